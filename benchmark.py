@@ -0,0 +1,279 @@
+from __future__ import print_function
+
+import os
+import sys
+import time
+import json
+import math
+import select
+import socket
+import argparse
+import subprocess
+
+clock = getattr(time, "perf_counter", time.time)
+
+
+###############################################################################
+# Synthetic game, run in its own process under the debugger
+###############################################################################
+
+def benchmark_game(depth, dict_size):
+    import debugger
+    debugger.attach()
+
+    big = dict(("key%s" % str(i), i) for i in range(dict_size))
+    while True:
+        benchmark_deep(depth, big)
+
+
+def benchmark_deep(depth, big):
+    if depth > 0:
+        return benchmark_deep(depth - 1, big)
+    return benchmark_leaf(big)
+
+
+def benchmark_leaf(big):
+    hit_time = time.time()
+    stepped = len(big)
+    return stepped
+
+
+def benchmark_idle():
+    # never called, breakpoints set here are synchronized but never hit
+    a = 1
+    b = a + 1
+    c = b + 1
+    d = c + 1
+    e = d + 1
+    f = e + 1
+    g = f + 1
+    h = g + 1
+    i = h + 1
+    j = i + 1
+    return j
+
+
+LEAF_LINE = benchmark_leaf.__code__.co_firstlineno + 2
+"""
+line of benchmark_leaf game pauses on, hit_time is set when it pauses
+"""
+
+IDLE_LINES = list(range(benchmark_idle.__code__.co_firstlineno + 2, benchmark_idle.__code__.co_firstlineno + 12))
+"""
+lines of benchmark_idle which are toggled by setBreakpoints benchmark
+"""
+
+
+###############################################################################
+# Scripted client
+###############################################################################
+
+class BenchmarkClient(object):
+    """
+    Blocking client on top of non-blocking connection of manual_debugger
+
+    Every request waits for its response, events are kept with time they arrived
+    """
+
+    def __init__(self, address):
+        from manual_debugger import DAPConnection
+
+        deadline = time.time() + 10
+        while True:
+            try:
+                self.connection = DAPConnection(address, self.on_event, self.on_closed)
+                break
+            except socket.error:
+                # game is still starting
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+        self.closed = False
+        # list of (arrival time, event message)
+        self.events = []
+
+    def on_event(self, message):
+        self.events.append((time.time(), message))
+
+    def on_closed(self):
+        self.closed = True
+
+    def pump(self, done, timeout=30.0):
+        """
+        runs connection until done() is true
+        """
+
+        deadline = time.time() + timeout
+        while not done():
+            if self.closed:
+                raise RuntimeError("Game closed the connection")
+            if time.time() > deadline:
+                raise RuntimeError("Timed out waiting for game")
+            writers = [self.connection] if self.connection.wants_write() else []
+            readable, writable, _ = select.select([self.connection], writers, [], 0.1)
+            if writable:
+                self.connection.write()
+            if readable:
+                self.connection.read()
+
+    def request(self, command, arguments=None):
+        """
+        sends request and waits for its response, returning response body
+        """
+
+        responses = []
+        self.connection.request(command, arguments, responses.append)
+        self.pump(lambda: responses)
+        if not responses[0]["success"]:
+            raise RuntimeError("Request %s failed: %s" % (command, responses[0].get("message", "")))
+        return responses[0].get("body", {})
+
+    def timed(self, command, arguments=None):
+        """
+        sends request, returning seconds until its response arrived and response body
+        """
+
+        start = clock()
+        body = self.request(command, arguments)
+        return clock() - start, body
+
+    def wait_event(self, name):
+        """
+        waits for event name, returning its arrival time and the event, events before it are dropped
+        """
+
+        def arrived():
+            while self.events and self.events[0][1]["event"] != name:
+                self.events.pop(0)
+            return self.events
+        self.pump(arrived)
+        return self.events.pop(0)
+
+    def close(self):
+        if not self.closed:
+            self.connection.close()
+
+
+###############################################################################
+# Measurements
+###############################################################################
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(percent / 100.0 * len(ordered))) - 1)]
+
+
+def run_benchmark(client, path, iterations, depth):
+    """
+    runs every measurement iterations times, returning measurement name -> list of seconds
+    """
+
+    results = dict((name, []) for name in ("setBreakpoints", "stopped delivery", "stackTrace", "variables (large dict)",
+                                          "next -> stopped", "continue -> stopped"))
+
+    client.request("initialize", {"adapterID": "renpy-benchmark"})
+    client.wait_event("initialized")
+    client.request("configurationDone")
+    client.request("launch", {})
+
+    # breakpoints which are never hit, each sync changes half of them
+    for iteration in range(iterations):
+        lines = IDLE_LINES[iteration % 2::2] + IDLE_LINES[:len(IDLE_LINES) // 2]
+        elapsed, _ = client.timed("setBreakpoints", {"source": {"path": path}, "breakpoints": [{"line": l} for l in lines]})
+        results["setBreakpoints"].append(elapsed)
+
+    client.request("setBreakpoints", {"source": {"path": path}, "breakpoints": [{"line": LEAF_LINE}]})
+    arrival, stopped = client.wait_event("stopped")
+    continued = None
+    for iteration in range(iterations):
+        thread_id = stopped["body"]["threadId"]
+
+        elapsed, body = client.timed("stackTrace", {"threadId": thread_id, "startFrame": 0, "levels": 0})
+        results["stackTrace"].append(elapsed)
+        if len(body["stackFrames"]) < depth:
+            raise RuntimeError("Paused in unexpected frame %s" % body["stackFrames"][0]["name"])
+        frame_id = body["stackFrames"][0]["id"]
+
+        # in microseconds, formatted float would lose precision
+        hit_time = int(client.request("evaluate", {"expression": "int(hit_time * 1000000)", "frameId": frame_id,
+                                                   "context": "repl"})["result"]) / 1000000.0
+        results["stopped delivery"].append(arrival - hit_time)
+        if continued is not None:
+            results["continue -> stopped"].append(arrival - continued)
+
+        scopes = client.request("scopes", {"frameId": frame_id})["scopes"]
+        local_variables = client.request("variables", {"variablesReference": scopes[0]["variablesReference"]})["variables"]
+        big = [v for v in local_variables if v["name"] == "big"][0]
+        elapsed, body = client.timed("variables", {"variablesReference": big["variablesReference"]})
+        results["variables (large dict)"].append(elapsed)
+
+        stepping = time.time()
+        client.request("next", {"threadId": thread_id})
+        arrival, stopped = client.wait_event("stopped")
+        results["next -> stopped"].append(arrival - stepping)
+
+        continued = time.time()
+        client.request("continue", {"threadId": thread_id})
+        arrival, stopped = client.wait_event("stopped")
+
+    client.request("setBreakpoints", {"source": {"path": path}, "breakpoints": []})
+    client.request("continue", {"threadId": stopped["body"]["threadId"]})
+    return results
+
+
+def print_results(results, out=sys.stdout):
+    print("%-24s %6s %10s %10s %10s" % ("measurement", "n", "p50 ms", "p99 ms", "max ms"), file=out)
+    for name in sorted(results):
+        values = results[name]
+        if values:
+            print("%-24s %6s %10.3f %10.3f %10.3f" % (name, str(len(values)), percentile(values, 50) * 1000,
+                                                      percentile(values, 99) * 1000, max(values) * 1000), file=out)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures latency of debugger requests and events against synthetic game on loopback")
+    parser.add_argument("--iterations", type=int, default=100, help="number of times each measurement is repeated")
+    parser.add_argument("--depth", type=int, default=200, help="depth of stack game pauses in")
+    parser.add_argument("--dict-size", type=int, default=10000, help="number of items of dict whose variables are listed")
+    parser.add_argument("--socket", help="use unix domain socket with this path instead of tcp port")
+    parser.add_argument("--python", default=sys.executable, help="python running the game, default is this one")
+    parser.add_argument("--json", help="also write results (seconds of every measurement) into this file")
+    parser.add_argument("--game", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.game:
+        benchmark_game(args.depth, args.dict_size)
+        sys.exit(0)
+
+    path = os.path.abspath(__file__)
+    if path.endswith(".pyc"):
+        path = path[:-1]
+
+    env = dict(os.environ)
+    if args.socket:
+        env["RENPY_DEBUGGER_SOCKET"] = args.socket
+        address = args.socket
+    else:
+        probe = socket.socket()
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        env["RENPY_DEBUGGER_PORT"] = str(port)
+        address = ("127.0.0.1", port)
+
+    game = subprocess.Popen([args.python, path, "--game", "--depth", str(args.depth), "--dict-size", str(args.dict_size)],
+                            env=env, cwd=os.path.dirname(path))
+    try:
+        client = BenchmarkClient(address)
+        try:
+            results = run_benchmark(client, path, args.iterations, args.depth)
+        finally:
+            client.close()
+    finally:
+        game.terminate()
+        game.wait()
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=1, sort_keys=True)
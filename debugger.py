@@ -8,11 +8,50 @@ import json
 import traceback
 import types
 import time
+import gzip
+import re
+import mmap
+import stat
+import struct
+import array
+import itertools
+import bisect
+import gc
+import marshal
+import weakref
+import atexit
+from collections import deque
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
+
+try:
+    TEXT_TYPES = (str, unicode)
+    INTEGER_TYPES = (int, long)
+except NameError:
+    # python 3 has neither unicode nor long, its bytes are the old str
+    TEXT_TYPES = (str, bytes)
+    INTEGER_TYPES = (int,)
 
 from librpydb.baseconf import DEBUGGER_PORT
 from librpydb.utils import NoneDict
 from librpydb.dis import dis
+from dis import findlinestarts, opname, cmp_op, hasconst, hasname, haslocal, hascompare, hasjrel, hasfree, \
+    HAVE_ARGUMENT, EXTENDED_ARG
+
+try:
+    from dis import get_instructions
+except ImportError:
+    get_instructions = None
 from librpydb.protocol import *
+from librpydb.protocol.base import DAPObject
 
 
 # Holds the instance of renpy debugger if debug mode is on
@@ -20,6 +59,297 @@ debugger = None
 # instance of debug handler,
 handler = None
 
+# features of this debugger reported to client
+debugger_features = dict(features)
+debugger_features.update(supports_evaluate_for_hovers=True, supports_set_variable=True, supports_set_expression=True,
+                         supports_data_breakpoints=True, supports_log_points=True, supports_function_breakpoints=True)
+
+INSTRUCTION_TRACING = hasattr(types.FrameType, "f_trace_opcodes")
+"""
+True if python can trace single instructions (3.7+), needed for instruction breakpoints and stepping
+"""
+
+# features newer than protocol classes, added to serialized capabilities
+custom_features = {"supportsDisassembleRequest": True, "supportsInstructionBreakpoints": INSTRUCTION_TRACING,
+                   "supportsSteppingGranularity": INSTRUCTION_TRACING}
+
+EVALUATION_TIMEOUT = 5.0
+"""
+time budget of evaluate, setVariable and setExpression requests in seconds
+"""
+
+PAUSE_SNAPSHOT_LEVELS = 20
+"""
+default number of stack frames in pause snapshot
+"""
+
+PAUSE_SNAPSHOT_VARIABLES = 100
+"""
+default number of variables of each scope in pause snapshot
+"""
+
+custom_requests = set([u"exportSnapshot", u"pauseSnapshot", u"setRecording", u"dumpRecording", u"heapStatistics",
+                       u"disassemble", u"setInstructionBreakpoints"])
+"""
+commands of requests handled by this debugger which are not in DAP specification
+"""
+
+_determine_dap_factory = DAPObject.determine_root_factory
+
+
+@staticmethod
+def _determine_root_factory(data):
+    # custom requests are deserialized as plain requests with their arguments as dict
+    if data["type"] == "request" and data["command"] in custom_requests:
+        return DAPRequest
+    # so are steps with granularity, their arguments are newer than protocol classes
+    if data["type"] == "request" and data["command"] in (u"next", u"stepIn") and "granularity" in data.get("arguments", {}):
+        return DAPRequest
+    return _determine_dap_factory(data)
+
+
+DAPObject.determine_root_factory = _determine_root_factory
+
+
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+"""
+levels of debugger log, messages below configured level are not logged
+"""
+
+LOG_BUFFER = 1000
+"""
+number of messages debugger log buffers before it drops the oldest ones
+"""
+
+
+class DebuggerLog(object):
+    """
+    Leveled log of debugger's own diagnostics
+
+    Messages are formatted and written by flusher thread, so logging thread only appends
+    message and its arguments to buffer. Log goes to file or to original stderr, never
+    to sys.stdout, which renpy redirects into its own log.
+    """
+
+    def __init__(self):
+        self.level = LOG_LEVELS["info"]
+        # file log is written to, None for original stderr
+        self.path = None
+        self.buffer = deque(maxlen=LOG_BUFFER)
+        self.dropped = 0
+        self.pending = threading.Event()
+        # serializes writes of flusher and final flush at exit
+        self.write_lock = threading.Lock()
+        self.flusher = None
+
+    def configure(self, path=None, level=None):
+        self.path = path
+        if level is not None:
+            self.level = LOG_LEVELS[level.lower()]
+
+    def log(self, level, message, *args):
+        if level < self.level:
+            return
+        if len(self.buffer) == LOG_BUFFER:
+            self.dropped += 1
+        self.buffer.append((time.time(), level, message, args))
+        if self.flusher is None:
+            self.start()
+        self.pending.set()
+
+    def debug(self, message, *args):
+        self.log(10, message, *args)
+
+    def info(self, message, *args):
+        self.log(20, message, *args)
+
+    def warning(self, message, *args):
+        self.log(30, message, *args)
+
+    def error(self, message, *args):
+        self.log(40, message, *args)
+
+    def exception(self, message, *args):
+        """
+        logs error with traceback of exception being handled
+        """
+
+        self.log(40, message + "\n%s", *(args + (traceback.format_exc().rstrip(),)))
+
+    def start(self):
+        with self.write_lock:
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.run, name="debugger log")
+                self.flusher.is_debugger_thread = True
+                self.flusher.daemon = True
+                self.flusher.start()
+
+    def run(self):
+        while True:
+            self.pending.wait()
+            self.pending.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        writes all buffered messages
+        """
+
+        names = dict((number, name.upper()) for name, number in LOG_LEVELS.items())
+        with self.write_lock:
+            lines = []
+            dropped, self.dropped = self.dropped, 0
+            if dropped:
+                lines.append("renpy debugger: %s log messages dropped\n" % str(dropped))
+            while True:
+                try:
+                    timestamp, level, message, args = self.buffer.popleft()
+                except IndexError:
+                    break
+                try:
+                    message = message % args if args else message
+                except Exception:
+                    message = "%s %s" % (message, repr(args))
+                lines.append("%s renpy debugger %s: %s\n" % (time.strftime("%H:%M:%S", time.localtime(timestamp)),
+                                                             names[level], message))
+            if not lines:
+                return
+
+            try:
+                if self.path is not None:
+                    with open(self.path, "a") as output:
+                        output.writelines(lines)
+                elif sys.__stderr__ is not None:
+                    sys.__stderr__.writelines(lines)
+                    sys.__stderr__.flush()
+            except Exception:
+                # nowhere to report failure of the log itself
+                pass
+
+
+log = DebuggerLog()
+atexit.register(log.flush)
+
+
+OUTPUT_INTERVAL = 0.05
+"""
+time in seconds output is collected for before it is sent, output in that time is sent as one event per category
+"""
+
+OUTPUT_BUFFER_LIMIT = 1 << 20
+"""
+maximum number of characters of output waiting to be sent, output over it is dropped
+"""
+
+
+class EventQueue(object):
+    """
+    Events waiting to be sent to client
+
+    Events are sent by queue's own thread, so threads producing them never wait for the socket
+    and slow client only makes events pile up here. Pending events are coalesced: stopped event
+    of thread replaces its older stopped event that was not sent yet, output is collected for
+    OUTPUT_INTERVAL and consecutive output of same category goes in single event, and output over
+    OUTPUT_BUFFER_LIMIT is dropped and reported in the next output event (or its own one). Other
+    events are sent in order, output and stopped events keep their place among them.
+
+    Events belong to generation of client session they were queued in, events of previous
+    client are never sent to the next one.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        # list of [kind, key, create, args, kwargs], kind is "event", "stopped" or "output"
+        self.pending = []
+        # client session pending events belong to, changed under server's send_lock
+        self.generation = 0
+        self.output_size = 0
+        self.dropped_output = 0
+        self.last_output = 0.0
+        self.condition = threading.Condition(threading.Lock())
+        self.thread = threading.Thread(target=self.run, name="DAP events")
+        self.thread.is_debugger_thread = True
+        self.thread.daemon = True
+        self.thread.start()
+
+    def clear(self):
+        """
+        drops pending events and starts new generation, called under server's send_lock when client changes
+        """
+
+        with self.condition:
+            self.generation += 1
+            self.pending = []
+            self.output_size = 0
+            self.dropped_output = 0
+
+    def put(self, create, *args, **kwargs):
+        with self.condition:
+            self.pending.append(["event", None, create, args, kwargs])
+            self.condition.notify()
+
+    def put_stopped(self, thread_id, create, *args, **kwargs):
+        with self.condition:
+            self.pending = [event for event in self.pending if event[0] != "stopped" or event[1] != thread_id]
+            self.pending.append(["stopped", thread_id, create, args, kwargs])
+            self.condition.notify()
+
+    def put_output(self, output, category):
+        with self.condition:
+            if self.output_size + len(output) > OUTPUT_BUFFER_LIMIT:
+                self.dropped_output += len(output)
+                return
+            self.output_size += len(output)
+            last = self.pending[-1] if self.pending else None
+            if last is not None and last[0] == "output" and last[1] == category:
+                last[3].append(output)
+            else:
+                self.pending.append(["output", category, None, [output], None])
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                if all(event[0] == "output" for event in self.pending):
+                    # only output is waiting, collect more of it
+                    remaining = self.last_output + OUTPUT_INTERVAL - time.time()
+                    if remaining > 0:
+                        self.condition.wait(remaining)
+                        continue
+                pending, self.pending = self.pending, []
+                self.output_size = 0
+                dropped, self.dropped_output = self.dropped_output, 0
+                generation = self.generation
+
+            for kind, key, create, args, kwargs in pending:
+                if kind == "output":
+                    output = "".join(args)
+                    if dropped:
+                        output += "(%s characters of output dropped)\n" % str(dropped)
+                        dropped = 0
+                    self.last_output = time.time()
+                    self.send(generation, DAPOutputEvent.create, DAPOutputEventBody.create(output, category=key))
+                else:
+                    self.send(generation, create, *args, **kwargs)
+            if dropped:
+                # no output event carried the report
+                self.send(generation, DAPOutputEvent.create,
+                          DAPOutputEventBody.create("(%s characters of output dropped)\n" % str(dropped), category="console"))
+
+    def send(self, generation, create, *args, **kwargs):
+        """
+        sends event taken from queue in generation, unless client changed since
+        """
+
+        try:
+            with self.server.send_lock:
+                if generation == self.generation:
+                    self.server.send(create, *args, **kwargs)
+        except Exception:
+            log.exception("Failed to send event")
+
 
 class DebugAdapterProtocolServer(threading.Thread):
     """
@@ -31,12 +361,27 @@ class DebugAdapterProtocolServer(threading.Thread):
     This will start listening in a new thread
     """
 
-    def __init__(self):
+    is_debugger_thread = True
+
+    def __init__(self, socket_path=None, channel=None):
         super(DebugAdapterProtocolServer, self).__init__(name="DAP")
         self.daemon = True
+        # if set, server listens on unix domain socket with this path instead of tcp port
+        self.socket_path = socket_path
+        # memory mapped channel for output, None if output goes in output events
+        self.channel = channel
         self._current_client = None
         # True if there is client connected whom is all set up
         self._ready_for_events = False
+        # messages are sent both from read loop and from paused threads, sequence and writes are under this lock
+        # reentrant, event queue holds it while checking its events still belong to current client
+        self.send_lock = threading.RLock()
+        # pauseSnapshot arguments pushed with every stopped event, None if client did not opt in
+        self.pause_snapshot_arguments = None
+        # granularity of next and stepIn without their own granularity, set by setStepGranularity
+        self.step_granularity = "line"
+        # events sent by their own thread
+        self.events = EventQueue(self)
 
         self.start()
 
@@ -48,11 +393,20 @@ class DebugAdapterProtocolServer(threading.Thread):
         Starts the handler server
         """
 
-        listen_port = DEBUGGER_PORT if "RENPY_DEBUGGER_PORT" not in os.environ else os.environ["RENPY_DEBUGGER_PORT"]
+        if self.socket_path is not None:
+            if os.path.lexists(self.socket_path):
+                if not stat.S_ISSOCK(os.lstat(self.socket_path).st_mode):
+                    raise ValueError("%s exists and is not a socket, refusing to replace it" % self.socket_path)
+                # socket left by previous run
+                os.unlink(self.socket_path)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(self.socket_path)
+        else:
+            listen_port = int(os.environ.get("RENPY_DEBUGGER_PORT", DEBUGGER_PORT))
 
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server.bind(("0.0.0.0", listen_port))
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind(("0.0.0.0", listen_port))
         server.listen(0)
 
         while True:
@@ -64,8 +418,14 @@ class DebugAdapterProtocolServer(threading.Thread):
         Attaches single client to the debugging
         """
 
-        self._current_client = csocket
-        self.next_seq = -1
+        if csocket.family == socket.AF_INET:
+            csocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.send_lock:
+            self._current_client = csocket
+            self.next_seq = -1
+            # events queued for previous client are dropped, even those being sent right now
+            self.events.clear()
+        self.pause_snapshot_arguments = None
 
         # manual requests
 
@@ -74,6 +434,9 @@ class DebugAdapterProtocolServer(threading.Thread):
     def enter_read_loop(self):
         """
         This thread blocks and waits for messages from current client
+
+        Client may pipeline requests without waiting for responses, they are resolved in order
+        and each response is sent as soon as it is ready
         """
 
         try:
@@ -82,7 +445,7 @@ class DebugAdapterProtocolServer(threading.Thread):
                     request = DAPBaseMessage.recv(self._current_client)
                 except Exception as e:
                     # TODO send error
-                    traceback.print_exc()
+                    log.exception("Failed to receive message")
                     continue
 
                 if request is None:
@@ -91,10 +454,8 @@ class DebugAdapterProtocolServer(threading.Thread):
                 try:
                     self.resolve_message(request)
                 except Exception as e:
-                    # TODO send error
-                    traceback.print_exc()
-                    self.next_seq += 1
-                    DAPErrorResponse.create(self.next_seq, rq.seq, False, message="Error").send(self._current_client)
+                    log.exception("Failed to resolve %s", getattr(request, "command", "message"))
+                    self.send_error(request, "Error: %s" % str(e))
                     continue
 
                 if self._current_client is None:
@@ -103,8 +464,7 @@ class DebugAdapterProtocolServer(threading.Thread):
 
         except BaseException as e:
             # failure while communicating
-            traceback.print_exc()
-            pass
+            log.exception("Client connection failed")
         finally:
             # final handler, clear active client
             self._current_client = None
@@ -120,118 +480,333 @@ class DebugAdapterProtocolServer(threading.Thread):
         """
 
         if rq.command == u"initialize":
-            self.next_seq += 1
-            DAPInitializeResponse.create(self.next_seq, rq.seq, True, rq.command, body=DAPCapabilities.create(**features)).send(self._current_client)
-            self.next_seq += 1
-            DAPInitializedEvent.create(self.next_seq).send(self._current_client)
+            body = DAPCapabilities.create(**debugger_features).serialize()
+            body.update(custom_features)
+            self.send(DAPResponse.create, rq.seq, True, rq.command, body=body)
+            self.send(DAPInitializedEvent.create)
         elif rq.command == u"setBreakpoints":
-            self.next_seq += 1
             bkps = self.create_breakpoints(**rq.get_arguments().as_current_kwargs())
             body = DAPSetBreakpointsResponseBody.create([b.serialize() for b in bkps])
-            DAPSetBreakpointsResponse.create(self.next_seq, rq.seq, True, body).send(self._current_client)
+            self.send(DAPSetBreakpointsResponse.create, rq.seq, True, body)
         elif rq.command == u"configurationDone":
-            self.next_seq += 1
-            DAPConfigurationDoneResponse.create(self.next_seq, rq.seq, True).send(self._current_client)
+            self.send(DAPConfigurationDoneResponse.create, rq.seq, True)
         elif rq.command == u"launch":
             # no special noDebug
-            self.next_seq += 1
-            DAPLaunchResponse.create(self.next_seq, rq.seq, True).send(self._current_client)
+            self.send(DAPLaunchResponse.create, rq.seq, True)
             self._ready_for_events = True
         elif rq.command == u"disconnect":
-            self.next_seq += 1
-            DAPDisconnectResponse.create(self.next_seq, rq.seq, True).send(self._current_client)
-            self._current_client.close()
-            self._current_client = None
+            self.send(DAPDisconnectResponse.create, rq.seq, True)
+            with self.send_lock:
+                self._current_client.close()
+                self._current_client = None
             return
         elif rq.command == u"continue":
-            self.next_seq += 1
-            body = DAPContinueResponseBody.create(all_threads_continued=True)
-            DAPContinueResponse.create(self.next_seq, rq.seq, True, body).send(self._current_client)
-            debugger.stepping = SteppingMode.STEP_NO_STEP
-            debugger.continue_next()
+            thread_id = rq.get_arguments().get_thread_id()
+            thread = debugger.get_thread(thread_id)
+            if thread is not None:
+                thread.stepping = NO_STEP
+            body = DAPContinueResponseBody.create(all_threads_continued=debugger.pause_all)
+            self.send(DAPContinueResponse.create, rq.seq, True, body)
+            debugger.resume(thread_id)
         elif rq.command == u"threads":
-            self.next_seq += 1
-            body = DAPThreadsResponseBody.create([DAPThread.create(0, "renpy_main")])
-            DAPThreadsResponse.create(self.next_seq, rq.seq, True, body).send(self._current_client)
+            body = DAPThreadsResponseBody.create([DAPThread.create(t.id, t.get_name()) for t in debugger.get_threads()])
+            self.send(DAPThreadsResponse.create, rq.seq, True, body)
         elif rq.command == u"stackTrace":
-            self.next_seq += 1
             body = DAPStackTraceResponseBody.create(debugger.get_stack_frames(**rq.get_arguments().as_current_kwargs()))
-            DAPStackTraceResponse.create(self.next_seq, rq.seq, True, body).send(self._current_client)
+            self.send(DAPStackTraceResponse.create, rq.seq, True, body)
         elif rq.command == u"scopes":
-            self.next_seq += 1
             body = DAPScopesResponseBody.create(debugger.get_scopes(int(rq.get_arguments().get_frame_id())))
-            DAPScopesResponse.create(self.next_seq, rq.seq, True, body).send(self._current_client)
+            self.send(DAPScopesResponse.create, rq.seq, True, body)
         elif rq.command == u"variables":
-            self.next_seq += 1
             body = DAPVariablesResponseBody.create(debugger.format_variable(**rq.get_arguments().as_current_kwargs()))
-            DAPVariablesResponse.create(self.next_seq, rq.seq, True, body).send(self._current_client)
+            self.send(DAPVariablesResponse.create, rq.seq, True, body)
         elif rq.command == u"pause":
-            self.next_seq += 1
-            DAPPauseResponse.create(self.next_seq, rq.seq, True).send(self._current_client)
-            debugger.break_pause = True
+            self.send(DAPPauseResponse.create, rq.seq, True)
+            debugger.request_pause(rq.get_arguments().get_thread_id())
         elif rq.command == u"next":
-            print("STEP")
-            self.next_seq += 1
-            DAPNextResponse.create(self.next_seq, rq.seq, True).send(self._current_client)
-            debugger.store_frames()
-            debugger.stepping = SteppingMode.STEP_NEXT
-            debugger.continue_next()
+            self.step(rq, DAPNextResponse.create, StepNext, StepInstruction)
         elif rq.command == u"stepIn":
-            self.next_seq += 1
-            DAPStepInResponse.create(self.next_seq, rq.seq, True).send(self._current_client)
-            debugger.store_frames()
-            debugger.stepping = SteppingMode.STEP_INTO
-            debugger.continue_next()
+            self.step(rq, DAPStepInResponse.create, StepInto, StepInstructionInto)
+        elif rq.command == u"setStepGranularity":
+            granularity = rq.get_arguments().get_granularity()
+            if granularity != "instruction" or not INSTRUCTION_TRACING:
+                granularity = "line"
+            self.step_granularity = granularity
+            self.send(DAPSetStepGranularityResponse.create, rq.seq, True, DAPSetStepGranularityResponseBody.create(granularity))
         elif rq.command == u"stepOut":
-            self.next_seq += 1
-            DAPStepOutResponse.create(self.next_seq, rq.seq, True).send(self._current_client)
-            debugger.store_frames()
-            debugger.stepping = SteppingMode.STEP_OUT
-            debugger.continue_next()
+            self.send(DAPStepOutResponse.create, rq.seq, True)
+            debugger.step(rq.get_arguments().get_thread_id(), StepOut)
+        elif rq.command == u"evaluate":
+            self.respond_from_thread(rq, debugger.evaluate, DAPEvaluateResponseBody.create, DAPEvaluateResponse.create)
+        elif rq.command == u"setVariable":
+            self.respond_from_thread(rq, debugger.set_variable, DAPSetVariableResponseBody.create,
+                                     DAPSetVariableResponse.create)
+        elif rq.command == u"setExpression":
+            self.respond_from_thread(rq, debugger.set_expression, DAPSetExpressionResponseBody.create,
+                                     DAPSetExpressionResponse.create)
+        elif rq.command == u"dataBreakpointInfo":
+            body = DAPDataBreakpointInfoResponseBody.create(**debugger.data_breakpoint_info(**rq.get_arguments().as_current_kwargs()))
+            self.send(DAPDataBreakpointInfoResponse.create, rq.seq, True, body)
+        elif rq.command == u"setFunctionBreakpoints":
+            bkps = self.create_function_breakpoints(**rq.get_arguments().as_current_kwargs())
+            body = DAPSetFunctionBreakpointsResponseBody.create([b.serialize() for b in bkps])
+            self.send(DAPSetFunctionBreakpointsResponse.create, rq.seq, True, body)
+        elif rq.command == u"setDataBreakpoints":
+            bkps = self.create_data_breakpoints(**rq.get_arguments().as_current_kwargs())
+            body = DAPSetDataBreakpointsResponseBody.create([b.serialize() for b in bkps])
+            self.send(DAPSetDataBreakpointsResponse.create, rq.seq, True, body)
+        elif rq.command == u"exportSnapshot":
+            arguments = rq.get_arguments_or_default({})
+            try:
+                body = debugger.export_snapshot(**arguments)
+            except Exception as e:
+                self.send_error(rq, str(e))
+            else:
+                self.send(DAPResponse.create, rq.seq, True, rq.command, body=body)
+        elif rq.command == u"setRecording" or rq.command == u"dumpRecording":
+            arguments = rq.get_arguments_or_default({})
+            try:
+                if rq.command == u"setRecording":
+                    body = debugger.set_recording(**arguments)
+                else:
+                    body = debugger.dump_recording(**arguments)
+            except Exception as e:
+                self.send_error(rq, str(e))
+            else:
+                self.send(DAPResponse.create, rq.seq, True, rq.command, body=body)
+        elif rq.command == u"disassemble":
+            arguments = rq.get_arguments_or_default({})
+            try:
+                body = debugger.disassemble(**arguments)
+            except Exception as e:
+                self.send_error(rq, str(e))
+            else:
+                self.send(DAPResponse.create, rq.seq, True, rq.command, body=body)
+        elif rq.command == u"setInstructionBreakpoints":
+            arguments = rq.get_arguments_or_default({})
+            try:
+                bkps = self.create_instruction_breakpoints(**arguments)
+            except Exception as e:
+                self.send_error(rq, str(e))
+            else:
+                self.send(DAPResponse.create, rq.seq, True, rq.command, body={"breakpoints": [b.serialize() for b in bkps]})
+        elif rq.command == u"heapStatistics":
+            arguments = rq.get_arguments_or_default({})
+            sample = arguments.pop("sample", 1)
+            refresh = arguments.pop("refresh", debugger.heap_statistics is None)
+
+            def respond(error=None):
+                try:
+                    if error is not None:
+                        raise error
+                    body = debugger.heap_statistics_page(**arguments)
+                except Exception as e:
+                    self.send_error(rq, str(e))
+                else:
+                    self.send(DAPResponse.create, rq.seq, True, rq.command, body=body)
+
+            if refresh:
+                try:
+                    debugger.collect_heap_statistics(sample, respond)
+                except Exception as e:
+                    self.send_error(rq, str(e))
+            else:
+                respond()
+        elif rq.command == u"pauseSnapshot":
+            arguments = rq.get_arguments_or_default({})
+            push = arguments.pop("push", None)
+            if push is not None:
+                self.pause_snapshot_arguments = dict((k, v) for k, v in arguments.items() if k != "threadId") if push else None
+            try:
+                body = debugger.pause_snapshot(**arguments)
+            except Exception as e:
+                self.send_error(rq, str(e))
+            else:
+                self.send(DAPResponse.create, rq.seq, True, rq.command, body=body)
         else:
+            self.send_error(rq, "NotImplemented")
+
+    def send(self, create, *args, **kwargs):
+        """
+        Creates message with create, numbered with next sequence number, and sends it to client
+        """
+
+        with self.send_lock:
+            if self._current_client is None:
+                return
             self.next_seq += 1
-            DAPErrorResponse.create(self.next_seq, rq.seq, False, message="NotImplemented").send(self._current_client)
+            create(self.next_seq, *args, **kwargs).send(self._current_client)
+
+    def send_error(self, rq, message):
+        """
+        Sends failed response with message to request rq
+        """
+
+        self.send(DAPErrorResponse.create, rq.seq, False, rq.command, DAPErrorResponseBody.create(), message=message)
+
+    def respond_from_thread(self, rq, run, create_body, create_response):
+        """
+        Runs request rq with run, which responds later from paused thread, so reading of requests continues
+
+        run is called with callback receiving response body arguments or exception, and request arguments
+        """
+
+        def done(result, exception):
+            if exception is not None:
+                self.send_error(rq, str(exception))
+            else:
+                self.send(create_response, rq.seq, True, create_body(**result))
+
+        try:
+            run(done, **rq.get_arguments().as_current_kwargs())
+        except Exception as e:
+            self.send_error(rq, str(e))
 
     def create_breakpoints(self, source, breakpoints=[], lines=[], sourceModified=False):
         """
         Creates breakpoints from request
         """
 
-        print("Synchronizing breakpoints for source=%s, bkps=%s" % (str(source), str(breakpoints)))
+        log.debug("Synchronizing %s breakpoints of %s", len(breakpoints), source.path)
         path = source.path
         created_breakpoints = []
 
-        debugger.clear_source_breakpoints(path)
-
         for bkp_info in breakpoints:
             line = bkp_info.get_line()
             condition = bkp_info.get_condition_or_default()
             hit_condition = bkp_info.get_hit_condition_or_default()
             if hit_condition is not None:
                 hit_condition = int(hit_condition)
-            # log message not suppored (yet?)
+            log_message = bkp_info.get_log_message_or_default()
+
+            breakpoint = Breakpoint(path, line, eval_condition=condition, counter=hit_condition, log_message=log_message)
+            created_breakpoints.append(breakpoint)
+
+        return debugger.set_source_breakpoints(path, created_breakpoints)
+
+    def create_function_breakpoints(self, breakpoints):
+        """
+        Creates function breakpoints from request, replacing all existing ones
+        """
+
+        created_breakpoints = []
+        for bkp_info in breakpoints:
+            hit_condition = bkp_info.get_hit_condition_or_default()
+            if hit_condition is not None:
+                hit_condition = int(hit_condition)
+
+            breakpoint = FunctionBreakpoint(bkp_info.get_name(), eval_condition=bkp_info.get_condition_or_default(),
+                                            counter=hit_condition)
+            created_breakpoints.append(breakpoint)
+
+        debugger.set_function_breakpoints(created_breakpoints)
+        return created_breakpoints
+
+    def create_instruction_breakpoints(self, breakpoints):
+        """
+        Creates instruction breakpoints from request, replacing all existing ones
+        """
+
+        created_breakpoints = []
+        for bkp_info in breakpoints:
+            hit_condition = bkp_info.get("hitCondition", None)
+            if hit_condition is not None:
+                hit_condition = int(hit_condition)
+
+            breakpoint = InstructionBreakpoint(bkp_info["instructionReference"], offset=bkp_info.get("offset", 0),
+                                               eval_condition=bkp_info.get("condition", None), counter=hit_condition)
+            created_breakpoints.append(breakpoint)
+
+        debugger.set_instruction_breakpoints(created_breakpoints)
+        return created_breakpoints
+
+    def step(self, rq, create_response, stepping, instruction_stepping):
+        """
+        Steps thread of next or stepIn request, by instructions if request or setStepGranularity asks for it
+        """
+
+        arguments = rq.get_arguments()
+        if isinstance(arguments, dict):
+            thread_id = arguments["threadId"]
+            granularity = arguments["granularity"]
+        else:
+            thread_id = arguments.get_thread_id()
+            granularity = self.step_granularity
+
+        self.send(create_response, rq.seq, True)
+        if granularity == "instruction" and INSTRUCTION_TRACING:
+            stepping = instruction_stepping
+        debugger.step(thread_id, stepping)
+
+    def create_data_breakpoints(self, breakpoints):
+        """
+        Creates data breakpoints from request, replacing all existing ones
+        """
+
+        created_breakpoints = []
+        for bkp_info in breakpoints:
+            hit_condition = bkp_info.get_hit_condition_or_default()
+            if hit_condition is not None:
+                hit_condition = int(hit_condition)
 
-            breakpoint = Breakpoint(path, line, eval_condition=condition, counter=hit_condition)
-            print("Added breakpoint %s" % str(breakpoint))
-            debugger.register_breakpoint(breakpoint)
+            breakpoint = DataBreakpoint(bkp_info.get_data_id(), access_type=bkp_info.get_access_type_or_default("write"),
+                                        eval_condition=bkp_info.get_condition_or_default(), counter=hit_condition)
             created_breakpoints.append(breakpoint)
 
+        debugger.set_data_breakpoints(created_breakpoints)
         return created_breakpoints
 
-    def send_breakpoint_event(self, breakpoint):
-        self.pause_debugging()
+    def send_breakpoint_event(self, thread, breakpoint):
+        self.pause_debugging(thread)
+
+    def pause_debugging(self, thread):
+        """
+        Sends message to client that thread has been paused
+
+        If client opted in, pause snapshot of the thread is pushed in the event's body as pauseSnapshot
+        """
+
+        body = DAPStoppedEventBody.create(reason=thread.pause_reason, description=thread.frame_location_info(),
+                                          thread_id=thread.id, preserve_focus_hint=False,
+                                          all_threads_stopped=debugger.pause_all)
+
+        arguments = self.pause_snapshot_arguments
+        if arguments is None:
+            self.events.put_stopped(thread.id, DAPStoppedEvent.create, body)
+            return
+
+        body = body.serialize()
+        try:
+            body["pauseSnapshot"] = debugger.pause_snapshot(thread.id, **arguments)
+        except Exception:
+            log.exception("Failed to create pause snapshot")
+        self.events.put_stopped(thread.id, DAPEvent.create, u"stopped", body=body)
+
+    def send_output(self, output, category="console"):
+        """
+        Sends output to client, through memory mapped channel if there is one
+        """
+
+        if self.channel is not None:
+            self.channel.write({"category": category, "output": output})
+        else:
+            self.events.put_output(output, category)
 
-    def pause_debugging(self):
+    def send_breakpoint_changed(self, breakpoint):
         """
-        Sends message to client that debug state has been paused
+        Sends message to client that breakpoint moved or its verification changed
         """
 
-        body = DAPStoppedEventBody.create(reason=debugger.pause_reason, description=debugger.frame_location_info(),
-                                          thread_id=0, preserve_focus_hint=False,
-                                          all_threads_stopped=True)
-        self.next_seq += 1
-        DAPStoppedEvent.create(self.next_seq, body).send(self._current_client)
+        body = DAPBreakpointEventBody.create(u"changed", breakpoint)
+        self.events.put(DAPBreakpointEvent.create, body)
+
+    def send_thread_event(self, reason, thread):
+        """
+        Sends message to client that thread has started or exited
+        """
 
+        body = DAPThreadEventBody.create(reason, thread.id)
+        self.events.put(DAPThreadEvent.create, body)
 
 
 class Breakpoint(object):
@@ -239,517 +814,3292 @@ class Breakpoint(object):
     Breakpoint information
     """
 
-    def __init__(self, source, line, eval_condition=None, counter=None):
-        self.source = source.encode("utf-8") if isinstance(source, unicode) else source
-        self.line = int(line) if isinstance(line, str) or isinstance(line, unicode) else line
+    def __init__(self, source, line, eval_condition=None, counter=None, log_message=None):
+        # python 2 paths are byte strings, as are filenames of its code objects
+        self.source = source if isinstance(source, str) else source.encode("utf-8")
+        self.line = int(line) if isinstance(line, TEXT_TYPES) else line
+        # line client asked for, breakpoint is moved from it to executable line
+        self.requested_line = self.line
         self.eval_condition = eval_condition
         self.counter = counter
+        # if set, this is logpoint which logs message instead of pausing
+        self.log_message = log_message
         self.times_hit = 0
+        # id reported to client, assigned when breakpoint is activated
+        self.id = None
+        # reason why breakpoint is not verified, None if it is
+        self.error = None
 
     def __str__(self):
         return "<breakpoint %s: %s (%s, %s, %s)>" % (self.source, str(self.line), str(self.eval_condition), str(self.counter), str(self.times_hit))
 
+    def key(self):
+        """
+        returns what identifies this breakpoint within its source, breakpoints with same key are the same breakpoint
+        """
+
+        return self.line, self.eval_condition, self.counter, self.log_message
+
     def serialize(self):
         """
-        Stub method to send information about breakpoint back to client
+        Sends information about breakpoint back to client
         """
 
         data = {}
 
-        data["verified"] = True
+        data["id"] = self.id
+        data["verified"] = self.error is None
+        if self.source:
+            data["source"] = {"path": self.source}
+        data["line"] = self.line
+        if self.error is not None:
+            data["message"] = self.error
 
         return data
 
+    def snap(self, lines, complete=True):
+        """
+        moves breakpoint to first executable line at or after line client asked for
+
+        lines is sorted list of executable lines of breakpoint's source, empty if none of its code is loaded.
+        If lines are not complete, breakpoint on line not among them stays there, its code may be compiled later.
+        """
+
+        self.line = self.requested_line
+        self.error = None
+        if not lines:
+            self.error = "No code of this file is loaded yet"
+            return
+        if not complete and self.line not in lines:
+            return
+
+        index = bisect.bisect_left(lines, self.line)
+        if index == len(lines):
+            self.error = "No code at or after this line"
+        else:
+            self.line = lines[index]
+
     def applies(self, frame):
         """
         Checks whether this breakpoint applies to this frame
         """
         if frame.f_code.co_filename == self.source and frame.f_lineno == self.line:
-            # breakpoint hits, now try eval if it is eval
-
-            eval_passed = True
-            if self.eval_condition is not None:
-                eval_passed = False
-                try:
-                    if eval(self.eval_condition, frame.f_globals, frame.f_locals):
-                        # so eval_passed is boolean not whatever eval returned, it is in separate if!
-                        eval_passed = True
-                except BaseException:
-                    # eval failure, ignore
-                    pass
+            return self.hits(frame)
+        return False
 
-            if eval_passed:
-                # eval passed, check for counter
-                self.times_hit += 1
+    def hits(self, frame):
+        """
+        Checks condition and counter of breakpoint reached in frame
+        """
 
-                if self.counter is None or self.counter < self.times_hit:
-                    return True
+        # breakpoint hits, now try eval if it is eval
+        eval_passed = True
+        if self.eval_condition is not None:
+            eval_passed = False
+            try:
+                if eval(self.eval_condition, frame.f_globals, frame.f_locals):
+                    # so eval_passed is boolean not whatever eval returned, it is in separate if!
+                    eval_passed = True
+            except BaseException:
+                # eval failure, ignore
+                pass
+
+        if eval_passed:
+            # eval passed, check for counter
+            self.times_hit += 1
+
+            if self.counter is None or self.counter < self.times_hit:
+                return True
 
         return False
 
+    def format_log_message(self, frame):
+        """
+        formats log message of logpoint in frame, expressions in {} are replaced with their values
+        """
 
-class SteppingMode(object):
-    """
-    Stepping mode enum
-    """
+        def evaluate(match):
+            try:
+                return str(eval(match.group(1), frame.f_globals, frame.f_locals))
+            except BaseException as e:
+                return "<%s>" % str(e)
 
-    STEP_NO_STEP = 0
-    """
-    No stepping is active
-    """
+        return LOG_MESSAGE_EXPRESSION.sub(evaluate, self.log_message)
 
-    STEP_NEXT = 1
-    """
-    Stepping into next line is active
-    """
 
-    STEP_INTO = 2
+class InstructionBreakpoint(Breakpoint):
     """
-    Stepping into next call is active
+    Breakpoint at single instruction, given by memory reference of disassembled instruction and byte offset from it
     """
 
-    STEP_OUT = 3
-    """
-    Stepping out of call is active
-    """
+    def __init__(self, reference, offset=0, eval_condition=None, counter=None):
+        self.reference = reference
+        self.offset = offset
+        # code object and offset of instruction in its bytecode, resolved when breakpoint is set
+        self.code = None
+        self.instruction_offset = None
+        Breakpoint.__init__(self, "", 0, eval_condition=eval_condition, counter=counter)
 
-    # special case that will break next time anything is called!
-    STEP_SINGLE_EXEC = 99
-    """
-    Step into next line frame, wherever it is
-    """
+    def key(self):
+        return self.reference, self.offset, self.eval_condition, self.counter
 
+    def serialize(self):
+        data = Breakpoint.serialize(self)
+        data["instructionReference"] = self.reference
+        data["offset"] = self.offset
+        return data
 
-class RenpyPythonDebugger(object):
-    """
-    RenpyPythonDebugger
+    def resolve(self, disassembly):
+        """
+        finds instruction of breakpoint in disassembly, setting error if there is none
+        """
 
-    Contains debugging state and debugs renpy
-    """
+        if not INSTRUCTION_TRACING:
+            self.error = "Instruction breakpoints need python 3.7 or newer"
+            return
+        try:
+            self.code, self.instruction_offset = disassembly.resolve(self.reference, self.offset)
+        except ValueError as e:
+            self.error = str(e)
+            return
+        self.source = self.code.co_filename
+        self.line = disassembly.line_of(self.code, self.instruction_offset)
 
-    def __init__(self):
-        super(RenpyPythonDebugger, self).__init__()
+    def applies(self, frame):
+        return frame.f_lasti == self.instruction_offset and self.hits(frame)
 
-        # set of active breakpoints
-        self.active_breakpoints = set()
-        # breakpoints set modification lock
-        self.bkp_lock = threading.Lock()
 
-        # active stepping mode
-        self.stepping = SteppingMode.STEP_NO_STEP
-        # cont is main spinlock, when False, state is paused
-        self.cont = True
-        # why was renpy execution paused is stored here and reported to client
-        self.pause_reason = None
-        # break on cont failure reasons
-        #  pause was asked
-        self.break_pause = False
+LABEL_PREFIX = "label:"
+"""
+prefix of function breakpoint name which names renpy label instead of python function
+"""
 
-        # holds paths to variables for each scope opened
-        # scope assign containts tuples (value, parent_accessor, type (None for scope), parent_object)
-        self.scope_assign = {}
-        # current break var id generator (0->more)
-        self.scope_var_id = 0
 
-        # current active call frame
-        self.active_call = None
-        # current active line frame
-        self.active_frame = None
-        # stored frames when stepping happens, used to differentiate where to step
-        self.stored_frames = None
+class FunctionBreakpoint(Breakpoint):
+    """
+    Breakpoint on call of python function (qualified name, or bare name of any function with
+    that name) or on execution of renpy label (LABEL_PREFIX and label name)
 
-    def store_frames(self):
-        """
-        stores active call and line frame in stored_frames
-        """
-        self.stored_frames = (self.active_call, self.active_frame)
+    Name is resolved to code objects once, calls are then matched by code object alone.
+    Labels are matched in calls of renpy's Label.execute by node's name.
+    """
 
-    def reset(self):
-        """
-        resets state of the debugging
+    def __init__(self, name, eval_condition=None, counter=None):
+        Breakpoint.__init__(self, "", 0, eval_condition=eval_condition, counter=counter)
+        self.name = name
+        self.label = name[len(LABEL_PREFIX):] if name.startswith(LABEL_PREFIX) else None
+        # code objects calls of which hit the breakpoint
+        self.codes = []
 
-        called when client disconnects
-        """
-        with self.bkp_lock:
-            self.active_breakpoints = set()
-            self.stepping = SteppingMode.STEP_NO_STEP
-            self.continue_next()
+    def key(self):
+        return self.name, self.eval_condition, self.counter
 
-    def continue_next(self):
+    def code_name(self):
         """
-        resumes execution, clearing any scope info
+        returns name of code objects breakpoint resolves to
         """
 
-        self.scope_assign = {}
-        self.scope_var_id = 0
-        self.cont = True
+        return "execute" if self.label is not None else self.name.rpartition(".")[2]
 
-    def attach(self):
-        """
-        attaches itself into renpy and begins tracing
-        """
-        sys.settrace(self.trace_event)
+    def serialize(self):
+        # breakpoint is on function or label, not on place in source the name resolved to
+        data = Breakpoint.serialize(self)
+        data.pop("source", None)
+        del data["line"]
+        return data
 
-    def trace_event(self, frame, event, arg):
+    def resolve(self, index):
         """
-        tracing function for non line events
+        finds code objects of breakpoint's function through index, setting error if there are none
         """
 
-        self.active_frame = frame
-        self.active_call = frame
-
-        if event == "call":
+        if self.label is not None:
+            self.codes = index.label_codes()
+            node = index.label_node(self.label) if self.codes else None
+            if not self.codes:
+                self.error = "Not running in renpy"
+            elif node is None:
+                # still hits once label is loaded, but is not verified until then
+                self.error = "No label %s is loaded yet" % self.label
+            else:
+                self.source, self.line = node.filename, node.linenumber
+                self.error = None
+        else:
+            self.codes = index.resolve(self.name)
+            if self.codes:
+                self.source, self.line = self.codes[0].co_filename, self.codes[0].co_firstlineno
+                self.error = None
+            else:
+                self.error = "No function %s is loaded yet" % self.name
+
+    def applies(self, frame):
+        if self.label is not None and getattr(frame.f_locals.get("self"), "name", None) != self.label:
+            return False
+        return self.hits(frame)
+
+
+def _decode_instructions(code):
+    """
+    returns list of (offset, size, instruction name, argument or None, argument description) of code
+    """
+
+    decoded = []
+    if get_instructions is not None:
+        instructions = list(get_instructions(code))
+        for index, instruction in enumerate(instructions):
+            end = instructions[index + 1].offset if index + 1 < len(instructions) else len(code.co_code)
+            decoded.append((instruction.offset, end - instruction.offset, instruction.opname, instruction.arg, instruction.argrepr))
+        return decoded
+
+    bytecode = code.co_code
+    extended = 0
+    offset = 0
+    while offset < len(bytecode):
+        op = ord(bytecode[offset])
+        size = 1
+        arg = None
+        description = ""
+        if op >= HAVE_ARGUMENT:
+            arg = ord(bytecode[offset + 1]) + ord(bytecode[offset + 2]) * 256 + extended
+            size = 3
+            extended = arg * 65536 if op == EXTENDED_ARG else 0
+            if op in hasconst:
+                description = repr(code.co_consts[arg])
+            elif op in hasname:
+                description = code.co_names[arg]
+            elif op in haslocal:
+                description = code.co_varnames[arg]
+            elif op in hascompare:
+                description = cmp_op[arg]
+            elif op in hasjrel:
+                description = "to " + str(offset + size + arg)
+            elif op in hasfree:
+                description = (code.co_cellvars + code.co_freevars)[arg]
+        decoded.append((offset, size, opname[op], arg, description))
+        offset += size
+    return decoded
+
+
+CODE_ADDRESS_BITS = 32
+"""
+memory reference of instruction is number of its code object shifted by this plus offset of instruction
+"""
+
+DISASSEMBLY_ARGUMENT_LIMIT = 60
+"""
+maximum length of argument description in disassembled instruction
+"""
+
+
+class Disassembly(object):
+    """
+    Cache of disassembled code objects
+
+    Code objects are numbered when their instructions are first referenced, so each
+    instruction has memory reference (hex string) that resolves back to its code and offset.
+    Code is disassembled once, when client first asks for its instructions. Code objects
+    are referenced weakly, references to code that was freed no longer resolve.
+    """
+
+    def __init__(self):
+        # number -> weak reference to code object, code object -> number
+        self.codes = [None]
+        self.numbers = weakref.WeakKeyDictionary()
+        # code object -> list of (offset, size, instruction name, argument or None, argument description)
+        self.instructions = weakref.WeakKeyDictionary()
+        # code object -> (sorted offsets starting lines, their lines)
+        self.line_starts = weakref.WeakKeyDictionary()
+        # code numbering lock, frames are referenced by paused threads too
+        self.lock = threading.Lock()
+
+    def reference(self, code, offset):
+        # frame which did not start yet has negative offset
+        offset = max(offset, 0)
+        number = self.numbers.get(code)
+        if number is None:
+            with self.lock:
+                number = self.numbers.get(code)
+                if number is None:
+                    number = len(self.codes)
+                    self.codes.append(weakref.ref(code))
+                    self.numbers[code] = number
+        return "0x%x" % ((number << CODE_ADDRESS_BITS) + offset)
+
+    def resolve(self, reference, offset=0):
+        """
+        returns code object and offset in it of memory reference moved by offset bytes
+        """
+
+        try:
+            address = int(reference, 16) + offset
+        except (TypeError, ValueError):
+            raise ValueError("Invalid memory reference %s" % str(reference))
+        number, code_offset = address >> CODE_ADDRESS_BITS, address & ((1 << CODE_ADDRESS_BITS) - 1)
+        code = self.codes[number]() if 0 < number < len(self.codes) else None
+        if code is None or code_offset >= len(code.co_code):
+            raise ValueError("No instruction at %s" % str(reference))
+        return code, code_offset
+
+    def get(self, code):
+        instructions = self.instructions.get(code)
+        if instructions is None:
+            instructions = self.instructions[code] = _decode_instructions(code)
+        return instructions
+
+    def line_of(self, code, offset):
+        starts = self.line_starts.get(code)
+        if starts is None:
+            pairs = [(start, line) for start, line in findlinestarts(code) if line is not None]
+            starts = self.line_starts[code] = ([start for start, _ in pairs], [line for _, line in pairs])
+        index = bisect.bisect_right(starts[0], offset) - 1
+        return starts[1][index] if index >= 0 else code.co_firstlineno
+
+    def disassemble(self, memory_reference, offset, instruction_offset, instruction_count):
+        """
+        returns instruction_count disassembled instructions from instruction_offset-th instruction from
+        one at memory_reference moved by offset bytes
+
+        slots outside of the code are filled with invalid instructions, as protocol wants exactly
+        instruction_count instructions
+        """
+
+        code, code_offset = self.resolve(memory_reference, offset)
+        instructions = self.get(code)
+        base = self.numbers[code] << CODE_ADDRESS_BITS
+
+        first = bisect.bisect_right([instruction[0] for instruction in instructions], code_offset) - 1 + instruction_offset
+        disassembled = []
+        for index in range(first, first + instruction_count):
+            if index < 0 or index >= len(instructions):
+                # addresses of padding stay in order around the code
+                address = base + index if index < 0 else base + len(code.co_code) + index - len(instructions)
+                disassembled.append({"address": "0x%x" % address, "instruction": "", "presentationHint": "invalid"})
+                continue
+
+            instruction_start, size, name, arg, description = instructions[index]
+            text = name
+            if arg is not None:
+                text += " " + str(arg)
+                if description:
+                    if len(description) > DISASSEMBLY_ARGUMENT_LIMIT:
+                        description = description[:DISASSEMBLY_ARGUMENT_LIMIT] + "..."
+                    text += " (" + description + ")"
+
+            instruction = {"address": "0x%x" % (base + instruction_start),
+                           "instructionBytes": " ".join("%02x" % (ord(b) if isinstance(b, str) else b)
+                                                        for b in code.co_code[instruction_start:instruction_start + size]),
+                           "instruction": text, "line": self.line_of(code, instruction_start)}
+            if index == 0 or index == first:
+                instruction["symbol"] = code.co_name
+                instruction["location"] = {"path": code.co_filename}
+            disassembled.append(instruction)
+
+        return disassembled
+
+
+def renpy_pycode_class():
+    """
+    returns class renpy stores compiled python blocks in, or None outside of renpy
+    """
+
+    try:
+        import renpy.ast
+        return renpy.ast.PyCode
+    except (ImportError, AttributeError):
+        return None
+
+
+RENPY_SCRIPT_EXTENSIONS = (".rpy", ".rpym")
+"""
+extensions of renpy script files, expressions of their statements are compiled when first run
+"""
+
+
+def renpy_compiled_codes(filename):
+    """
+    returns code objects renpy compiled for expressions of script filename (conditions, screens...), empty list outside of renpy
+
+    renpy compiles expressions on demand and keeps them in its compile caches, by key holding filename
+    and line, compiled code or its marshalled bytes
+    """
+
+    try:
+        import renpy.python
+    except ImportError:
+        return []
+
+    codes = []
+    for cache_name in ("py_compile_cache", "compile_cache"):
+        cache = getattr(renpy.python, cache_name, None)
+        if not isinstance(cache, dict):
+            continue
+        for key, value in list(cache.items()):
+            if not isinstance(key, tuple) or filename not in key:
+                continue
+            if isinstance(value, bytes):
+                try:
+                    value = marshal.loads(value)
+                except Exception:
+                    continue
+            if isinstance(value, types.CodeType) and value.co_filename == filename:
+                codes.append(value)
+    return codes
+
+
+def _modification_time(filename):
+    """
+    returns modification time of file, None if it can't be found
+    """
+
+    try:
+        return os.path.getmtime(filename)
+    except (OSError, IOError):
+        return None
+
+
+class ExecutableLines(object):
+    """
+    Lazy index of executable lines of source files
+
+    Lines of a file are collected from line tables of its loaded code objects and all code
+    objects nested in them when the file first gets breakpoints. Code objects are found
+    through live functions, renpy's compiled python blocks and expressions and, for python
+    modules, by compiling the module source. Files without any loaded code are remembered
+    only until next import or reload, either may load their code. Modification time of each
+    cached file is kept, so after reload only files that changed are collected again.
+
+    Lines of renpy scripts are never complete, expressions of their statements are compiled
+    only when they first run.
+    """
+
+    def __init__(self):
+        # filename -> (modification time, sorted list of executable lines)
+        self.files = {}
+        # filename -> number of loaded modules when no code of the file was found
+        self.missing = {}
+
+    def get(self, filename):
+        cached = self.files.get(filename)
+        if cached is not None:
+            return cached[1]
+        if self.missing.get(filename) == len(sys.modules):
+            # nothing was imported since, searching all objects again would find nothing
+            return []
+        lines = self.build(filename)
+        if lines:
+            self.files[filename] = (_modification_time(filename), lines)
+            self.missing.pop(filename, None)
+        else:
+            self.missing[filename] = len(sys.modules)
+        return lines
+
+    def is_cached(self, filename):
+        return filename in self.files
+
+    @staticmethod
+    def is_complete(filename):
+        """
+        returns False if filename may have executable lines whose code is not compiled yet
+        """
+
+        return not filename.endswith(RENPY_SCRIPT_EXTENSIONS)
+
+    def drop_changed(self):
+        """
+        drops files modified since their lines were collected, returning their names
+        """
+
+        changed = [filename for filename, (mtime, _) in self.files.items()
+                   if mtime is None or _modification_time(filename) != mtime]
+        for filename in changed:
+            del self.files[filename]
+        # reload may have loaded code of files which had none
+        self.missing.clear()
+        return changed
+
+    def build(self, filename):
+        lines = set()
+        stack = self.find_codes(filename)
+        seen = set()
+        while stack:
+            code = stack.pop()
+            if id(code) in seen:
+                continue
+            seen.add(id(code))
+            # python 3.11+ starts code with instruction on line 0 (or None), no source line is there
+            lines.update(line for _, line in findlinestarts(code) if line)
+            stack.extend(const for const in code.co_consts if isinstance(const, types.CodeType))
+        return sorted(lines)
+
+    def find_codes(self, filename):
+        """
+        returns top level code objects of filename that can be found
+        """
+
+        codes = []
+        pycode = renpy_pycode_class()
+        for obj in gc.get_objects():
+            if isinstance(obj, types.FunctionType):
+                code = obj.__code__
+            elif pycode is not None and isinstance(obj, pycode):
+                code = getattr(obj, "bytecode", None)
+            else:
+                continue
+            if isinstance(code, types.CodeType) and code.co_filename == filename:
+                codes.append(code)
+
+        if filename.endswith(RENPY_SCRIPT_EXTENSIONS):
+            codes.extend(renpy_compiled_codes(filename))
+        elif filename.endswith(".py") and os.path.isfile(filename):
+            try:
+                # compile handles any newlines and encoding declaration of bytes
+                with open(filename, "rb") as source:
+                    codes.append(compile(source.read(), filename, "exec"))
+            except Exception:
+                # source that does not compile has only code found above
+                pass
+
+        return codes
+
+
+CLASS_TYPES = (type, types.ClassType) if hasattr(types, "ClassType") else (type,)
+"""
+types of classes, old style classes included
+"""
+
+
+def _function_codes(value):
+    """
+    returns code objects of function, method, static or class method value, empty list for anything else
+    """
+
+    value = getattr(value, "__func__", value)
+    code = getattr(value, "__code__", None)
+    return [code] if isinstance(code, types.CodeType) else []
+
+
+class FunctionIndex(object):
+    """
+    Index of function names to code objects
+
+    Qualified names (module.function, module.Class.method) are looked up through their
+    module, so they are always current. Bare names are looked up in index of functions and
+    methods of all loaded modules, built when first needed and updated with modules imported
+    since then and modules which were replaced or gained names (ie. renpy's stores).
+    """
+
+    def __init__(self):
+        # bare name -> list of code objects
+        self.names = {}
+        # module name -> (id of module, size of its dict, code objects indexed from it) of indexed modules
+        self.modules = {}
+
+    def resolve(self, name):
+        """
+        returns code objects of functions name refers to
+        """
+
+        parts = name.split(".")
+        for split in range(len(parts) - 1, 0, -1):
+            module = sys.modules.get(".".join(parts[:split]))
+            if module is None:
+                continue
+            value = module
+            for attribute in parts[split:]:
+                value = getattr(value, attribute, None)
+            codes = _function_codes(value)
+            if codes:
+                return codes
+
+        if len(parts) == 1:
+            self.update()
+            return list(self.names.get(name, []))
+        return []
+
+    def update(self):
+        """
+        indexes functions of modules imported, replaced or changed in size since last update
+        """
+
+        for module_name, module in list(sys.modules.items()):
+            if module is None:
+                continue
+            namespace = getattr(module, "__dict__", {})
+            state = id(module), len(namespace)
+            indexed = self.modules.get(module_name)
+            if indexed is not None:
+                if indexed[:2] == state:
+                    continue
+                for code in indexed[2]:
+                    codes = self.names.get(code.co_name, [])
+                    if code in codes:
+                        codes.remove(code)
+                    if not codes:
+                        self.names.pop(code.co_name, None)
+
+            module_codes = []
+            for value in list(namespace.values()):
+                try:
+                    if getattr(value, "__module__", None) != module_name:
+                        continue
+                    members = list(vars(value).values()) if isinstance(value, CLASS_TYPES) else [value]
+                except Exception:
+                    # proxies and other objects failing on attribute access
+                    continue
+                for member in members:
+                    for code in _function_codes(member):
+                        codes = self.names.setdefault(code.co_name, [])
+                        if code not in codes:
+                            codes.append(code)
+                            module_codes.append(code)
+            self.modules[module_name] = state + (module_codes,)
+
+    def label_codes(self):
+        """
+        returns code of renpy's label execution, empty list outside of renpy
+        """
+
+        try:
+            import renpy.ast
+            return _function_codes(renpy.ast.Label.execute)
+        except (ImportError, AttributeError):
+            return []
+
+    def label_node(self, label):
+        """
+        returns script node of label, None if script is not loaded or has no such label
+        """
+
+        try:
+            import renpy.game
+            return renpy.game.script.namemap.get(label)
+        except (ImportError, AttributeError):
+            return None
+
+
+LOG_MESSAGE_EXPRESSION = re.compile(r"\{([^{}]+)\}")
+"""
+expression in logpoint message
+"""
+
+
+class DataBreakpoint(object):
+    """
+    Data breakpoint information, watching writes of single store variable
+
+    data_id is store name and variable name, ie. store.x or store.audio.x
+    """
+
+    def __init__(self, data_id, access_type="write", eval_condition=None, counter=None):
+        self.data_id = data_id
+        self.store_name, _, self.name = data_id.rpartition(".")
+        self.access_type = access_type
+        self.eval_condition = eval_condition
+        self.counter = counter
+        self.times_hit = 0
+        # reason why breakpoint can't be set, None if it is set
+        self.error = None
+
+    def __str__(self):
+        return "<data breakpoint %s (%s, %s, %s)>" % (self.data_id, str(self.eval_condition), str(self.counter), str(self.times_hit))
+
+    def serialize(self):
+        data = {}
+
+        data["verified"] = self.error is None
+        if self.error is not None:
+            data["message"] = self.error
+
+        return data
+
+    def applies(self, frame, old_value, value):
+        """
+        Checks whether this breakpoint applies to write of value over old_value in frame
+        """
+
+        try:
+            if old_value is value or old_value == value:
+                # no change
+                return False
+        except BaseException:
+            # uncomparable values are changed
+            pass
+
+        if self.eval_condition is not None:
+            try:
+                if not eval(self.eval_condition, frame.f_globals, frame.f_locals):
+                    return False
+            except BaseException:
+                # eval failure, ignore
+                return False
+
+        self.times_hit += 1
+        return self.counter is None or self.counter < self.times_hit
+
+
+_missing = object()
+
+
+def _watching_store_class(store_dict, store_name, watches):
+    """
+    creates subclass of store_dict's class which reports writes of names in watches
+
+    instance's class is switched to it while store has data breakpoints, so only writes
+    made through store dict (STORE_NAME of renpy python blocks, del) are seen and only
+    writes of watched names pay for the check
+    """
+
+    base = type(store_dict)
+    base_setitem = base.__setitem__
+    base_delitem = base.__delitem__
+
+    class WatchingStoreDict(base):
+
+        def __setitem__(self, key, value):
+            if key in watches:
+                old_value = dict.get(self, key, _missing)
+                base_setitem(self, key, value)
+                debugger.store_written(store_name, key, old_value, value, sys._getframe(1))
+            else:
+                base_setitem(self, key, value)
+
+        def __delitem__(self, key):
+            if key in watches:
+                old_value = dict.get(self, key, _missing)
+                base_delitem(self, key)
+                debugger.store_written(store_name, key, old_value, _missing, sys._getframe(1))
+            else:
+                base_delitem(self, key)
+
+    WatchingStoreDict.__name__ = base.__name__
+    WatchingStoreDict.__module__ = base.__module__
+    return WatchingStoreDict
+
+
+def get_store_dicts():
+    """
+    returns renpy's store dicts, store name -> dict, or empty dict outside of renpy
+    """
+
+    try:
+        import renpy.python
+        return renpy.python.store_dicts
+    except (ImportError, AttributeError):
+        return {}
+
+
+class StepHandler(object):
+    """
+    Stepping handler, used as is when no stepping is active
+
+    Stepping handler is consulted once for every trace event of the debugged thread
+    and decides whether frame should be line traced and whether execution should pause.
+    """
+
+    reason = None
+    """
+    pause reason reported to client when this handler pauses execution
+    """
+
+    def trace_call(self, frame):
+        """
+        called on call event, returns True if frame should be line traced
+        """
+        return True
+
+    def trace_local(self, frame, event):
+        """
+        called on line, return and exception events of line traced frames
+
+        returns True if execution should pause on this event
+        """
+        return False
+
+
+NO_STEP = StepHandler()
+"""
+Shared handler for no stepping
+"""
+
+
+class FrameStepHandler(StepHandler):
+    """
+    Stepping handler which tracks frame in which stepping started
+
+    Frame is tracked by identity, so recursive calls of the same code are never
+    confused with the stepped frame. When tracked frame returns, its caller
+    becomes tracked frame.
+    """
+
+    def __init__(self, thread, frame):
+        self.thread = thread
+        self.frame = frame
+
+    def leave_frame(self, frame):
+        """
+        moves tracking to caller of frame
+
+        caller gets line traced again if it is not, since it might have been
+        dropped from line tracing when it was called
+        """
+
+        caller = frame.f_back
+        if caller is None:
+            # returned from thread itself, nothing to step to
+            self.thread.stepping = NO_STEP
+            return
+        self.thread.line_trace(caller)
+        self.frame = caller
+
+
+class StepOver(FrameStepHandler):
+    """
+    Stepping handler pausing on next line in tracked frame
+
+    Frames called from tracked frame are not line traced (unless they have
+    breakpoints), so stepping over heavy calls costs one check per call.
+
+    levels is number of frames that must return before line pauses the execution,
+    0 for step over, 1 for step out.
+    """
+
+    levels = 0
+
+    def trace_call(self, frame):
+        # only tracked frame can be called again (generator resume), anything else is deeper
+        return frame is self.frame
+
+    def trace_local(self, frame, event):
+        if frame is self.frame:
+            if event == "line":
+                return self.levels == 0
+            if event == "return":
+                self.leave_frame(frame)
+                if self.levels > 0:
+                    self.levels -= 1
+        return False
+
+
+class StepNext(StepOver):
+    """
+    Step over, pauses on next line in same frame or in caller if frame returns
+    """
+
+    reason = "step"
+
+
+class StepOut(StepOver):
+    """
+    Step out, pauses on next line in caller of current frame
+    """
+
+    reason = "stepOut"
+    levels = 1
+
+
+class StepInto(FrameStepHandler):
+    """
+    Step into, pauses on very next line executed, wherever it is
+    """
+
+    reason = "step"
+
+    def trace_call(self, frame):
+        if frame is not self.frame:
+            self.reason = "stepIn"
+        return True
+
+    def trace_local(self, frame, event):
+        if event == "line":
+            return True
+        if event == "return" and frame is self.frame:
+            self.leave_frame(frame)
+        return False
+
+
+def _enable_opcode_events():
+    """
+    makes python 3.12 deliver opcode events to frames with f_trace_opcodes set
+
+    3.12 delivers them only if f_trace_opcodes of some frame was set when sys.settrace was called,
+    so it is set on this frame and trace function of this thread is set again
+    """
+
+    if sys.version_info[:2] != (3, 12):
+        return
+    frame = sys._getframe()
+    frame.f_trace_opcodes = True
+    frame.f_trace_opcodes = False
+    sys.settrace(sys.gettrace())
+
+
+class StepInstruction(FrameStepHandler):
+    """
+    Instruction step, pauses on next instruction in tracked frame or in caller if frame returns
+
+    Only tracked frame traces instructions, frames it calls are not line traced (unless they have
+    breakpoints), as in step over.
+    """
+
+    reason = "step"
+
+    def __init__(self, thread, frame):
+        FrameStepHandler.__init__(self, thread, frame)
+        # instruction at which step started gets opcode event after line event it paused on
+        self.started = frame.f_lasti
+        frame.f_trace_opcodes = True
+        _enable_opcode_events()
+
+    def trace_call(self, frame):
+        return frame is self.frame
+
+    def trace_local(self, frame, event):
+        if frame is self.frame:
+            if event == "opcode":
+                started, self.started = self.started, None
+                return frame.f_lasti != started
+            if event == "return":
+                self.leave_frame(frame)
+                if self.thread.stepping is self:
+                    self.started = None
+                    self.frame.f_trace_opcodes = True
+        return False
+
+
+class StepInstructionInto(StepInstruction):
+    """
+    Instruction step into, pauses on next instruction in tracked frame, first instruction of frame it calls
+    or in caller if frame returns
+    """
+
+    def trace_call(self, frame):
+        return True
+
+    def trace_local(self, frame, event):
+        if frame is not self.frame and event == "line" and frame.f_back is self.frame:
+            self.reason = "stepIn"
+            return True
+        return StepInstruction.trace_local(self, frame, event)
+
+
+FRAMES_PER_THREAD = 1 << 16
+"""
+frame ids are unique over all threads, frame id is thread id * FRAMES_PER_THREAD + frame level
+"""
+
+
+ASYNC_EXCEPTION_CHECKS = 100000
+"""
+loops after which exception sent to thread is surely raised, python checks for it every
+few loops (python 2 every sys.getcheckinterval() instructions)
+"""
+
+
+class EvaluationTimeout(Exception):
+    """
+    Raised in paused thread when evaluation runs out of its time budget
+    """
+
+
+class ThreadWork(object):
+    """
+    Work sent to paused thread, to be run there in its frames
+
+    done(result, exception) is called exactly once: by paused thread when work finishes,
+    or by timer thread when work does not finish in time
+    """
+
+    def __init__(self, function, args, done):
+        self.function = function
+        self.args = args
+        self.done = done
+        # ident of thread while it runs function, None before and after
+        self.ident = None
+        # True once done was called
+        self.finished = False
+        # True if EvaluationTimeout was sent to thread running function
+        self.interrupted = False
+        # guards ident, finished and interrupted between paused thread and timer
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def start(self, thread, timeout):
+        """
+        sends work to paused thread, timing it out after timeout seconds
+        """
+
+        self.timer = threading.Timer(timeout, self.time_out, (timeout,))
+        self.timer.is_debugger_thread = True
+        self.timer.daemon = True
+        thread.work.put(self)
+        self.timer.start()
+
+    def run(self):
+        """
+        runs the work, called by paused thread
+        """
+
+        with self.lock:
+            if self.finished:
+                # timed out before paused thread got to it
+                return
+            self.ident = threading.current_thread().ident
+
+        result = exception = None
+        try:
+            result = self.function(*self.args)
+        except BaseException as e:
+            exception = e
+        with self.lock:
+            self.ident = None
+            interrupted = self.interrupted
+        if interrupted and not isinstance(exception, EvaluationTimeout):
+            # function finished before EvaluationTimeout was raised in it, it is raised here instead of in debugged code
+            _absorb_async_exception(EvaluationTimeout)
+        self.finish(result, exception)
+
+    def finish(self, result, exception):
+        """
+        calls done with result of work, unless it was already called
+        """
+
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+        if self.timer is not None:
+            self.timer.cancel()
+        try:
+            self.done(result, exception)
+        except Exception:
+            log.exception("Failed to respond with result of work")
+
+    def time_out(self, timeout):
+        """
+        calls done with EvaluationTimeout, interrupting function if it still runs, called by timer
+        """
+
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+            # checked under lock, so exception is never sent after function returned
+            if self.ident is not None and _set_async_exception(self.ident, EvaluationTimeout):
+                self.interrupted = True
+        try:
+            self.done(None, EvaluationTimeout("Evaluation timed out after %s seconds" % str(timeout)))
+        except Exception:
+            log.exception("Failed to respond with result of work")
+
+
+def _set_async_exception(ident, exception):
+    """
+    raises exception in thread ident at one of its next instructions
+
+    returns True if exception was set
+    """
+
+    if ctypes is None:
+        return False
+    return ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(ident), ctypes.py_object(exception)) == 1
+
+
+def _absorb_async_exception(exception):
+    """
+    lets exception sent to current thread by _set_async_exception be raised, and ignores it
+
+    exception can't be cancelled instead, setting NULL exception leaves python 3.11 checking
+    for it forever, which hangs every traced call. Gives up after ASYNC_EXCEPTION_CHECKS
+    loops, in case exception was already raised and caught elsewhere.
+    """
+
+    try:
+        for _ in range(ASYNC_EXCEPTION_CHECKS):
+            pass
+    except exception:
+        pass
+
+
+class DebuggedThread(object):
+    """
+    Debugging state of single traced thread
+
+    Each thread has its own trace functions bound to its state, so tracing
+    never has to look up which thread it runs in.
+    """
+
+    def __init__(self, debugger, id, thread):
+        super(DebuggedThread, self).__init__()
+
+        self.debugger = debugger
+        # id of thread reported to client
+        self.id = id
+        # threading.Thread object of this thread
+        self.thread = thread
+
+        # active stepping handler
+        self.stepping = NO_STEP
+        # cont is spinlock of this thread, when False, thread is paused
+        self.cont = True
+        # why was thread paused is stored here and reported to client
+        self.pause_reason = None
+        # break on cont failure reasons
+        #  pause was asked
+        self.break_pause = False
+
+        # current active line frame
+        self.active_frame = None
+        # work sent to this thread while it is paused
+        self.work = Queue()
+
+    def get_name(self):
+        """
+        returns name of thread for client
+        """
+
+        if self.id == 0:
+            return "renpy_main"
+        return self.thread.name
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def step(self, stepping):
+        """
+        resumes thread, stepping with handler class stepping from active frame
+        """
+
+        self.stepping = stepping(self, self.active_frame)
+        self.continue_next()
+
+    def continue_next(self):
+        """
+        resumes thread, clearing its scope info
+        """
+
+        self.debugger.clear_scopes(self.id)
+        self.cont = True
+        # wake up thread waiting for work
+        self.work.put(None)
+
+    def trace_event(self, frame, event, arg):
+        """
+        tracing function for call events
+
+        frame is line traced only when stepping needs it or it can hit breakpoint
+        """
+
+        recorder = self.debugger.recorder
+        if recorder is not None:
+            record = recorder.tracer(self.id)
+            record(frame, event, arg)
+
+        unresolved_names = self.debugger.unresolved_function_names
+        if unresolved_names and frame.f_code.co_name in unresolved_names:
+            # called function may be the one unresolved breakpoint waits for, resolved before it is matched
+            for breakpoint in self.debugger.resolve_function_breakpoints(frame.f_code):
+                handler.send_breakpoint_changed(breakpoint)
+
+        function_breakpoints = self.debugger.function_breakpoints
+        if function_breakpoints and frame.f_code in function_breakpoints:
+            self.function_trace(frame, function_breakpoints[frame.f_code])
+
+        instruction_breakpoints = self.debugger.instruction_breakpoints
+        if instruction_breakpoints and frame.f_code in instruction_breakpoints:
+            # python 3.12 turns instruction events on only for frame which already has trace function
             frame.f_trace = self.trace_line
+            frame.f_trace_opcodes = True
+            return self.trace_line
+        stepping = self.stepping
+        if recorder is not None and stepping is NO_STEP and not self.break_pause:
+            # nothing is stepping, so frames without breakpoints are traced only by recorder,
+            # pause request is noticed by next call
+            traced = frame.f_code.co_filename in self.debugger.breakpoint_sources
+        else:
+            traced = stepping.trace_call(frame) or frame.f_code.co_filename in self.debugger.breakpoint_sources
+        if traced:
+            return self.trace_line
+        if recorder is not None:
+            # frames traced only for recorder are traced by recorder directly
+            return record
+
+    def line_trace(self, frame):
+        """
+        makes frame line traced with trace_line, if it is not traced or traced only for recorder
+        """
+
+        if frame.f_trace != self.trace_line:
+            frame.f_trace = self.trace_line
+
+    def trace_line(self, frame, event, arg):
+        """
+        trace function for line, return, exception and opcode events
+        """
+
+        recorder = self.debugger.recorder
+        if recorder is not None and event != "opcode":
+            # recorder keeps lines, instructions would only flood it
+            recorder.tracer(self.id)(frame, event, arg)
+
+        self.active_frame = frame
+
+        if self.stepping.trace_local(frame, event):
+            self.pause(self.stepping.reason)
+        elif event == "line":
+            self.base_trace(frame, event, arg)
+        elif event == "opcode":
+            self.instruction_trace(frame)
+
+        # check for external requested pause
+        if self.break_pause:
+            self.pause("pause")
+
+        self.wait_for_resume()
+
+    def wait_for_resume(self):
+        """
+        blocks paused thread until it is resumed, running any work sent to it meanwhile
+        """
+
+        while True:
+            try:
+                while not self.cont:
+                    try:
+                        work = self.work.get(timeout=0.1)
+                    except Empty:
+                        continue
+                    if work is not None:
+                        work.run()
+                return
+            except EvaluationTimeout:
+                # interrupted just after work was done
+                pass
+
+    def run_work(self, function, args, done):
+        """
+        runs function with args in this paused thread, calling done(result, exception) with its outcome
+
+        done is called in this thread, or with EvaluationTimeout in timer thread if function does not
+        finish within EVALUATION_TIMEOUT
+        """
+
+        if self.cont:
+            raise ValueError("Thread %s is not paused" % self.get_name())
+
+        ThreadWork(function, args, done).start(self, EVALUATION_TIMEOUT)
+
+    def base_trace(self, frame, event, arg):
+        """
+        checks breakpoints, called on every line event of line traced frames
+        """
+
+        # print("Tracing %s %s %s (%s))" % (event, "<File %s, Line %s>" % (frame.f_code.co_filename, frame.f_lineno), str(arg), str(id(threading.current_thread()))))
+
+        # breakpoints of source are replaced as whole on sync, so they are read without lock
+        line_breakpoints = self.debugger.source_breakpoints.get(frame.f_code.co_filename)
+        if line_breakpoints is None:
+            return
+        breakpoints = line_breakpoints.get(frame.f_lineno)
+        if breakpoints is None:
+            return
+
+        breaking_on = None
+        logging = []
+
+        for breakpoint in breakpoints:
+            if breakpoint.applies(frame):
+                if breakpoint.log_message is not None:
+                    logging.append(breakpoint)
+                elif breaking_on is None:
+                    breaking_on = breakpoint
+        for logpoint in logging:
+            handler.send_output(logpoint.format_log_message(frame) + "\n")
+        if breaking_on is not None:
+            log.debug("Broke at %s:%s in thread %s", frame.f_code.co_filename, frame.f_lineno, self.get_name())
+            self.break_code(breaking_on)  # sets this to blocking
+
+    def function_trace(self, frame, breakpoints):
+        """
+        checks function breakpoints of code called in frame, pausing thread in it if any applies
+        """
+
+        for breakpoint in breakpoints:
+            if breakpoint.applies(frame):
+                self.active_frame = frame
+                self.break_code(breakpoint, "function breakpoint")
+                self.wait_for_resume()
+                return
+
+    def instruction_trace(self, frame):
+        """
+        checks instruction breakpoints, called on opcode events of frames tracing instructions
+        """
+
+        offsets = self.debugger.instruction_breakpoints.get(frame.f_code)
+        if offsets is None:
+            if not isinstance(self.stepping, StepInstruction):
+                # instruction step that turned instruction tracing on is over
+                frame.f_trace_opcodes = False
+            return
+
+        for breakpoint in offsets.get(frame.f_lasti, []):
+            if breakpoint.applies(frame):
+                self.break_code(breakpoint)
+                return
+
+    def pause(self, reason):
+        """
+        pauses thread at active frame, reporting reason to client
+        """
+
+        self.stepping = NO_STEP
+        self.break_pause = False
+        self.pause_reason = reason
+        self.cont = False
+        self.debugger.pause_other_threads(self)
+        handler.pause_debugging(self)
+
+    def break_code(self, breakpoint, reason="breakpoint"):
+        """
+        breaks code at breakpoint
+        """
+
+        self.stepping = NO_STEP
+        self.cont = False
+        self.pause_reason = reason
+        self.debugger.clear_scopes(self.id)
+        self.debugger.pause_other_threads(self)
+        handler.send_breakpoint_event(self, breakpoint)
+
+    def frame_location_info(self):
+        """
+        returns location information about current frame
+
+        should be used by other thread when this thread is cont=False
+        """
+
+        return str(self.active_frame.f_code.co_filename) + ":" + str(self.active_frame.f_lineno)
+
+
+class RenpyPythonDebugger(object):
+    """
+    RenpyPythonDebugger
+
+    Contains debugging state and debugs renpy
+    """
+
+    def __init__(self):
+        super(RenpyPythonDebugger, self).__init__()
+
+        # active breakpoints, source -> line -> list of Breakpoint
+        # dict of source is never modified, sync replaces it
+        self.source_breakpoints = {}
+        # sources of active breakpoints, frames from these are always line traced
+        self.breakpoint_sources = set()
+        # all breakpoints of each source as client set them, including unverified ones
+        self.breakpoints_of_source = {}
+        # breakpoints set modification lock
+        self.bkp_lock = threading.Lock()
+        # breakpoint id generator
+        self.breakpoint_id = 0
+        # executable lines of sources with breakpoints
+        self.executable_lines = ExecutableLines()
+
+        # function breakpoints, code object -> list of FunctionBreakpoint, replaced as whole on sync
+        self.function_breakpoints = {}
+        # all function breakpoints as client set them, including unresolved ones
+        self.function_breakpoint_list = []
+        # names of functions and labels function breakpoints are resolved through
+        self.function_index = FunctionIndex()
+        # names of code objects unresolved function breakpoints may resolve to, calls of such code resolve them
+        self.unresolved_function_names = frozenset()
+        # code objects which already resolved unresolved function breakpoints
+        self.resolving_codes = set()
+
+        # instruction breakpoints, code object -> offset -> list of InstructionBreakpoint
+        # replaced as whole on sync, frames of these codes trace instructions
+        self.instruction_breakpoints = {}
+        # disassembled code, instruction memory references resolve through it
+        self.disassembly = Disassembly()
+
+        # data breakpoints, store name -> variable name -> list of DataBreakpoint
+        self.data_breakpoints = {}
+        # store dicts watched for data breakpoints, store name -> (store dict, its original class)
+        self.watched_stores = {}
+
+        # traced threads, thread id -> DebuggedThread
+        self.threads = {}
+        # thread registry modification lock
+        self.threads_lock = threading.Lock()
+        # thread id generator, main thread is always 0
+        self.thread_id = 0
+        # if True, all threads pause when any thread pauses, otherwise only that thread pauses
+        self.pause_all = True
+
+        # holds paths to variables for each scope opened
+        # scope assign containts tuples (value, parent_accessor, type (None for scope), parent_object)
+        self.scope_assign = {}
+        # frame id of each variable in scope_assign
+        self.scope_frames = {}
+        # current break var id generator (0->more)
+        self.scope_var_id = 0
+        # guards scope info, values are described both by server thread and by paused threads evaluating
+        self.scope_lock = threading.RLock()
+        # results of evaluation while paused, (frame id, expression, context) -> evaluate response body
+        self.evaluated = {}
+        # types whose values are too slow to preview by repr
+        self.slow_preview_types = set()
+        # previews of values shown while paused
+        self.previews = ValuePreview(self.slow_preview_types)
+
+        # flight recorder recording trace events of all threads, None if not recording
+        self.recorder = None
+
+        # last collected heap statistics, None if none were collected
+        self.heap_statistics = None
+        # thread collecting heap statistics, None if none is running
+        self.heap_collector = None
+
+    def reset(self):
+        """
+        resets state of the debugging
+
+        called when client disconnects
+        """
+        self.set_data_breakpoints([])
+        with self.bkp_lock:
+            self.function_breakpoints = {}
+            self.function_breakpoint_list = []
+            self.unresolved_function_names = frozenset()
+            self.resolving_codes = set()
+            self.instruction_breakpoints = {}
+            self.source_breakpoints = {}
+            self.breakpoint_sources = set()
+            self.breakpoints_of_source = {}
+            for thread in self.get_threads():
+                thread.stepping = NO_STEP
+                thread.continue_next()
+
+    def clear_scopes(self, thread_id=None):
+        """
+        clears scope info of thread thread_id (of all threads if None), called when its execution resumes
+
+        variables references and evaluation results of other threads stay valid, they may still be paused
+        """
+
+        with self.scope_lock:
+            if thread_id is None:
+                self.scope_assign = {}
+                self.scope_frames = {}
+                self.scope_var_id = 0
+                self.evaluated = {}
+            else:
+                for var_ref, frame_id in list(self.scope_frames.items()):
+                    if frame_id is None or frame_id // FRAMES_PER_THREAD == thread_id:
+                        del self.scope_assign[var_ref]
+                        del self.scope_frames[var_ref]
+                self.evaluated = dict((key, body) for key, body in self.evaluated.items()
+                                      if key[0] // FRAMES_PER_THREAD != thread_id)
+            # previewed values may be changed by resumed thread
+            self.previews = ValuePreview(self.slow_preview_types)
+
+    def attach(self):
+        """
+        attaches itself into renpy and begins tracing
+
+        current thread is traced immediately, threads started later are traced once they run
+        """
+
+        main_thread = self.register_thread()
+        sys.settrace(main_thread.trace_event)
+        threading.settrace(self.trace_thread)
+
+    def trace_thread(self, frame, event, arg):
+        """
+        tracing function for first event of newly started thread
+
+        registers the thread and installs its own trace function
+        """
+
+        if getattr(threading.current_thread(), "is_debugger_thread", False):
+            # debugger's own threads are never traced
+            sys.settrace(None)
+            return None
+
+        thread = self.register_thread()
+        sys.settrace(thread.trace_event)
+        return thread.trace_event(frame, event, arg)
+
+    def register_thread(self):
+        """
+        registers current thread, returning its DebuggedThread
+        """
+
+        with self.threads_lock:
+            thread = DebuggedThread(self, self.thread_id, threading.current_thread())
+            self.threads[thread.id] = thread
+            self.thread_id += 1
+
+        if handler is not None and handler.is_client_attached():
+            handler.send_thread_event("started", thread)
+        return thread
+
+    def get_threads(self):
+        """
+        returns list of live traced threads, ordered by id
+
+        dead threads are dropped from registry and reported as exited
+        """
+
+        with self.threads_lock:
+            exited = [thread for thread in self.threads.values() if not thread.is_alive()]
+            for thread in exited:
+                del self.threads[thread.id]
+            threads = sorted(self.threads.values(), key=lambda t: t.id)
+
+        if handler is not None and handler.is_client_attached():
+            for thread in exited:
+                handler.send_thread_event("exited", thread)
+        return threads
+
+    def current_thread(self):
+        """
+        returns DebuggedThread of current thread or None if it is not traced
+        """
+
+        current = threading.current_thread()
+        for thread in self.get_threads():
+            if thread.thread is current:
+                return thread
+        return None
+
+    def get_thread(self, thread_id):
+        """
+        returns DebuggedThread with id thread_id or None
+        """
+
+        return self.threads.get(thread_id, None)
+
+    def pause_other_threads(self, paused_thread):
+        """
+        pauses all threads other than paused_thread, if debugger pauses all threads
+
+        other threads pause on their next traced event, without reporting to client
+        """
+
+        if not self.pause_all:
+            return
+
+        for thread in self.get_threads():
+            if thread is not paused_thread:
+                thread.cont = False
+
+    def resume(self, thread_id):
+        """
+        resumes thread with thread_id, or all threads if debugger pauses all threads
+
+        returns True if all threads were resumed
+        """
+
+        if self.pause_all:
+            for thread in self.get_threads():
+                thread.continue_next()
+            return True
+
+        thread = self.get_thread(thread_id)
+        if thread is not None:
+            thread.continue_next()
+        return False
+
+    def step(self, thread_id, stepping):
+        """
+        steps thread with thread_id with handler class stepping, resuming other threads if they were paused with it
+        """
+
+        thread = self.get_thread(thread_id)
+        if thread is None:
+            return
+        thread.stepping = stepping(thread, thread.active_frame)
+        self.resume(thread_id)
+
+    def request_pause(self, thread_id):
+        """
+        requests thread with thread_id to pause on its next traced event
+        """
+
+        thread = self.get_thread(thread_id)
+        if thread is not None:
+            thread.break_pause = True
+
+    def set_source_breakpoints(self, source, breakpoints):
+        """
+        replaces breakpoints of source with breakpoints, returning active breakpoint for each of them
+
+        breakpoints are first moved to executable lines, breakpoints which can never hit are not
+        activated and are reported unverified. Breakpoints of file without loaded code stay where
+        they are until the code is loaded.
+
+        breakpoint with same key as existing one is the existing one, keeping its id and hit count,
+        only new breakpoints get new ids. Only source's own breakpoints are touched, so sync costs
+        one lookup per breakpoint of the source no matter how many breakpoints other sources have.
+        """
+
+        source = source if isinstance(source, str) else source.encode("utf-8")
+
+        executable = self.executable_lines.get(source)
+        complete = self.executable_lines.is_complete(source)
+        for breakpoint in breakpoints:
+            breakpoint.snap(executable, complete)
+
+        with self.bkp_lock:
+            existing = dict((breakpoint.key(), breakpoint) for breakpoint in self.breakpoints_of_source.get(source, []))
+
+            active = []
+            for breakpoint in breakpoints:
+                kept = existing.pop(breakpoint.key(), None)
+                if kept is None:
+                    self.breakpoint_id += 1
+                    breakpoint.id = self.breakpoint_id
+                    kept = breakpoint
+                else:
+                    kept.error = breakpoint.error
+                active.append(kept)
+
+            self.activate_breakpoints(source, active, executable)
+
+        return active
+
+    def activate_breakpoints(self, source, breakpoints, executable):
+        """
+        makes breakpoints all breakpoints of source, activating those which can hit
+
+        must be called with bkp_lock held
+        """
+
+        lines = {}
+        for breakpoint in breakpoints:
+            if breakpoint.error is None or not executable:
+                lines.setdefault(breakpoint.line, []).append(breakpoint)
+
+        if breakpoints:
+            self.breakpoints_of_source[source] = breakpoints
+        else:
+            self.breakpoints_of_source.pop(source, None)
+
+        if lines:
+            self.source_breakpoints[source] = lines
+            self.breakpoint_sources.add(source)
+        else:
+            self.source_breakpoints.pop(source, None)
+            self.breakpoint_sources.discard(source)
+
+    def reload(self):
+        """
+        called when renpy reloaded its scripts, code objects of reloaded files are new
+
+        references to old frames and code are dropped, instruction breakpoints are invalidated,
+        breakpoints of changed files and files whose code was not loaded yet are moved to
+        executable lines of the new code, returning breakpoints which moved or changed
+        verification, and data breakpoints watch the stores renpy uses now
+        """
+
+        for thread in self.get_threads():
+            thread.stepping = NO_STEP
+            if thread.cont:
+                thread.active_frame = None
+        self.clear_scopes()
+        if self.recorder is not None:
+            self.recorder.forget_codes()
+
+        changed_files = set(self.executable_lines.drop_changed())
+        changed = []
+
+        # reload executes every script again into new code objects, instructions of the old ones never run again
+        # and memory references of disassembly are renumbered
+        with self.bkp_lock:
+            for offsets in self.instruction_breakpoints.values():
+                for bkps in offsets.values():
+                    for breakpoint in bkps:
+                        breakpoint.error = "Code was reloaded"
+                        changed.append(breakpoint)
+            self.instruction_breakpoints = {}
+        self.disassembly = Disassembly()
+        # reloaded modules and stores hold new functions
+        self.function_index = FunctionIndex()
+        changed.extend(self.resolve_function_breakpoints())
+
+        for source in list(self.breakpoints_of_source.keys()):
+            if source not in changed_files and self.executable_lines.is_cached(source):
+                continue
+
+            executable = self.executable_lines.get(source)
+            complete = self.executable_lines.is_complete(source)
+            with self.bkp_lock:
+                breakpoints = self.breakpoints_of_source.get(source, [])
+                for breakpoint in breakpoints:
+                    previous = breakpoint.line, breakpoint.error
+                    breakpoint.snap(executable, complete)
+                    if (breakpoint.line, breakpoint.error) != previous:
+                        changed.append(breakpoint)
+                self.activate_breakpoints(source, breakpoints, executable)
+
+        self.set_data_breakpoints([breakpoint for watches in self.data_breakpoints.values()
+                                   for bkps in watches.values() for breakpoint in bkps])
+
+        thread = self.current_thread()
+        if thread is None:
+            thread = self.register_thread()
+        sys.settrace(thread.trace_event)
+        return changed
+
+    def set_function_breakpoints(self, breakpoints):
+        """
+        replaces function breakpoints with breakpoints
+
+        breakpoints of functions which are not loaded yet are resolved again when function of that name is called
+        """
+
+        for breakpoint in breakpoints:
+            breakpoint.resolve(self.function_index)
+
+        with self.bkp_lock:
+            self.resolving_codes = set()
+            for breakpoint in breakpoints:
+                self.breakpoint_id += 1
+                breakpoint.id = self.breakpoint_id
+            self.function_breakpoint_list = breakpoints
+            self.activate_function_breakpoints()
+
+    def activate_function_breakpoints(self):
+        """
+        rebuilds function breakpoints of code from resolved breakpoints, must be called with bkp_lock held
+        """
+
+        function_breakpoints = {}
+        for breakpoint in self.function_breakpoint_list:
+            for code in breakpoint.codes:
+                function_breakpoints.setdefault(code, []).append(breakpoint)
+        self.function_breakpoints = function_breakpoints
+        self.unresolved_function_names = frozenset(breakpoint.code_name()
+                                                   for breakpoint in self.function_breakpoint_list
+                                                   if breakpoint.error is not None)
+
+    def resolve_function_breakpoints(self, code=None):
+        """
+        resolves function breakpoints again, returning those whose resolution changed
+
+        with code being called, only breakpoints not yet resolved are resolved, once for each code
+        """
+
+        unresolved_only = code is not None
+        if unresolved_only:
+            if code in self.resolving_codes:
+                return []
+            self.resolving_codes.add(code)
+        else:
+            self.resolving_codes = set()
+
+        changed = []
+        for breakpoint in list(self.function_breakpoint_list):
+            if unresolved_only and breakpoint.error is None:
+                continue
+            previous = breakpoint.codes, breakpoint.error
+            breakpoint.resolve(self.function_index)
+            if (breakpoint.codes, breakpoint.error) != previous:
+                changed.append(breakpoint)
+
+        with self.bkp_lock:
+            self.activate_function_breakpoints()
+        return changed
+
+    def set_instruction_breakpoints(self, breakpoints):
+        """
+        replaces instruction breakpoints with breakpoints
+
+        frames already running code of breakpoints start tracing instructions, frames called later
+        start when they are called
+        """
+
+        for breakpoint in breakpoints:
+            breakpoint.resolve(self.disassembly)
+
+        with self.bkp_lock:
+            instruction_breakpoints = {}
+            for breakpoint in breakpoints:
+                self.breakpoint_id += 1
+                breakpoint.id = self.breakpoint_id
+                if breakpoint.error is None:
+                    instruction_breakpoints.setdefault(breakpoint.code, {}).setdefault(breakpoint.instruction_offset, []).append(breakpoint)
+            self.instruction_breakpoints = instruction_breakpoints
+
+        if not instruction_breakpoints:
+            return
+        _enable_opcode_events()
+
+        threads = dict((thread.thread.ident, thread) for thread in self.get_threads())
+        for ident, frame in sys._current_frames().items():
+            thread = threads.get(ident)
+            while thread is not None and frame is not None:
+                if frame.f_code in instruction_breakpoints:
+                    thread.line_trace(frame)
+                    frame.f_trace_opcodes = True
+                frame = frame.f_back
+
+    def disassemble(self, memoryReference, instructionCount, offset=0, instructionOffset=0, resolveSymbols=True):
+        """
+        disassembles instructions around memory reference, returning custom disassemble response body
+        """
+
+        return {"instructions": self.disassembly.disassemble(memoryReference, offset, instructionOffset, instructionCount)}
+
+    def data_breakpoint_info(self, name, variablesReference=None):
+        """
+        returns data breakpoint info response body for variable name
+
+        only variables of renpy stores can be watched, either listed in scope of store
+        or named directly (x for store.x, or full name store.audio.x)
+        """
+
+        store_dicts = get_store_dicts()
+
+        store_name = None
+        if variablesReference is not None and variablesReference in self.scope_assign:
+            container = self.scope_assign[variablesReference][0]
+            for sname, store_dict in store_dicts.items():
+                if store_dict is container:
+                    store_name = sname
+                    break
+        elif "." in name and name.rpartition(".")[0] in store_dicts:
+            store_name, _, name = name.rpartition(".")
+        elif "store" in store_dicts:
+            store_name = "store"
+
+        if store_name is None:
+            return {"data_id": None, "description": "Only renpy store variables can be watched"}
+
+        data_id = store_name + "." + name
+        return {"data_id": data_id, "description": data_id, "access_types": ["write"], "can_persist": True}
+
+    def set_data_breakpoints(self, breakpoints):
+        """
+        replaces data breakpoints with breakpoints, watching their stores
+        """
+
+        store_dicts = get_store_dicts()
+
+        data_breakpoints = {}
+        for breakpoint in breakpoints:
+            if breakpoint.access_type != "write":
+                # reads of store variables are not observable, readWrite would silently miss them
+                breakpoint.error = "Only writes can be watched, %s access can't" % breakpoint.access_type
+            elif breakpoint.store_name not in store_dicts:
+                breakpoint.error = "No store %s" % breakpoint.store_name
+            else:
+                data_breakpoints.setdefault(breakpoint.store_name, {}).setdefault(breakpoint.name, []).append(breakpoint)
+
+        with self.bkp_lock:
+            # restore original classes of all watched stores, then watch stores which have breakpoints
+            for store_dict, original_class in self.watched_stores.values():
+                store_dict.__class__ = original_class
+            self.watched_stores = {}
+
+            for store_name, watches in data_breakpoints.items():
+                store_dict = store_dicts[store_name]
+                original_class = type(store_dict)
+                try:
+                    store_dict.__class__ = _watching_store_class(store_dict, store_name, watches)
+                except TypeError:
+                    for bkps in watches.values():
+                        for breakpoint in bkps:
+                            breakpoint.error = "Store %s can't be watched" % store_name
+                    continue
+                self.watched_stores[store_name] = (store_dict, original_class)
+
+            self.data_breakpoints = data_breakpoints
+
+    def store_written(self, store_name, name, old_value, value, frame):
+        """
+        called when watched variable of store is written by frame, pausing current thread if any of its data breakpoints applies
+
+        writes made while thread is paused are never reported
+        """
+
+        thread = self.current_thread()
+        if thread is None or not thread.cont:
+            # thread is paused already, the write was made by debugger work (setVariable, evaluation) it runs
+            return
+
+        breaking_on = None
+        for breakpoint in self.data_breakpoints.get(store_name, {}).get(name, []):
+            if breakpoint.applies(frame, old_value, value):
+                breaking_on = breakpoint
+                break
+        if breaking_on is None:
+            return
+
+        # debugger's own code must not be traced while thread waits, tracing of the write is restored after
+        previous_trace = sys.gettrace()
+        sys.settrace(None)
+        try:
+            thread.line_trace(frame)
+            thread.active_frame = frame
+            thread.stepping = NO_STEP
+            thread.cont = False
+            thread.pause_reason = "data breakpoint"
+            self.clear_scopes(thread.id)
+            self.pause_other_threads(thread)
+            handler.send_breakpoint_event(thread, breaking_on)
+            thread.wait_for_resume()
+        finally:
+            sys.settrace(previous_trace)
+
+    def get_frame(self, frame_id):
+        """
+        returns frame with id frame_id from stack of its thread
+        """
+
+        thread = self.get_thread(frame_id // FRAMES_PER_THREAD)
+        if thread is None:
+            return None
+
+        frame_ord = frame_id % FRAMES_PER_THREAD
+        cframe = thread.active_frame
+        c = 0
+        while cframe is not None:
+            if c == frame_ord:
+                return cframe
+            cframe = cframe.f_back
+            c += 1
+        return None
+
+    def get_stack_frames(self, threadId=0, startFrame=0, levels=0, format=None):
+        """
+        returns stack frames from current execution in DAP format
+        """
+
+        # format is ignored, TODO?
+
+        thread = self.get_thread(threadId)
+        if thread is None:
+            return []
+
+        clevel = 0
+        slevel = 0 if startFrame is None else startFrame
+        elevel = None if levels is None or levels == 0 else slevel + levels
+
+        frames = []
+        cframe = thread.active_frame
+        while cframe is not None:
+            if clevel >= slevel:
+                finfo = {}
+
+                finfo["id"] = thread.id * FRAMES_PER_THREAD + clevel
+                finfo["name"] = cframe.f_code.co_name + self.format_method_signature(cframe.f_locals, cframe.f_code)
+                finfo["source"] = {"path": cframe.f_code.co_filename}
+                finfo["line"] = cframe.f_lineno
+                finfo["presentationHint"] = "normal"
+                finfo["column"] = 0
+                finfo["instructionPointerReference"] = self.disassembly.reference(cframe.f_code, cframe.f_lasti)
+
+                dis_info = {}
+                finfo["subsource"] = dis_info
+
+                disassembled = dis(cframe.f_code, cframe.f_lasti)
+                dis_info["sources"] = [{"text": self.format_disassembly(cframe.f_lineno, *de), "line": de[1], "source": finfo["source"]} for de in disassembled]
+                ord = 0
+                for de in disassembled:
+                    if de[0]:
+                        break
+                    ord += 1
+                finfo["subsourceElement"] = ord
+
+                frames.append(finfo)
+            clevel += 1
+            if elevel is not None and clevel >= elevel:
+                break
+            cframe = cframe.f_back
+
+        return frames
+
+    def format_disassembly(self, cline, current, python_lineno, bytecode_offset, instruction, arg, constant):
+        """
+        formats disassembly info for single opcode from disassembler
+        """
+
+        fmtd = ""
+
+        if bytecode_offset is not None:
+            fmtd += str(bytecode_offset) + " "
+
+        fmtd += "[" + instruction + "]"
+
+        if python_lineno is not None:
+            fmtd += " at line " + str(python_lineno + cline)
+
+        if arg is not None:
+            fmtd += " (%s, %s)" % (str(arg), str(constant))
+
+        return fmtd
+
+    def format_method_signature(self, locals, code):
+        """
+        formats method signature from code and locals
+        """
+
+        res = ""
+        is_args = code.co_flags & 4
+        is_kwargs = code.co_flags & 8
+        total_args = code.co_argcount
+        if is_args:
+            total_args += 1
+        if is_kwargs:
+            total_args += 1
+        for i in range(total_args):
+            varname = code.co_varnames[i]
+
+            if is_args and is_kwargs and i == total_args - 2:
+                varname = "*" + varname
+            elif is_args and is_kwargs and i == total_args - 1:
+                varname = "**" + varname
+            elif is_args and i == total_args - 1:
+                varname = "*" + varname
+            elif is_kwargs and i == total_args - 1:
+                varname = "**" + varname
+            if res == "":
+                res = varname
+            else:
+                res += ", " + varname
+
+        return "(%s)" % res
+
+    def get_scopes(self, frame_id):
+        """
+        returns scope information for DAP
+        """
+
+        frame = self.get_frame(frame_id)
+
+        return [self.get_scope(frame_id, frame, frame.f_locals, "Locals", False),
+                self.get_scope(frame_id, frame, frame.f_globals, "Globals", True)]
+
+    def get_scope(self, frame_id, f, scope_dict, name, expensive):
+        """
+        returns information about scope to DAP
+
+        frame of scope is stored as its parent object
+        """
+
+        with self.scope_lock:
+            scope_id = self.scope_var_id
+            self.scope_assign[scope_id] = (scope_dict, None, None, f)
+            self.scope_frames[scope_id] = frame_id
+            self.scope_var_id += 1
+
+        return {
+            "name": name,
+            "variablesReference": scope_id,
+            "expensive": expensive,
+            "namedVariables": len(scope_dict.keys())
+        }
+
+    def format_variable(self, variablesReference, filter=None, start=None, count=None, format=None):
+        """
+        formats variable and any components for variablesReference in DAP format
+        """
+
+        # format is ignored, TODO?
+
+        vs = None if start is None or start == 0 else start
+        es = None if count is None or count == 0 else count
+
+        var, name, tt, parent = self.scope_assign[variablesReference]
+
+        # print(str(var) + ", " + str(name) + ", " + str(tt))
+
+        is_slotted = False
+
+        if not isinstance(var, (dict, list, tuple)):
+            if isinstance(getattr(var, "__dict__", None), dict):
+                var = var.__dict__
+            else:
+                is_slotted = True
+
+        # print (str(var))
+
+        if not is_slotted and isinstance(var, dict):
+            if filter is not None and filter == "indexed":
+                return []
+            try:
+                keys = sorted(var.keys())
+            except Exception:
+                keys = list(var.keys())
+        elif not is_slotted:
+            if filter is not None and filter == "named":
+                return []
+            keys = range(len(var))
+        elif is_slotted:
+            # slots only, dir() and attribute lookup could run code of the value
+            keys = ValuePreview.slots(var)
+
+        if "self" in keys:
+            keys.remove("self")
+            keys = ["self"] + keys
+
+        # print (str(keys))
+
+        frame_id = self.scope_frames.get(variablesReference, None)
+
+        it = 0
+        total = 0
+        variables = []
+        for vkey in keys:
+            if vs is None or it >= vs:
+                if is_slotted:
+                    value = getattr(var, vkey)
+                else:
+                    value = var[vkey]
+
+                variables.append(self.describe_variable(vkey, value, var, frame_id))
+                total += 1
+            it += 1
+            if es is not None and total >= es:
+                break
+
+        return variables
+
+    def describe_variable(self, vkey, value, parent, frame_id):
+        """
+        describes single value in DAP format, registering it so its components can be listed
+        """
+
+        with self.scope_lock:
+            var_ref = self.scope_var_id
+
+            vardesc = {}
+
+            vardesc["name"] = vkey
+            vardesc["value"] = self.previews.preview(value)
+            vardesc["type"] = str(type(value))
+            # vardesc["presentationHint"] # TODO!!!
+            vardesc["evaluateName"] = vkey
+
+            if isinstance(value, PREVIEW_SCALARS):
+                # nothing to expand
+                vardesc["variablesReference"] = 0
+                return vardesc
+            vardesc["variablesReference"] = var_ref
+
+            vv_inner = value
+            vv_slotted = False
+            if not isinstance(vv_inner, (dict, list, tuple)):
+                if isinstance(getattr(vv_inner, "__dict__", None), dict):
+                    vv_inner = vv_inner.__dict__
+                else:
+                    vv_slotted = True
+
+            if not vv_slotted and isinstance(vv_inner, dict):
+                vardesc["namedVariables"] = len(vv_inner)
+            elif not vv_slotted:
+                vardesc["indexedVariables"] = len(vv_inner)
+            else:
+                vardesc["namedVariables"] = len(ValuePreview.slots(vv_inner))
+
+            self.scope_assign[var_ref] = (value, vkey, str(type(value)), parent)
+            self.scope_frames[var_ref] = frame_id
+
+            self.scope_var_id += 1
+            return vardesc
+
+    def export_snapshot(self, path, frameId=0, maxDepth=None):
+        """
+        writes snapshot of locals and globals of paused frame frameId into file path
+
+        returns custom exportSnapshot response body
+        """
+
+        self.get_paused_thread(frameId)
+        frame = self.get_frame(frameId)
+
+        snapshot = StateSnapshot(path, SNAPSHOT_MAX_DEPTH if maxDepth is None else maxDepth)
+        count = snapshot.write(frame)
+        return {"path": path, "values": count}
+
+    def pause_snapshot(self, threadId=0, levels=None, count=None):
+        """
+        returns custom pauseSnapshot response body for paused thread threadId
+
+        body holds everything client usually asks for after pause: threads, top levels stack frames
+        of the thread, scopes of its top frame and first count variables of each not expensive scope
+        (in scope's variables), so single response replaces threads, stackTrace, scopes and variables
+        round trips. If the thread is not paused, only threads are returned.
+        """
+
+        levels = PAUSE_SNAPSHOT_LEVELS if levels is None else levels
+        count = PAUSE_SNAPSHOT_VARIABLES if count is None else count
+
+        body = {"threads": [{"id": t.id, "name": t.get_name()} for t in self.get_threads()]}
+
+        thread = self.get_thread(threadId)
+        if thread is None or thread.cont or thread.active_frame is None:
+            return body
+
+        frames = self.get_stack_frames(thread.id, 0, levels)
+        scopes = self.get_scopes(frames[0]["id"])
+        for scope in scopes:
+            if not scope["expensive"]:
+                scope["variables"] = self.format_variable(scope["variablesReference"], count=count)
+
+        body["threadId"] = thread.id
+        body["stackFrames"] = frames
+        body["scopes"] = scopes
+        return body
+
+    def set_recording(self, capacity=None):
+        """
+        starts flight recorder with room for capacity (default RECORDER_CAPACITY) events, or stops it if capacity is 0
+
+        returns custom setRecording response body
+        """
+
+        if capacity is None:
+            capacity = RECORDER_CAPACITY
+        self.recorder = FlightRecorder(capacity) if capacity else None
+        return {"recording": self.recorder is not None}
+
+    def dump_recording(self, path, seconds=None):
+        """
+        writes events of last seconds (or all recorded events) from flight recorder into file path
+
+        returns custom dumpRecording response body
+        """
+
+        recorder = self.recorder
+        if recorder is None:
+            raise ValueError("Flight recorder is not running")
+        count = recorder.dump(path, seconds, dict((t.id, t.get_name()) for t in self.get_threads()))
+        return {"path": path, "events": count}
+
+    def collect_heap_statistics(self, sample, done):
+        """
+        starts collecting heap statistics of every sample-th object on background thread, calling done
+        with None, or exception collection failed with, once it finishes
+
+        previous statistics become baseline of the new ones
+        """
+
+        if sample < 1:
+            raise ValueError("Sample must be at least 1")
+        if self.heap_collector is not None:
+            raise ValueError("Heap statistics are already being collected")
+
+        def collect():
+            error = None
+            try:
+                previous = self.heap_statistics
+                statistics = HeapStatistics(sample, previous.types if previous is not None else None)
+                statistics.collect()
+                self.heap_statistics = statistics
+            except Exception as e:
+                error = e
+            self.heap_collector = None
+            done(error)
+
+        self.heap_collector = threading.Thread(target=collect, name="heap statistics")
+        self.heap_collector.is_debugger_thread = True
+        self.heap_collector.daemon = True
+        self.heap_collector.start()
+
+    def heap_statistics_page(self, start=0, count=None, sortBy="size"):
+        """
+        returns page of last collected heap statistics as custom heapStatistics response body
+        """
+
+        if self.heap_statistics is None:
+            raise ValueError("No heap statistics were collected")
+        return self.heap_statistics.page(start, HEAP_STATISTICS_PAGE if count is None else count, sortBy)
+
+    def get_paused_thread(self, frame_id):
+        """
+        returns thread of frame_id, which must be paused
+        """
+
+        thread = self.get_thread(frame_id // FRAMES_PER_THREAD)
+        if thread is None or thread.cont:
+            raise ValueError("Frame %s is not in paused thread" % str(frame_id))
+        return thread
+
+    def evaluate(self, done, expression, frameId=None, context=None, format=None):
+        """
+        evaluates expression in frame frameId, calling done(body, exception) with evaluate response body
+
+        expression is compiled here, evaluated and described in paused thread of the frame,
+        which calls done, so caller does not wait for it. Results are cached until execution
+        resumes or state may have changed. In repl context, statements are executed as well
+        and cached results and previews are dropped.
+        """
+
+        if frameId is None:
+            frameId = 0
+        key = (frameId, expression, context)
+        if key in self.evaluated:
+            done(self.evaluated[key], None)
+            return
+
+        thread = self.get_paused_thread(frameId)
+        try:
+            code = compile(expression, "<evaluate>", "eval")
+        except SyntaxError:
+            if context != "repl":
+                raise
+            code = compile(expression, "<evaluate>", "exec")
+
+        frame = self.get_frame(frameId)
+
+        def evaluate():
+            value = _evaluate_in_frame(code, frame)
+            if context == "repl":
+                # statements may have changed previewed values and results of earlier evaluations
+                self.evaluated = {}
+                self.previews = ValuePreview(self.slow_preview_types)
+            body = self.describe_result(expression, value, None, frameId, "result")
+            if context != "repl":
+                # repl can change state, so only watch and hover evaluations are cached
+                self.evaluated[key] = body
+            return body
+
+        thread.run_work(evaluate, (), done)
+
+    def set_variable(self, done, variablesReference, name, value, format=None):
+        """
+        sets component name of variablesReference to value of expression value, calling done(body, exception)
+        with set variable response body
+        """
+
+        container, _, tt, parent = self.scope_assign[variablesReference]
+        frame_id = self.scope_frames.get(variablesReference, None)
+        if frame_id is None:
+            raise ValueError("Variable %s can't be set" % name)
+
+        thread = self.get_paused_thread(frame_id)
+        frame = self.get_frame(frame_id)
+        code = compile(value, "<setVariable>", "eval")
+        # scopes have their frame as parent, change of locals must be written back to frame
+        locals_of = parent if tt is None and container is not frame.f_globals else None
+
+        def set_variable():
+            new_value = _assign_in_frame(code, frame, container, name, locals_of)
+            self.evaluated = {}
+            self.previews = ValuePreview(self.slow_preview_types)
+            return self.describe_result(name, new_value, container, frame_id, "value")
+
+        thread.run_work(set_variable, (), done)
+
+    def set_expression(self, done, expression, value, frameId=None, format=None):
+        """
+        assigns value of expression value to assignable expression, calling done(body, exception)
+        with set expression response body
+        """
+
+        if frameId is None:
+            frameId = 0
+
+        thread = self.get_paused_thread(frameId)
+        frame = self.get_frame(frameId)
+        code = compile(value, "<setExpression>", "eval")
+        target = compile("%s = __rpydb_value__" % expression, "<setExpression>", "exec")
+
+        def set_expression():
+            new_value = _execute_assignment(code, target, frame)
+            self.evaluated = {}
+            self.previews = ValuePreview(self.slow_preview_types)
+            return self.describe_result(expression, new_value, None, frameId, "value")
+
+        thread.run_work(set_expression, (), done)
+
+    def describe_result(self, name, value, parent, frame_id, value_key):
+        """
+        returns body of evaluate (value_key "result"), setVariable or setExpression (value_key "value") response
+
+        called in paused thread, so previews of the value run code in the thread that owns it
+        """
+
+        vardesc = self.describe_variable(name, value, parent, frame_id)
+        return {
+            value_key: vardesc["value"],
+            "type": vardesc["type"],
+            "variables_reference": vardesc["variablesReference"],
+            "named_variables": vardesc.get("namedVariables", 0),
+            "indexed_variables": vardesc.get("indexedVariables", 0)
+        }
+
+
+def _locals_to_fast(frame):
+    """
+    writes changes of frame.f_locals dict back to frame's local variables
+    """
+
+    if ctypes is not None:
+        ctypes.pythonapi.PyFrame_LocalsToFast(ctypes.py_object(frame), ctypes.c_int(0))
+
+
+def _evaluate_in_frame(code, frame):
+    """
+    evaluates code in frame, run in paused thread
+
+    statements (exec mode code) are executed and None is returned
+    """
+
+    f_locals = frame.f_locals
+    result = eval(code, frame.f_globals, f_locals)
+    if f_locals is not frame.f_globals:
+        _locals_to_fast(frame)
+    return result
+
+
+def _assign_in_frame(code, frame, container, name, locals_of):
+    """
+    sets container[name] (or attribute name) to value of code evaluated in frame, run in paused thread
+    """
+
+    value = eval(code, frame.f_globals, frame.f_locals)
+    if isinstance(container, dict):
+        container[name] = value
+        if locals_of is not None:
+            _locals_to_fast(locals_of)
+    elif isinstance(container, list):
+        container[int(name)] = value
+    else:
+        setattr(container, name, value)
+    return value
+
 
-        self.base_trace(frame, event, arg)
+def _execute_assignment(code, target, frame):
+    """
+    evaluates code in frame and assigns it with target assignment code, run in paused thread
+    """
 
-    def trace_line(self, frame, event, arg):
+    f_locals = frame.f_locals
+    value = eval(code, frame.f_globals, f_locals)
+    f_locals["__rpydb_value__"] = value
+    try:
+        exec(target, frame.f_globals, f_locals)
+    finally:
+        del f_locals["__rpydb_value__"]
+    if f_locals is not frame.f_globals:
+        _locals_to_fast(frame)
+    return value
+
+
+SNAPSHOT_MAX_DEPTH = 16
+"""
+default depth limit of values written into snapshot
+"""
+
+SNAPSHOT_VALUE_LIMIT = 120
+"""
+strings longer than this are truncated in snapshot
+"""
+
+SNAPSHOT_SCALARS = INTEGER_TYPES + (float, bool, complex) + TEXT_TYPES + (type(None),)
+"""
+types written into snapshot as values, without components
+"""
+
+SNAPSHOT_OPAQUE = (types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType) + \
+    CLASS_TYPES + (types.CodeType, types.FrameType, types.GeneratorType)
+"""
+types written into snapshot only by their type, since they are code or would pull whole program in
+"""
+
+
+class StateSnapshot(object):
+    """
+    Streams values reachable from frame's locals and globals into gzipped snapshot file
+
+    Snapshot file starts with json header line, each next line describes single value:
+
+        path<TAB>type<TAB>value
+
+    where path is python-like accessor of the value from its scope (globals.x[0].name).
+    Containers and objects have their component count as value and their components follow,
+    values already written are referenced as @path instead, so cycles end there.
+    Snapshots are compared with snapshot_diff.py.
+    """
+
+    def __init__(self, path, max_depth):
+        self.path = path
+        self.max_depth = max_depth
+
+    def write(self, frame):
         """
-        trace function for line events
+        writes the snapshot of frame, returning number of values written
         """
 
-        self.active_frame = frame
+        header = {
+            "format": "rpysnapshot",
+            "version": 1,
+            "source": frame.f_code.co_filename,
+            "line": frame.f_lineno,
+            "time": time.time()
+        }
 
-        self.base_trace(frame, event, arg)
+        roots = [("globals", frame.f_globals)]
+        if frame.f_locals is not frame.f_globals:
+            roots.insert(0, ("locals", frame.f_locals))
 
-    def base_trace(self, frame, event, arg):
+        count = 0
+        output = gzip.open(self.path, "wb")
+        try:
+            output.write((json.dumps(header) + "\n").encode("utf-8"))
+            for name, scope in roots:
+                count += self.write_value(output, name, scope)
+        finally:
+            output.close()
+        return count
+
+    def write_value(self, output, root_path, root):
         """
-        main tracing method, called on every frame of execution including special events
+        writes root and all its components depth first, without recursion
         """
 
-        # print("Tracing %s %s %s (%s))" % (event, "<File %s, Line %s>" % (frame.f_code.co_filename, frame.f_lineno), str(arg), str(id(threading.current_thread()))))
+        # id -> path of containers already written, ids are stable since execution is paused
+        seen = {}
+        count = 0
+        stack = [(root_path, root, 0)]
+        while stack:
+            path, value, depth = stack.pop()
+            type_name = type(value).__name__
+            count += 1
+
+            if isinstance(value, SNAPSHOT_SCALARS):
+                output.write(self.format_line(path, type_name, self.format_scalar(value)))
+                continue
+
+            if isinstance(value, SNAPSHOT_OPAQUE):
+                output.write(self.format_line(path, type_name, ""))
+                continue
+
+            if id(value) in seen:
+                output.write(self.format_line(path, type_name, "@" + seen[id(value)]))
+                continue
+            seen[id(value)] = path
+
+            components = self.components(path, value)
+            output.write(self.format_line(path, type_name, str(len(components))))
+            if depth < self.max_depth:
+                # reversed, so components are written in order
+                for component_path, component in reversed(components):
+                    stack.append((component_path, component, depth + 1))
+        return count
+
+    def components(self, path, value):
+        """
+        returns list of (path, component) of value
 
-        # if true, breakpoints will be checked
-        test_breakpoints = True
-
-        # check for steppings
-        if self.stepping != SteppingMode.STEP_NO_STEP:
-            # print("Tracing for %s %s %s %s (%s))" % (str(self.stepping), event, "<File %s, Line %s>" % (frame.f_code.co_filename, frame.f_lineno), str(arg), str(id(threading.current_thread()))))
-
-            # single execution step, to move out of return/call frames into line frames
-            if self.stepping == SteppingMode.STEP_SINGLE_EXEC:
-                test_breakpoints = False
-                self.stepping = SteppingMode.STEP_NO_STEP
-                self.break_pause = False
-                self.cont = False
-                handler.pause_debugging()
-
-            # step INTO and call happens on same level as we are, we are in
-            # just move one step to line
-            if self.stepping == SteppingMode.STEP_INTO and self.active_frame.f_back is self.stored_frames[1] and event == "call":
-                # this will exit because call is unhandled!
-                test_breakpoints = False
-                self.stepping = SteppingMode.STEP_SINGLE_EXEC
-                self.pause_reason = "stepIn"
-
-            # step INTO but there is nothing to go in
-            # so only move as step
-            if self.stepping == SteppingMode.STEP_INTO and self.active_frame is self.stored_frames[1] and event != "return":
-                self.stepping = SteppingMode.STEP_NEXT
-
-            # same as above but we are returning, so do single step to move out
-            if self.stepping == SteppingMode.STEP_INTO and self.active_frame is self.stored_frames[1] and event != "return":
-                test_breakpoints = False
-                self.stepping = SteppingMode.STEP_SINGLE_EXEC
-                self.pause_reason = "step"
-
-            # step OUT and return happens, just move one step to line
-            if self.stepping == SteppingMode.STEP_OUT and self.active_frame is self.stored_frames[1] and event == "return":
-                test_breakpoints = False
-                self.stepping = SteppingMode.STEP_SINGLE_EXEC
-                self.pause_reason = "stepOut"
-                return  # exit evaluation
-
-            # next will always break if this is line
-            if self.stepping == SteppingMode.STEP_NEXT and self.active_frame is self.stored_frames[1] and event != "call":
-                test_breakpoints = False
-                self.stepping = SteppingMode.STEP_NO_STEP
-                self.break_pause = False
-                self.pause_reason = "step"
-                self.cont = False
-                handler.pause_debugging()
-
-        if event == "exception" or event == "call":
-            return  # TODO: exceptions, calls
-
-        if test_breakpoints:
-            # due to lock we move triggered breakpoint to here
-            breaking_on = None
-
-            # check breakpoints under lock
-            with self.bkp_lock:
-                for breakpoint in self.active_breakpoints:
-                    if breakpoint.applies(frame):
-                        breaking_on = breakpoint
-                        break
-            if breaking_on is not None:
-                print("Broke at %s %s %s (%s))" % (event, "<File %s, Line %s>" % (frame.f_code.co_filename, frame.f_lineno), str(arg), str(id(threading.current_thread()))))
-                self.break_code(breaking_on)  # sets this to blocking
+        only items of containers, instance dicts and slots are used, properties are never called
+        """
 
-        # check for external requested pause
-        if self.break_pause:
-            self.break_pause = False
-            self.pause_reason = "pause"
-            self.cont = False
-            handler.pause_debugging()
+        if isinstance(value, dict):
+            try:
+                keys = sorted(value.keys())
+            except Exception:
+                keys = list(value.keys())
+            return [("%s[%s]" % (path, self.format_key(k)), value[k]) for k in keys]
+
+        if isinstance(value, (list, tuple)):
+            return [("%s[%s]" % (path, str(i)), v) for i, v in enumerate(value)]
+
+        if isinstance(value, (set, frozenset)):
+            # sets have no stable order, so items are ordered by their representation
+            return [("%s{%s}" % (path, str(i)), v) for i, v in enumerate(sorted(value, key=self.format_scalar))]
+
+        components = []
+        attributes = getattr(value, "__dict__", None)
+        if isinstance(attributes, dict):
+            components = [("%s.%s" % (path, k), attributes[k]) for k in sorted(attributes.keys())]
+        for cls in type(value).__mro__:
+            for slot in cls.__dict__.get("__slots__", ()):
+                if slot != "__dict__" and slot != "__weakref__" and hasattr(value, slot):
+                    components.append(("%s.%s" % (path, slot), getattr(value, slot)))
+        return components
+
+    def format_key(self, key):
+        if isinstance(key, SNAPSHOT_SCALARS):
+            return self.format_scalar(key)
+        return "<%s at %s>" % (type(key).__name__, hex(id(key)))
+
+    def format_scalar(self, value):
+        """
+        formats scalar value into single line, truncating long strings
+        """
 
-        while not self.cont:
-            # spinlock when we are waiting for debugger
-            time.sleep(0.1)
+        if isinstance(value, TEXT_TYPES) and len(value) > SNAPSHOT_VALUE_LIMIT:
+            return repr(value[:SNAPSHOT_VALUE_LIMIT]) + "...(%s)" % str(len(value))
+        try:
+            return repr(value)
+        except Exception:
+            return "<%s at %s>" % (type(value).__name__, hex(id(value)))
 
-    def register_breakpoint(self, breakpoint):
-        with self.bkp_lock:
-            self.active_breakpoints.add(breakpoint)
+    def format_line(self, path, type_name, value):
+        line = "%s\t%s\t%s\n" % (path, type_name, value)
+        if not isinstance(line, bytes):
+            line = line.encode("utf-8")
+        return line
 
-    def clear_source_breakpoints(self, src):
-        with self.bkp_lock:
-            new_breakpoints = set()
-            for b in self.active_breakpoints:
-                if b.source != src:
-                    new_breakpoints.add(b)
-            self.active_breakpoints = new_breakpoints
 
-    def frame_location_info(self):
+PREVIEW_LENGTH = 200
+"""
+strings, previews by repr and listed items of containers longer than this are truncated
+"""
+
+PREVIEW_ITEMS = 10
+"""
+number of items of containers shown in preview
+"""
+
+PREVIEW_DEPTH = 2
+"""
+depth of nested containers shown in preview, deeper containers are shown only by their brackets
+"""
+
+PREVIEW_SLOW = 0.05
+"""
+seconds a single fallback preview may take, types of values which take longer are never previewed by repr again
+"""
+
+PREVIEW_BUDGET = 1.0
+"""
+seconds fallback previews may take during single pause, values are then previewed only by type and id
+"""
+
+PREVIEW_SCALARS = INTEGER_TYPES + (float, bool, complex) + TEXT_TYPES + (type(None),)
+"""
+types of values which have no components to list
+"""
+
+
+class ValuePreview(object):
+    """
+    Previews values shown in variables, memoized per object until execution resumes
+
+    Values of types with registered formatter (see register_preview_formatter) are previewed without
+    calling any code of the value. Other values are previewed by repr, guarded against exceptions
+    and recursion. Time of repr is only measured after it returns, a repr which hangs is not
+    interrupted, but types whose repr was slow are not previewed by repr again and once time of
+    the pause runs out no repr is called.
+    """
+
+    def __init__(self, slow_types):
+        # id of value -> (value, preview), value is kept so its id can't be reused
+        self.memo = {}
+        # type -> formatter or None if type has none
+        self.formatters = {}
+        # registered formatters of types which are loaded, including ones registered by dotted path
+        self.registered = {}
+        for key, formatter in preview_formatters.items():
+            if isinstance(key, str):
+                module_name, _, name = key.rpartition(".")
+                key = getattr(sys.modules.get(module_name), name, None)
+            if isinstance(key, CLASS_TYPES):
+                self.registered[key] = formatter
+        # types whose repr was too slow, shared by all pauses
+        self.slow_types = slow_types
+        # seconds left for fallback previews
+        self.budget = PREVIEW_BUDGET
+        # ids of containers being previewed
+        self.active = set()
+
+    def preview(self, value):
+        """
+        returns preview of value
         """
-        returns location information about current frame
 
-        should be used by other thread when debugged main thread is cont=False
+        key = id(value)
+        if key not in self.memo:
+            self.memo[key] = (value, self.nested(value))
+        return self.memo[key][1]
+
+    def nested(self, value):
+        """
+        returns preview of value, which can be part of previewed container
         """
 
-        return str(self.active_frame.f_code.co_filename) + ":" + str(self.active_frame.f_lineno)
+        formatter = self.formatter_of(type(value))
+        if formatter is None:
+            return self.fallback(value)
+        try:
+            return formatter(self, value)
+        except Exception:
+            return self.opaque(value)
+
+    def formatter_of(self, value_type):
+        if value_type not in self.formatters:
+            formatter = None
+            for cls in getattr(value_type, "__mro__", (value_type,)):
+                if cls in self.registered:
+                    formatter = self.registered[cls]
+                    break
+            self.formatters[value_type] = formatter
+        return self.formatters[value_type]
+
+    def fallback(self, value):
+        """
+        previews value by its repr, unless its type was too slow or time of this pause ran out
+        """
 
-    def get_frame(self, frame_ord):
+        value_type = type(value)
+        if value_type in self.slow_types or self.budget <= 0:
+            return self.opaque(value)
+
+        start = time.time()
+        try:
+            text = repr(value)
+        except Exception:
+            # RuntimeError of recursion included
+            text = self.opaque(value)
+        elapsed = time.time() - start
+        self.budget -= elapsed
+        if elapsed > PREVIEW_SLOW:
+            self.slow_types.add(value_type)
+            log.debug("Preview of %s took %.3f s, its values will not be previewed by repr", value_type, elapsed)
+
+        if len(text) > PREVIEW_LENGTH:
+            text = text[:PREVIEW_LENGTH] + "..."
+        return text
+
+    def opaque(self, value):
+        return "<%s at %s>" % (type(value).__name__, hex(id(value)))
+
+    def items(self, value, opening, closing, size, iterable, format_item):
         """
-        returns frame with id frame_ord from stack
+        previews first PREVIEW_ITEMS items of container value with format_item, guarding against cycles and depth
+
+        size and iterable are taken by caller through methods of builtin container type, not of value's subclass
         """
 
-        cframe = self.active_frame
-        c = 0
-        while cframe is not None:
-            if c == frame_ord:
-                return cframe
-            cframe = cframe.f_back
-            c += 1
+        if id(value) in self.active or len(self.active) >= PREVIEW_DEPTH:
+            return opening + "..." + closing
+
+        parts = []
+        length = 0
+        self.active.add(id(value))
+        try:
+            for item in itertools.islice(iterable, PREVIEW_ITEMS):
+                if length >= PREVIEW_LENGTH:
+                    break
+                part = format_item(item)
+                if length + len(part) > PREVIEW_LENGTH:
+                    part = part[:PREVIEW_LENGTH - length] + "..."
+                parts.append(part)
+                length += len(part) + 2
+        finally:
+            self.active.discard(id(value))
+
+        if size > len(parts):
+            parts.append("... (%s items)" % str(size))
+        return opening + ", ".join(parts) + closing
+
+    def attribute(self, value, name):
+        """
+        returns attribute name of value from its instance dict or class, without calling any property or __getattr__
+        """
+
+        attributes = getattr(value, "__dict__", None)
+        if isinstance(attributes, dict) and name in attributes:
+            return attributes[name]
+        for cls in type(value).__mro__:
+            if name in cls.__dict__ and not hasattr(cls.__dict__[name], "__get__"):
+                return cls.__dict__[name]
         return None
 
-    def get_stack_frames(self, threadId=0, startFrame=0, levels=0, format=None):
+    @staticmethod
+    def slots(value):
         """
-        returns stack frames from current execution in DAP format
+        returns names of slots of value which are set
         """
 
-        # format is ignored, TODO?
-        # threadId is ignored since renpy is single threaded for stuff we need
+        names = []
+        for cls in getattr(type(value), "__mro__", ()):
+            slots = cls.__dict__.get("__slots__", ())
+            if isinstance(slots, str):
+                slots = (slots,)
+            for slot in slots:
+                if slot != "__dict__" and slot != "__weakref__" and hasattr(value, slot):
+                    names.append(slot)
+        return sorted(names)
 
-        clevel = 0
-        slevel = 0 if startFrame is None else startFrame
-        elevel = None if levels is None or levels == 0 else levels
 
-        frames = []
-        cframe = self.active_frame
-        while cframe is not None:
-            if clevel >= slevel:
-                finfo = {}
+preview_formatters = {}
+"""
+formatters of values by their type, formatter(preview, value) returns preview of value
 
-                finfo["id"] = clevel
-                finfo["name"] = cframe.f_code.co_name + self.format_method_signature(cframe.f_locals, cframe.f_code)
-                finfo["source"] = {"path": cframe.f_code.co_filename}
-                finfo["line"] = cframe.f_lineno
-                finfo["presentationHint"] = "normal"
-                finfo["column"] = 0
+type is either class or dotted path of class, resolved when the class is loaded. Formatter of nearest
+class in method resolution order of value's type is used.
+"""
 
-                dis_info = {}
-                finfo["subsource"] = dis_info
 
-                disassembled = dis(cframe.f_code, cframe.f_lasti)
-                dis_info["sources"] = [{"text": self.format_disassembly(cframe.f_lineno, *de), "line": de[1], "source": finfo["source"]} for de in disassembled]
-                ord = 0
-                for de in disassembled:
-                    if de[0]:
-                        break
-                    ord += 1
-                finfo["subsourceElement"] = ord
+def register_preview_formatter(cls, formatter):
+    """
+    registers formatter(preview, value) previewing values of class cls (or dotted path of the class) and its subclasses
 
-                frames.append(finfo)
-            clevel += 1
-            if elevel is not None and clevel >= elevel:
-                break
-            cframe = cframe.f_back
+    formatter must not call code of the value and should keep preview short, components are previewed by preview.nested
+    """
 
-        return frames
+    preview_formatters[cls] = formatter
 
-    def format_disassembly(self, cline, current, python_lineno, bytecode_offset, instruction, arg, constant):
-        """
-        formats disassembly info for single opcode from disassembler
-        """
 
-        fmtd = ""
+def _preview_number(preview, value):
+    if type(value) not in PREVIEW_SCALARS:
+        # subclass may override anything used to format it
+        return preview.fallback(value)
+    if isinstance(value, bool):
+        return "True" if value else "False"
+    if isinstance(value, float):
+        return repr(float(value))
+    if isinstance(value, complex):
+        return repr(complex(value))
+    return "%d" % value
 
-        if bytecode_offset is not None:
-            fmtd += str(bytecode_offset) + " "
 
-        fmtd += "[" + instruction + "]"
+def _preview_string(preview, value):
+    if type(value) not in PREVIEW_SCALARS:
+        return preview.fallback(value)
+    if len(value) > PREVIEW_LENGTH:
+        return repr(value[:PREVIEW_LENGTH]) + "... (%s characters)" % str(len(value))
+    return repr(value)
 
-        if python_lineno is not None:
-            fmtd += " at line " + str(python_lineno + cline)
 
-        if arg is not None:
-            fmtd += " (%s, %s)" % (str(arg), str(constant))
+# containers, including subclasses (ie. renpy's revertable ones), are read through methods of builtin type
 
-        return fmtd
 
-    def format_method_signature(self, locals, code):
-        """
-        formats method signature from code and locals
-        """
+def _preview_list(preview, value):
+    return preview.items(value, "[", "]", list.__len__(value), list.__iter__(value), preview.nested)
 
-        res = ""
-        is_args = code.co_flags & 4
-        is_kwargs = code.co_flags & 8
-        total_args = code.co_argcount
-        if is_args:
-            total_args += 1
-        if is_kwargs:
-            total_args += 1
-        for i in xrange(total_args):
-            varname = code.co_varnames[i]
 
-            if is_args and is_kwargs and i == total_args - 2:
-                varname = "*" + varname
-            elif is_args and is_kwargs and i == total_args - 1:
-                varname = "**" + varname
-            elif is_args and i == total_args - 1:
-                varname = "*" + varname
-            elif is_kwargs and i == total_args - 1:
-                varname = "**" + varname
-            if res == "":
-                res = varname
-            else:
-                res += ", " + varname
+def _preview_tuple(preview, value):
+    length = tuple.__len__(value)
+    return preview.items(value, "(", ",)" if length == 1 else ")", length, tuple.__iter__(value), preview.nested)
 
-        return "(%s)" % res
 
-    def get_scopes(self, frame_ord):
+def _preview_set(preview, value):
+    base = set if isinstance(value, set) else frozenset
+    length = base.__len__(value)
+    if not length:
+        return "%s()" % type(value).__name__
+    return preview.items(value, "{", "}", length, base.__iter__(value), preview.nested)
+
+
+def _preview_dict(preview, value):
+    def format_item(key):
+        return "%s: %s" % (preview.nested(key), preview.nested(dict.__getitem__(value, key)))
+    return preview.items(value, "{", "}", dict.__len__(value), dict.__iter__(value), format_item)
+
+
+def _preview_character(preview, value):
+    return "Character(%s)" % preview.nested(preview.attribute(value, "name"))
+
+
+def _preview_displayable(preview, value):
+    # text of Text, file of Image, name of ImageReference
+    for name in ("text", "filename", "name"):
+        detail = preview.attribute(value, name)
+        if detail is not None:
+            return "<%s %s>" % (type(value).__name__, preview.nested(detail))
+    return preview.opaque(value)
+
+
+def _preview_node(preview, value):
+    location = "%s:%s" % (preview.attribute(value, "filename"), str(preview.attribute(value, "linenumber")))
+    name = preview.attribute(value, "name")
+    if isinstance(name, TEXT_TYPES):
+        return "<%s %s at %s>" % (type(value).__name__, name, location)
+    return "<%s at %s>" % (type(value).__name__, location)
+
+
+for number_type in INTEGER_TYPES + (float, bool, complex):
+    register_preview_formatter(number_type, _preview_number)
+for text_type in TEXT_TYPES:
+    register_preview_formatter(text_type, _preview_string)
+register_preview_formatter(type(None), lambda preview, value: "None")
+register_preview_formatter(list, _preview_list)
+register_preview_formatter(tuple, _preview_tuple)
+register_preview_formatter(set, _preview_set)
+register_preview_formatter(frozenset, _preview_set)
+register_preview_formatter(dict, _preview_dict)
+register_preview_formatter("renpy.character.ADVCharacter", _preview_character)
+register_preview_formatter("renpy.display.core.Displayable", _preview_displayable)
+register_preview_formatter("renpy.ast.Node", _preview_node)
+
+
+HEAP_STATISTICS_PAGE = 50
+"""
+number of types in page of heap statistics if client does not ask for other count
+"""
+
+HEAP_STATISTICS_CHUNK = 10000
+"""
+number of objects measured before heap statistics collection lets other threads run
+"""
+
+HEAP_STATISTICS_ORDER = {
+    "size": lambda entry: entry[2],
+    "count": lambda entry: entry[1],
+    "growth": lambda entry: entry[2] - entry[4],
+}
+"""
+sort keys of heap statistics entries (type, count, size, baseline count, baseline size), largest first
+"""
+
+
+def _gc_generations():
+    """
+    returns gc generations objects can be listed by, [None] if python lists only all objects at once
+    """
+
+    try:
+        gc.get_objects(0)
+    except TypeError:
+        return [None]
+    return list(range(len(gc.get_count())))
+
+
+class HeapStatistics(object):
+    """
+    Number and size of objects of each type on the heap
+
+    Objects are those tracked by gc (containers and instances, not numbers or strings), measured
+    by sys.getsizeof without their contents. With sample greater than 1, only every sample-th
+    object is measured and counts and sizes are scaled up. Objects are measured on collecting
+    thread in chunks, so game keeps running, only getting lists of objects stops it.
+
+    Sampling does not make listing cheaper, gc lists every tracked object. On python 3.8 and
+    newer objects are listed one generation at a time, so only the largest generation is
+    listed at once, older pythons list all objects in single list.
+
+    Statistics of previous collection are baseline, growth is difference from it.
+    """
+
+    def __init__(self, sample=1, baseline=None):
+        self.sample = sample
+        # type name -> (count, size) of baseline, None if there is none
+        self.baseline = baseline
+        # type name -> (count, size)
+        self.types = {}
+        self.objects = 0
+        self.size = 0
+        self.elapsed = 0.0
+        # sort key -> sorted entries, sorted when page is first asked for
+        self.sorted = {}
+
+    def collect(self):
+        started = time.time()
+        instance_type = getattr(types, "InstanceType", None)
+        getsizeof = sys.getsizeof
+
+        by_type = {}
+        for generation in _gc_generations():
+            objects = gc.get_objects() if generation is None else gc.get_objects(generation)
+            # sampled chunk by chunk, so sample is never copied whole
+            step = HEAP_STATISTICS_CHUNK * self.sample
+            for chunk_start in range(0, len(objects), step):
+                for obj in objects[chunk_start:chunk_start + step:self.sample]:
+                    obj_type = type(obj)
+                    if obj_type is instance_type:
+                        obj_type = obj.__class__
+                    try:
+                        size = getsizeof(obj)
+                    except Exception:
+                        size = 0
+                    entry = by_type.get(obj_type)
+                    if entry is None:
+                        by_type[obj_type] = [1, size]
+                    else:
+                        entry[0] += 1
+                        entry[1] += size
+                # lets game threads run
+                time.sleep(0)
+            del objects
+
+        # types are kept by name only, so statistics do not keep reloaded classes alive
+        for obj_type, (count, size) in by_type.items():
+            name = "%s.%s" % (getattr(obj_type, "__module__", "?"), obj_type.__name__)
+            count, size = count * self.sample, size * self.sample
+            previous = self.types.get(name, (0, 0))
+            self.types[name] = (previous[0] + count, previous[1] + size)
+            self.objects += count
+            self.size += size
+        self.elapsed = time.time() - started
+
+    def page(self, start, count, sort_by):
         """
-        returns scope information for DAP
+        returns count types from start, in order sort_by, as custom heapStatistics response body
         """
 
-        frame = self.get_frame(frame_ord)
+        if sort_by not in HEAP_STATISTICS_ORDER:
+            raise ValueError("Unknown order %s" % sort_by)
+
+        entries = self.sorted.get(sort_by)
+        if entries is None:
+            baseline = self.baseline or {}
+            entries = [(name, c, s) + baseline.get(name, (0, 0)) for name, (c, s) in self.types.items()]
+            entries.sort(key=HEAP_STATISTICS_ORDER[sort_by], reverse=True)
+            self.sorted[sort_by] = entries
+
+        statistics = []
+        for name, c, s, baseline_count, baseline_size in entries[start:start + count]:
+            entry = {"type": name, "count": c, "size": s}
+            if self.baseline is not None:
+                entry["countDelta"] = c - baseline_count
+                entry["sizeDelta"] = s - baseline_size
+            statistics.append(entry)
+
+        return {"objects": self.objects, "size": self.size, "types": len(entries), "sample": self.sample,
+                "elapsed": self.elapsed, "baseline": self.baseline is not None, "start": start,
+                "statistics": statistics}
+
+
+RECORDER_CAPACITY = 1 << 20
+"""
+default number of events flight recorder keeps
+"""
+
+RECORDER_EVENTS = {"call": 0, "line": 1, "return": 2, "exception": 3}
+"""
+trace events as stored by flight recorder
+"""
+
+RECORDER_MAGIC = b"RPYDBFR1"
+
+
+class FlightRecorder(object):
+    """
+    Records trace events of all threads into preallocated ring of arrays
+
+    Each event is stored as code id, line, event, thread id and timestamp in parallel
+    arrays, code objects are interned to ids by their filename, name and first line.
+    Oldest events are overwritten once capacity events were recorded. Dumps are read
+    by flight_log.py.
 
-        return [self.get_scope(frame, frame.f_locals, "Locals", False), self.get_scope(frame, frame.f_globals, "Globals", True)]
+    Each slot also holds sequence number of its event, -1 while the event is written,
+    so dumps taken while threads record leave out slots written meanwhile.
 
-    def get_scope(self, f, scope_dict, name, expensive):
+    Dump file is RECORDER_MAGIC, 4 byte length and json header with codes, threads and
+    event count, followed by the arrays of dumped events in chronological order, each
+    written as whole in native byte order (header says which).
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # id() of code object -> (code id, code name), id -> (filename, name, first line) and back
+        # code objects are not kept alive, name guards against id reused by another code object
+        self.code_ids = {}
+        self.code_info = []
+        self.info_ids = {}
+        self.codes = array.array("i", [0]) * capacity
+        self.lines = array.array("i", [0]) * capacity
+        self.events = array.array("b", [0]) * capacity
+        self.threads = array.array("i", [0]) * capacity
+        self.times = array.array("d", [0.0]) * capacity
+        # sequence number of event in each slot, doubles hold it exactly and fit python 2 too
+        self.sequences = array.array("d", [-1.0]) * capacity
+        # next() is atomic, so threads never get same sequence number
+        self.counter = itertools.count()
+        # guards interning and dumps
+        self.lock = threading.Lock()
+        # thread id -> its trace function
+        self.tracers = {}
+
+    def tracer(self, thread_id):
         """
-        returns information about scope to DAP
+        returns trace function recording events of thread thread_id
+
+        everything it needs is bound to locals of the closure, so each event costs
+        single call without attribute lookups
         """
 
-        scope_id = self.scope_var_id
-        self.scope_assign[scope_id] = (scope_dict, None, None, None)
-        self.scope_var_id += 1
+        record = self.tracers.get(thread_id)
+        if record is not None:
+            return record
+
+        codes, lines, events, threads, times = self.codes, self.lines, self.events, self.threads, self.times
+        sequences = self.sequences
+        code_ids = self.code_ids
+        intern = self.intern
+        counter = self.counter
+        capacity = self.capacity
+        event_ids = RECORDER_EVENTS
+        clock = time.time
+
+        def record(frame, event, arg):
+            code = frame.f_code
+            interned = code_ids.get(id(code))
+            if interned is not None and interned[1] is code.co_name:
+                code_id = interned[0]
+            else:
+                code_id = intern(code)
+
+            sequence = next(counter)
+            index = sequence % capacity
+            sequences[index] = -1
+            codes[index] = code_id
+            lines[index] = frame.f_lineno
+            events[index] = event_ids[event]
+            threads[index] = thread_id
+            times[index] = clock()
+            sequences[index] = sequence
+
+        self.tracers[thread_id] = record
+        return record
+
+    def intern(self, code):
+        """
+        returns id of code, assigning new one if code with its filename, name and first line has none
+        """
 
-        return {
-            "name": name,
-            "variablesReference": scope_id,
-            "expensive": expensive,
-            "namedVariables": len(scope_dict.keys())
-        }
+        info = (code.co_filename, code.co_name, code.co_firstlineno)
+        with self.lock:
+            code_id = self.info_ids.get(info)
+            if code_id is None:
+                code_id = len(self.code_info)
+                self.code_info.append(info)
+                self.info_ids[info] = code_id
+            self.code_ids[id(code)] = (code_id, code.co_name)
+        return code_id
+
+    def forget_codes(self):
+        """
+        forgets ids of recorded code objects, code with same name and place keeps its id
+        """
 
-    def format_variable(self, variablesReference, filter=None, start=None, count=None, format=None):
+        # cleared in place, tracers hold the dict
+        self.code_ids.clear()
+
+    def dump(self, path, seconds, thread_names):
         """
-        formats variable and any components for variablesReference in DAP format
+        writes events of last seconds (all if None) into file path, returning number of events written
         """
 
-        # format is ignored, TODO?
+        with self.lock:
+            code_info = list(self.code_info)
+
+        # each column is copied at once, slots whose sequence changed meanwhile may be torn
+        sequences = self.sequences[:]
+        columns = [self.codes[:], self.lines[:], self.events[:], self.threads[:], self.times[:]]
+        written = self.sequences[:]
+
+        # only latest event of each slot is kept, in ring order they follow in sequence
+        last = int(max(written))
+        oldest = max(last - self.capacity, -1)
+        start = (last + 1) % self.capacity
+        times = columns[-1]
+        cutoff = None if seconds is None else time.time() - seconds
+        kept = [index for index in itertools.chain(range(start, self.capacity), range(start))
+                if sequences[index] == written[index] > oldest and (cutoff is None or times[index] >= cutoff)]
+
+        header = {
+            "codes": code_info,
+            "threads": dict((str(k), v) for k, v in thread_names.items()),
+            "events": len(kept),
+            "byteorder": sys.byteorder
+        }
+        data = json.dumps(header).encode("utf-8")
 
-        vs = None if start is None or start == 0 else start
-        es = None if count is None or count == 0 else count
+        with open(path, "wb") as f:
+            f.write(RECORDER_MAGIC)
+            f.write(struct.pack("<I", len(data)))
+            f.write(data)
+            for column in columns:
+                array.array(column.typecode, [column[index] for index in kept]).tofile(f)
 
-        var, name, tt, parent = self.scope_assign[variablesReference]
+        return len(kept)
 
-        # print(str(var) + ", " + str(name) + ", " + str(tt))
 
-        is_slotted = False
+def _dump_recording_on_exception(function, path):
+    """
+    wraps exception reporting function to dump flight recorder into path first
+    """
 
-        if not isinstance(var, dict) and not isinstance(var, list):
-            if hasattr(var, "__dict__"):
-                var = var.__dict__
-            else:
-                is_slotted = True
+    def report(*args, **kwargs):
+        if debugger.recorder is not None:
+            # dumping must not be recorded itself
+            trace = sys.gettrace()
+            sys.settrace(None)
+            try:
+                debugger.dump_recording(path)
+            except Exception:
+                log.exception("Failed to dump flight recorder into %s", path)
+            finally:
+                sys.settrace(trace)
+        return function(*args, **kwargs)
+    return report
 
-        # print (str(var))
 
-        if not is_slotted and isinstance(var, dict):
-            if filter is not None and filter == "indexed":
-                return []
-            keys = sorted(var.keys())
-        elif not is_slotted:
-            if filter is not None and filter == "named":
-                return []
-            keys = range(len(var))
-        elif is_slotted:
-            keys = dir(var)
+CHANNEL_HEADER = struct.Struct("<8sQQQ")
+"""
+header of output channel file: magic, capacity of data area, sequence, total number of bytes written
+"""
 
-        if "self" in keys:
-            keys.remove("self")
-            keys = ["self"] + keys
+CHANNEL_MAGIC = b"RPYDBCH2"
 
-        # print (str(keys))
+CHANNEL_RECORD = struct.Struct("<I")
+"""
+length prefix of output channel record
+"""
 
-        it = 0
-        total = 0
-        variables = []
-        for vkey in keys:
-            if vs is None or it >= vs:
-                var_ref = self.scope_var_id
-                if is_slotted:
-                    value = getattr(var, vkey)
-                else:
-                    value = var[vkey]
+CHANNEL_CAPACITY = 1 << 20
+"""
+size of data area of output channel in bytes
+"""
 
-                vardesc = {}
-                variables.append(vardesc)
-
-                vardesc["name"] = vkey
-                vardesc["value"] = str(value)
-                vardesc["type"] = str(type(value))
-                # vardesc["presentationHint"] # TODO!!!
-                vardesc["evaluateName"] = vkey
-                vardesc["variablesReference"] = var_ref
-
-                vv_inner = value
-                vv_slotted = False
-                if not isinstance(vv_inner, dict) and not isinstance(vv_inner, list):
-                    if hasattr(vv_inner, "__dict__"):
-                        vv_inner = vv_inner.__dict__
-                    else:
-                        vv_slotted = True
 
-                if not vv_slotted and isinstance(vv_inner, dict):
-                    vardesc["namedVariables"] = len(vv_inner.keys())
-                elif not vv_slotted:
-                    vardesc["indexedVariables"] = len(vv_inner)
-                else:
-                    vardesc["namedVariables"] = len(dir(vv_inner))
+class OutputChannel(object):
+    """
+    Memory mapped ring buffer carrying output to client on the same machine
 
-                self.scope_assign[var_ref] = (value, vkey, str(type(value)), var)
+    File starts with CHANNEL_HEADER, data area of capacity bytes follows. Each record is
+    length prefixed utf-8 json of output event body and may wrap around the end of data area.
+    Total written count is updated only after record is complete, so it always points to
+    record boundary. Game never waits for client, client which falls more than capacity
+    behind loses records and continues from written count.
 
-                self.scope_var_id += 1
-                total += 1
-            it += 1
-            if es is not None and total >= es:
-                break
+    Sequence is odd while record is being written and even otherwise (seqlock), client
+    reading records while sequence changed reads them again, since they may have been
+    overwritten halfway.
+    """
 
-        return variables
+    def __init__(self, path, capacity=CHANNEL_CAPACITY):
+        self.capacity = capacity
+        self.written = 0
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+        with open(path, "w+b") as f:
+            f.truncate(CHANNEL_HEADER.size + capacity)
+            self.map = mmap.mmap(f.fileno(), CHANNEL_HEADER.size + capacity)
+        CHANNEL_HEADER.pack_into(self.map, 0, CHANNEL_MAGIC, capacity, 0, 0)
 
-    def break_code(self, breakpoint):
+    def write(self, body):
         """
-        breaks code at breakpoint
+        appends record with body, records larger than whole data area are dropped
         """
 
-        self.cont = False
-        self.pause_reason = "breakpoint"
-        self.scope_assign = {}
-        self.scope_var_id = 0
-        handler.send_breakpoint_event(breakpoint)
+        data = json.dumps(body).encode("utf-8")
+        record = CHANNEL_RECORD.pack(len(data)) + data
+        if len(record) > self.capacity:
+            return
+
+        with self.lock:
+            self.sequence += 1
+            CHANNEL_HEADER.pack_into(self.map, 0, CHANNEL_MAGIC, self.capacity, self.sequence, self.written)
+            start = self.written % self.capacity
+            first = min(len(record), self.capacity - start)
+            offset = CHANNEL_HEADER.size + start
+            self.map[offset:offset + first] = record[:first]
+            if first < len(record):
+                self.map[CHANNEL_HEADER.size:CHANNEL_HEADER.size + len(record) - first] = record[first:]
+            self.written += len(record)
+            self.sequence += 1
+            CHANNEL_HEADER.pack_into(self.map, 0, CHANNEL_MAGIC, self.capacity, self.sequence, self.written)
 
 
 def wait_for_connection(no_wait):
@@ -761,14 +4111,56 @@ def wait_for_connection(no_wait):
         time.sleep(0.1)  # spinlock
 
 
+ATTACHED_MODULE = "_renpy_debugger_module"
+"""
+attribute of sys holding module which attached debugger
+
+renpy's reload runs python early blocks again, which may import this module again and
+call attach again. The attribute survives that, so debugging continues in the module which
+attached first, its server keeps the client connection and its globals stay alive
+"""
+
+
+def reattach():
+    """
+    called instead of attach when renpy reloaded its scripts
+    """
+
+    for breakpoint in debugger.reload():
+        handler.send_breakpoint_changed(breakpoint)
+
+
 def attach():
     global debugger, handler
-    # initializes and enables debugging
+    # initializes and enables debugging, reload of renpy scripts only updates debugging state
+
+    attached = getattr(sys, ATTACHED_MODULE, None)
+    if attached is not None:
+        attached.reattach()
+        return
+    setattr(sys, ATTACHED_MODULE, sys.modules[__name__])
+    log.configure(os.environ.get("RENPY_DEBUGGER_LOG", None), os.environ.get("RENPY_DEBUGGER_LOG_LEVEL", None))
+
+    socket_path = os.environ.get("RENPY_DEBUGGER_SOCKET", None)
+    channel_path = os.environ.get("RENPY_DEBUGGER_CHANNEL", None)
 
     debugger = RenpyPythonDebugger()
-    handler = DebugAdapterProtocolServer()
+    handler = DebugAdapterProtocolServer(socket_path=socket_path,
+                                         channel=OutputChannel(channel_path) if channel_path else None)
 
     # TODO
     no_wait = "RENPY_DEBUGGER_NOWAIT" in os.environ and os.environ["RENPY_DEBUGGER_NOWAIT"] == "True"
+    debugger.pause_all = "RENPY_DEBUGGER_PAUSE_ALL" not in os.environ or os.environ["RENPY_DEBUGGER_PAUSE_ALL"] != "False"
+    if "RENPY_DEBUGGER_RECORD" in os.environ:
+        debugger.set_recording(int(os.environ["RENPY_DEBUGGER_RECORD"]) or None)
+    if "RENPY_DEBUGGER_RECORD_DUMP" in os.environ:
+        # uncaught exceptions and errors reported by renpy dump the recording
+        dump_path = os.environ["RENPY_DEBUGGER_RECORD_DUMP"]
+        sys.excepthook = _dump_recording_on_exception(sys.excepthook, dump_path)
+        try:
+            import renpy.error
+            renpy.error.report_exception = _dump_recording_on_exception(renpy.error.report_exception, dump_path)
+        except (ImportError, AttributeError):
+            pass
     debugger.attach()
     wait_for_connection(no_wait)
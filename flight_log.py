@@ -0,0 +1,96 @@
+from __future__ import print_function
+
+import sys
+import json
+import struct
+import array
+import argparse
+
+MAGIC = b"RPYDBFR1"
+EVENTS = ["call", "line", "return", "exception"]
+CALL, LINE, RETURN, EXCEPTION = range(4)
+
+
+def read_log(path):
+    """
+    reads flight recorder dump, returning its header and list of events (code id, line, event, thread id, time)
+    """
+
+    with open(path, "rb") as log:
+        if log.read(len(MAGIC)) != MAGIC:
+            raise ValueError("not a renpy debugger flight recorder dump")
+        length = struct.unpack("<I", log.read(4))[0]
+        header = json.loads(log.read(length).decode("utf-8"))
+
+        columns = []
+        for typecode in ("i", "i", "b", "i", "d"):
+            column = array.array(typecode)
+            column.fromfile(log, header["events"])
+            if header["byteorder"] != sys.byteorder:
+                column.byteswap()
+            columns.append(column)
+
+    return header, list(zip(*columns))
+
+
+def replay(header, events, thread=None, calls_only=False, out=sys.stdout):
+    """
+    prints call tree with line history of every thread, returns number of events printed
+
+    dump starts in the middle of execution and frames which were already running when recording
+    started have no call or return events, so stack of each thread is rebuilt from code of events:
+    line event of code deeper in the stack returns to it, line event of unknown code is its bottom.
+    Return of unknown code is ignored, it has no frame in the stack to pop.
+    """
+
+    codes = header["codes"]
+    start = events[0][4] if events else 0
+
+    thread_ids = sorted(set(e[3] for e in events)) if thread is None else [thread]
+    printed = 0
+    for thread_id in thread_ids:
+        print("thread %s (%s)" % (str(thread_id), header["threads"].get(str(thread_id), "exited")), file=out)
+
+        stack = []
+        for code_id, line, event, event_thread, timestamp in events:
+            if event_thread != thread_id:
+                continue
+
+            if event == CALL:
+                stack.append(code_id)
+            elif event == RETURN and code_id not in stack:
+                continue
+            elif code_id in stack:
+                del stack[len(stack) - stack[::-1].index(code_id):]
+            else:
+                stack.insert(0, code_id)
+
+            filename, name, first_line = codes[code_id]
+            if event == CALL:
+                text = "call %s (%s:%s)" % (name, filename, str(first_line))
+            elif event == LINE:
+                text = "line %s" % str(line)
+            elif event == RETURN:
+                text = "return from %s at line %s" % (name, str(line))
+            else:
+                text = "exception in %s at line %s" % (name, str(line))
+
+            if not calls_only or event == CALL:
+                print("%12.6f %s%s" % (timestamp - start, "  " * (len(stack) - 1), text), file=out)
+                printed += 1
+
+            if event == RETURN:
+                stack.pop()
+
+    return printed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prints call tree and line history from flight recorder dump of debugged renpy game")
+    parser.add_argument("dump", help="flight recorder dump")
+    parser.add_argument("--thread", type=int, help="print only thread with this id")
+    parser.add_argument("--calls", action="store_true", help="print only calls, without line history")
+    args = parser.parse_args()
+
+    header, events = read_log(args.dump)
+    replay(header, events, args.thread, args.calls)
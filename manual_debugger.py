@@ -1,91 +1,583 @@
 from __future__ import print_function
 
-import os
 import sys
 import threading
 import socket
+import select
+import errno
 import json
+import mmap
+import struct
+import argparse
 import readline
 import traceback
-import time
 
-from librpydb.debugger import *
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
 from librpydb.baseconf import DEBUGGER_PORT as debugger_port
 from librpydb.utils import get_input
 
 
-renpy_debugger = RenpyDebugger("127.0.0.1", debugger_port)
-execution_paused_state = None
-execution_threads = []
-executed_thread = None
-executed_stack_frames = None
-executed_stack_frame = None
-showing_variables = None
+class DebuggerState(object):
+    """
+    Connection state enum
+    """
+
+    NOT_CONNECTED = 0
+    CONNECTING = 1
+    CONNECTED = 2
 
 
-def connected(*args, **kwargs):
-    print("Connected!")
+class DAPConnection(object):
+    """
+    Non-blocking connection to debugged game
 
+    Requests are appended to outgoing buffer and written whenever socket is writable,
+    so any number of requests can be in flight at once. Responses are dispatched to
+    callbacks of their requests, events to event callback.
+    """
 
-def disconnected(*args, **kwargs):
-    global execution_paused_state
-    print("Disconnected!")
-    execution_paused_state = None
+    def __init__(self, address, event_callback, closed_callback):
+        if isinstance(address, tuple):
+            self.socket = socket.create_connection(address, 5)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            # unix domain socket path
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(address)
+        self.socket.setblocking(False)
 
+        self.event_callback = event_callback
+        self.closed_callback = closed_callback
 
-def paused(stop_reason, description, exc):
-    class IThread(threading.Thread):
-        def run(self):
-            global execution_paused_state, execution_threads, executed_thread, executed_stack_frames, executed_stack_frame
-            execution_paused_state = exc
-            execution_threads = exc.get_threads()
-            executed_thread = execution_threads[0]
-            executed_stack_frames = executed_thread.get_stack_frames()
-            executed_stack_frame = executed_stack_frames[0]
+        self.seq = 0
+        # request seq -> callback of response
+        self.callbacks = {}
+        self.incoming = b""
+        self.outgoing = b""
 
-    t = IThread()
-    t.start()
-    print("Paused for %s (%s)" % (stop_reason, description))
+    def fileno(self):
+        return self.socket.fileno()
 
+    def wants_write(self):
+        return len(self.outgoing) > 0
 
-def client_error(*args, **kwargs):
-    pass
+    def request(self, command, arguments=None, callback=None):
+        """
+        queues request, callback is called with response once it arrives
+        """
 
+        self.seq += 1
+        message = {"seq": self.seq, "type": "request", "command": command}
+        if arguments is not None:
+            message["arguments"] = arguments
+        data = json.dumps(message).encode("utf-8")
+        self.outgoing += ("Content-Length: %s\r\n\r\n" % str(len(data))).encode("ascii") + data
+        self.callbacks[self.seq] = callback
+        return self.seq
 
-# setting callbacks
-renpy_debugger.set_connected_callback(connected)
-renpy_debugger.set_disconnected_callback(disconnected)
-renpy_debugger.set_client_error_callback(client_error)
-renpy_debugger.set_pause_callback(paused)
+    def write(self):
+        """
+        writes as much of outgoing buffer as socket accepts
+        """
 
+        try:
+            sent = self.socket.send(self.outgoing)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.close()
+            return
+        self.outgoing = self.outgoing[sent:]
 
-while True:
-    try:
-        data = get_input(">>> ")
-        print("")
+    def read(self):
+        """
+        reads available data and dispatches every complete message in it
+        """
+
+        try:
+            data = self.socket.recv(65536)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = b""
+
+        if not data:
+            self.close()
+            return
+
+        self.incoming += data
+        while True:
+            header_end = self.incoming.find(b"\r\n\r\n")
+            if header_end < 0:
+                return
+
+            length = None
+            for header in self.incoming[:header_end].split(b"\r\n"):
+                name, _, value = header.partition(b":")
+                if name.strip().lower() == b"content-length":
+                    length = int(value.strip())
+            start = header_end + 4
+            if length is None or len(self.incoming) < start + length:
+                return
+
+            body = self.incoming[start:start + length]
+            self.incoming = self.incoming[start + length:]
+            self.dispatch(json.loads(body.decode("utf-8")))
+
+    def dispatch(self, message):
+        if message["type"] == "response":
+            callback = self.callbacks.pop(message["request_seq"], None)
+            if callback is not None:
+                callback(message)
+        elif message["type"] == "event":
+            self.event_callback(message)
+
+    def close(self):
+        if self.socket is None:
+            return
+        self.socket.close()
+        self.socket = None
+        self.closed_callback()
+
+
+CHANNEL_HEADER = struct.Struct("<8sQQQ")
+CHANNEL_MAGIC = b"RPYDBCH2"
+CHANNEL_RECORD = struct.Struct("<I")
+# reads of records overlapping writes of game are retried this many times before next poll
+CHANNEL_READ_ATTEMPTS = 8
+
+
+class ChannelReader(object):
+    """
+    Reads output from memory mapped channel of debugged game (RENPY_DEBUGGER_CHANNEL)
+
+    See OutputChannel in debugger.py for the format
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.capacity, _, self.position = CHANNEL_HEADER.unpack_from(self.map, 0)
+        if magic != CHANNEL_MAGIC:
+            raise ValueError("%s is not debugger output channel" % path)
+
+    def header(self):
+        """
+        returns sequence and written count of the channel
+        """
+
+        return CHANNEL_HEADER.unpack_from(self.map, 0)[2:]
+
+    def read_bytes(self, position, length):
+        start = CHANNEL_HEADER.size + position % self.capacity
+        first = min(length, CHANNEL_HEADER.size + self.capacity - start)
+        data = self.map[start:start + first]
+        if first < length:
+            data += self.map[CHANNEL_HEADER.size:CHANNEL_HEADER.size + length - first]
+        return data
+
+    def read(self):
+        """
+        returns list of output event bodies written since last read and whether any were lost
+
+        records are read between two reads of sequence, if game wrote meanwhile they may be torn
+        and are read again. If game keeps writing, nothing is returned until next read.
+        Raises ValueError if channel holds record that is not valid, resync skips it.
+        """
+
+        for _ in range(CHANNEL_READ_ATTEMPTS):
+            sequence, written = self.header()
+            if sequence % 2 == 1:
+                # game is writing record
+                continue
+
+            position = self.position
+            if written < position:
+                # game was restarted, channel starts from beginning
+                position = 0
+
+            lost = False
+            if written - position > self.capacity:
+                lost = True
+                position = written
+
+            records = []
+            while position < written:
+                length = CHANNEL_RECORD.unpack(self.read_bytes(position, CHANNEL_RECORD.size))[0]
+                if length > written - position - CHANNEL_RECORD.size:
+                    # torn length, unless sequence is unchanged
+                    break
+                records.append(self.read_bytes(position + CHANNEL_RECORD.size, length))
+                position += CHANNEL_RECORD.size + length
+
+            if self.header()[0] != sequence:
+                continue
+            if position != written:
+                raise ValueError("Output channel record at %s is not valid" % str(position))
+
+            self.position = position
+            return [json.loads(data.decode("utf-8")) for data in records], lost
+
+        return [], False
+
+    def resync(self):
+        """
+        skips everything written so far, reading continues with next record written
+        """
+
+        self.position = self.header()[1]
+
+
+class ManualDebugger(object):
+    """
+    Text user interface debugger
+
+    Single event loop owns the connection. Whenever game pauses, threads, stack of paused
+    thread, scopes of its top frame and their variables arrive in pause snapshot pushed
+    with stopped event (or are requested in pipelined bursts if it is missing) and are
+    cached, so commands answer from the cache. Commands asking for data still in
+    flight are deferred until it arrives.
+    """
+
+    def __init__(self, address, channel_path=None):
+        # (host, port) or unix domain socket path
+        self.address = address
+        self.channel_path = channel_path
+        self.channel = None
+
+        self.state = DebuggerState.NOT_CONNECTED
+        self.connection = None
+        # breakpoints set by user, list of (source, line, log message or None)
+        self.breakpoints = []
+        # function and label breakpoints set by user, list of names
+        self.function_breakpoints = []
+        # sources sent to game, so removed breakpoints are cleared there too
+        self.synced_sources = set()
+
+        # commands read from input, with event set once command is executed
+        self.commands = Queue()
+
+        self.generation = 0
+        self.reset_pause()
+
+    def reset_pause(self):
+        """
+        drops all cached state of paused game, data requested earlier is not cached anymore
+        """
+
+        self.generation += 1
+        # thread which paused, None while game runs
+        self.paused_thread = None
+        # thread and frame commands work with
+        self.selected_thread = None
+        self.selected_frame = None
+        self.threads = None
+        # thread id -> stack frames
+        self.stacks = {}
+        # frame id -> scopes
+        self.scopes = {}
+        # variables reference -> variables
+        self.variables = {}
+        # requests in flight, so same data is never requested twice
+        self.fetching = set()
+        # list of (ready, action), action is run once ready returns True
+        self.deferred = []
+        # variables (or scopes) listed last, v # expands them
+        self.showing_variables = None
+
+    def run(self):
+        """
+        event loop, runs until input ends
+        """
+
+        reader = threading.Thread(target=self.read_commands, name="input")
+        reader.daemon = True
+        reader.start()
+
+        while True:
+            if self.connection is not None:
+                wlist = [self.connection] if self.connection.wants_write() else []
+                readable, writable, _ = select.select([self.connection], wlist, [], 0.05)
+                # output written to channel before messages arrived is shown first
+                if self.channel is not None:
+                    self.read_channel()
+                if writable and self.connection is not None:
+                    self.connection.write()
+                if readable and self.connection is not None:
+                    self.connection.read()
+            else:
+                select.select([], [], [], 0.05)
+
+            self.run_deferred()
+
+            while True:
+                try:
+                    command, executed = self.commands.get_nowait()
+                except Empty:
+                    break
+
+                if command is None:
+                    return
+                try:
+                    self.execute(command)
+                except BaseException:
+                    print("Oops, something went wrong.")
+                    traceback.print_exc()
+                executed.set()
+
+    def read_commands(self):
+        """
+        reads commands from input, waiting until each is executed before prompting for next one
+        """
+
+        while True:
+            try:
+                data = get_input(">>> ")
+            except (EOFError, KeyboardInterrupt):
+                self.commands.put((None, None))
+                return
+            print("")
+
+            executed = threading.Event()
+            self.commands.put((data.strip(), executed))
+            executed.wait()
+
+    def request(self, command, arguments=None, callback=None, failure=None):
+        """
+        sends request, callback gets response body if request succeeds, failure gets message if it fails
+        """
+
+        def on_response(response):
+            if not response.get("success", False):
+                message = response.get("message", "")
+                print("Request %s failed: %s" % (command, message))
+                if failure is not None:
+                    failure(message)
+                return
+            if callback is not None:
+                callback(response.get("body", {}))
+
+        self.connection.request(command, arguments, on_response)
+
+    def when(self, ready, action):
+        """
+        runs action now if ready returns True, otherwise once it does
+        """
+
+        if ready():
+            action()
+        else:
+            self.deferred.append((ready, action))
+
+    def run_deferred(self):
+        deferred = self.deferred
+        self.deferred = []
+        for ready, action in deferred:
+            self.when(ready, action)
+
+    def abort_deferred(self, command):
+        """
+        runs deferred actions which are ready, aborting the rest, called when request command failed
+
+        data deferred actions wait for may never arrive once any fetch failed
+        """
+
+        deferred = self.deferred
+        self.deferred = []
+        for ready, action in deferred:
+            if ready():
+                action()
+            else:
+                print("Command aborted, %s failed" % command)
+
+    ###########
+    # Events
+    ###########
+
+    def on_event(self, message):
+        event = message["event"]
+        body = message.get("body", {})
+
+        if event == "initialized":
+            # opt in to receive pause snapshot with each stopped event
+            self.request("pauseSnapshot", {"push": True})
+            self.sync_breakpoints()
+            self.request("configurationDone")
+            self.request("launch", {}, self.on_launched)
+        elif event == "stopped":
+            self.on_stopped(body)
+        elif event == "output":
+            self.on_output(body)
+        elif event == "thread":
+            print("Thread %s %s" % (str(body["threadId"]), body["reason"]))
+            self.threads = None
+            if ("threads",) in self.fetching:
+                # list in flight is stale, answer of request sent now arrives after it and replaces it
+                self.fetching.discard(("threads",))
+                self.fetch_threads()
+        elif event == "breakpoint":
+            breakpoint = body["breakpoint"]
+            if breakpoint["verified"] and "source" in breakpoint:
+                print("Breakpoint %s now at %s, line %s" % (str(breakpoint["id"]), breakpoint["source"]["path"], str(breakpoint["line"])))
+
+    def on_output(self, body):
+        sys.stdout.write(body["output"])
+
+    def read_channel(self):
+        try:
+            bodies, lost = self.channel.read()
+        except Exception as e:
+            print("Output channel unreadable (%s), skipping to latest output" % str(e))
+            self.channel.resync()
+            return
+        if lost:
+            print("Output channel overrun, some output was lost")
+        for body in bodies:
+            self.on_output(body)
+
+    def on_launched(self, body):
+        self.state = DebuggerState.CONNECTED
+        print("Connected!")
+
+    def on_stopped(self, body):
+        self.reset_pause()
+        self.paused_thread = body.get("threadId", 0)
+        self.selected_thread = self.paused_thread
+        print("Paused for %s (%s)" % (body["reason"], body.get("description", "")))
+
+        if "pauseSnapshot" in body:
+            self.load_snapshot(body["pauseSnapshot"])
+            return
+
+        # first burst, threads and stack go together, top frame's scopes follow stack
+        self.fetch_threads()
+        self.fetch_stack(self.paused_thread, select_top=True)
 
-        if data == "xxx":
-            print(globals())
+    def load_snapshot(self, snapshot):
+        """
+        fills cache from pause snapshot pushed with stopped event, fetching only what it lacks
+        """
 
+        self.threads = snapshot["threads"]
+        frames = snapshot.get("stackFrames")
+        if not frames:
+            self.fetch_stack(self.paused_thread, select_top=True)
+            return
+
+        self.stacks[self.paused_thread] = frames
+        self.selected_frame = frames[0]
+        self.scopes[self.selected_frame["id"]] = snapshot["scopes"]
+        for scope in snapshot["scopes"]:
+            variables = scope.get("variables")
+            if variables is not None and len(variables) >= scope.get("namedVariables", 0):
+                self.variables[scope["variablesReference"]] = variables
+
+    def on_closed(self):
+        print("Disconnected!")
+        self.connection = None
+        self.state = DebuggerState.NOT_CONNECTED
+        self.reset_pause()
+        if self.channel is not None:
+            self.read_channel()
+            self.channel = None
+
+    ##############
+    # Prefetch
+    ##############
+
+    def fetch(self, key, command, arguments, store):
+        """
+        requests data for key unless it is cached or already in flight
+
+        data arriving after game resumed is dropped. If request fails, key can be fetched again
+        and deferred commands are aborted.
+        """
+
+        if key in self.fetching:
+            return
+        self.fetching.add(key)
+
+        generation = self.generation
+
+        def store_current(body):
+            if generation == self.generation:
+                store(body)
+
+        def failed(message):
+            if generation == self.generation:
+                self.fetching.discard(key)
+                self.abort_deferred(command)
+        self.request(command, arguments, store_current, failed)
+
+    def fetch_threads(self):
+        def store(body):
+            self.threads = body["threads"]
+        self.fetch(("threads",), "threads", None, store)
+
+    def fetch_stack(self, thread_id, select_top=False):
+        def store(body):
+            frames = body["stackFrames"]
+            self.stacks[thread_id] = frames
+            if select_top and len(frames) > 0:
+                self.select_frame(frames[0])
+        self.fetch(("stack", thread_id), "stackTrace", {"threadId": thread_id}, store)
+
+    def select_frame(self, frame):
+        self.selected_frame = frame
+        self.fetch_scopes(frame["id"])
+
+    def fetch_scopes(self, frame_id):
+        def store(body):
+            scopes = body["scopes"]
+            self.scopes[frame_id] = scopes
+            for scope in scopes:
+                if not scope.get("expensive", False):
+                    self.fetch_variables(scope["variablesReference"])
+        self.fetch(("scopes", frame_id), "scopes", {"frameId": frame_id}, store)
+
+    def fetch_variables(self, reference):
+        def store(body):
+            self.variables[reference] = body["variables"]
+        self.fetch(("variables", reference), "variables", {"variablesReference": reference}, store)
+
+    #############
+    # Commands
+    #############
+
+    def is_paused(self):
+        return self.state == DebuggerState.CONNECTED and self.paused_thread is not None
+
+    def execute(self, data):
         # always active commands
         if data == "h" or data == "help":
             #########
             # Help
             #########
             print("Available commands:")
-            print("connect - connects to debugged renpy game on port 14711")
+            print("connect - connects to debugged renpy game at %s" % str(self.address))
             print("  will automatically sync breakpoints")
             print("disconnect - stops debugging, but can still be attached later")
             print("b - sets the breakpoint: b game/script.rpy:10")
-            print("rb - removes breakpoint - arguments can be source, source:line or nothing -> removes all")
+            print("fb - sets the function breakpoint: fb module.function or fb label:name")
+            print("lp - sets the logpoint, logging message with {expressions}: lp game/script.rpy:10 x is {x}")
+            print("rb - removes breakpoint - arguments can be source, source:line, function name or nothing -> removes all")
             print("lb - lists breakpoints")
             print("sb - synchronized breakpoints")
-            print("threads - lists threads, renpy only supports thread 0")
-            print("bt - shows backtrace of thread")
+            print("threads - lists traced threads, main renpy thread is thread 0")
+            print("bt - bt [thread id] - shows backtrace of paused thread or thread with id")
             print("st - st # - switch to stack frame #")
-            # print("bytet - shows bytecode of current frame")
             print("scopes - shows scopes")
             print("v # - displays subfields of variable # or lists variables in scopes")
+            print("e - e expression - evaluates expression in current stack frame")
+            print("snap - snap path - exports snapshot of current stack frame into file path")
+            print("dis - dis [count] - disassembles instructions around current instruction of current stack frame")
+            print("gran - gran line|instruction - sets whether s and si step by lines or instructions")
+            print("rec - rec start [capacity] | rec stop | rec dump path [seconds] - controls flight recorder")
+            print("heap - heap collect [sample] | heap [size|count|growth] [page] - shows heap statistics, growth since previous collection")
             print("c - continue (with the) execution")
             print("p - pauses execution wherever it is")
             print("s - moves execution by next step")
@@ -93,24 +585,52 @@ while True:
             print("so - moves execution out of call")
             print("OK")
 
-
         elif data.startswith("b "):
             #######################
             # Install breakpoint
             #######################
             try:
-                file, line = data[2:].split(":")
-                renpy_debugger.add_breakpoint(Breakpoint(line, file))
+                source, line = data[2:].split(":")
+                self.add_breakpoint(source, int(line), None)
                 print("OK")
             except BaseException:
                 print("Failed to insert breakpoint, check syntax")
 
+        elif data.startswith("fb "):
+            ################################
+            # Install function breakpoint
+            ################################
+            name = data[3:].strip()
+            if name:
+                self.function_breakpoints.append(name)
+                print("Don't forget to 'sb' to synchronize breakpoints!")
+                print("OK")
+            else:
+                print("Failed to insert function breakpoint, check syntax")
+
+        elif data.startswith("lp "):
+            #######################
+            # Install logpoint
+            #######################
+            try:
+                location, message = data[3:].split(" ", 1)
+                source, line = location.split(":")
+                self.add_breakpoint(source, int(line), message)
+                print("OK")
+            except BaseException:
+                print("Failed to insert logpoint, check syntax")
+
         elif data == "lb":
             #####################
             # List breakpoints
             #####################
-            for breakpoint in renpy_debugger.breakpoints:
-                print("Breakpoint at %s, line %s" % (breakpoint.source, breakpoint.line))
+            for source, line, message in self.breakpoints:
+                if message is None:
+                    print("Breakpoint at %s, line %s" % (source, str(line)))
+                else:
+                    print("Logpoint at %s, line %s: %s" % (source, str(line), message))
+            for name in self.function_breakpoints:
+                print("Function breakpoint at %s" % name)
             print("OK")
 
         elif data.startswith("rb"):
@@ -118,197 +638,396 @@ while True:
             # Remove breakpoints
             #######################
             if data == "rb":
-                renpy_debugger.clear_breakpoints()
+                self.breakpoints = []
+                self.function_breakpoints = []
                 print("All breakpoints removed")
             else:
                 rest = data[3:]
                 if ":" in rest:
-                    file, line = rest.split(":")
-                    renpy_debugger.remove_breakpoint(Breakpoint(line, file))
+                    source, line = rest.split(":")
+                    self.breakpoints = [b for b in self.breakpoints if b[:2] != (source, int(line))]
                 else:
-                    renpy_debugger.remove_breakpoint_from_source(rest)
+                    self.breakpoints = [b for b in self.breakpoints if b[0] != rest]
+                    self.function_breakpoints = [name for name in self.function_breakpoints if name != rest]
             print("Don't forget to 'sb' to synchronize breakpoints!")
             print("OK")
 
-        elif renpy_debugger.get_state() == DebuggerState.NOT_CONNECTED:
+        elif self.state == DebuggerState.NOT_CONNECTED:
             # no connection commands
             if data == "connect":
                 #############################
                 # Connect to debugged game
                 #############################
                 print("Establishing connection")
-
-                try:
-                    renpy_debugger.connect()
-                except Exception:
-                    print("Failed. Is renpy debugged game running?")
-
+                self.connect()
                 print("OK")
 
+        elif self.state == DebuggerState.CONNECTING:
+            print("Not connected yet")
+
         else:
-            # connected
-            if data == "sb":
-                ############################
-                # Synchronize breakpoints
-                ############################
-                if renpy_debugger.get_state() == DebuggerState.CONNECTED or renpy_debugger.get_state() == DebuggerState.CONNECTING:
-                    print("Not connected")
-                else:
-                    renpy_debugger.sync_breakpoints()
-                    print("OK")
-
-            elif data == "threads" and execution_paused_state is not None and execution_paused_state.is_valid():
-                #################
-                # List threads
-                #################
-                execution_threads = execution_paused_state.get_threads()
-
-                print("Threads:")
-                it = 0
-                for renpy_thread in execution_threads:
-                    print("Threads #%s: %s" % (str(it), renpy_thread.get_thread_name()))
-                    it += 1
-                print("OK")
+            self.execute_connected(data)
 
-            elif data.startswith("bt") and execution_paused_state is not None and execution_paused_state.is_valid():
-                ###################
-                # Show backtrace
-                ###################
-                try:
-                    if data == "bt":
-                        thread_id = "0"
-                    else:
-                        thread_id = data[3:]
-                except BaseException:
-                    print("Failed to display bt, check syntax")
+    def execute_connected(self, data):
+        # connected
+        if data == "sb":
+            ############################
+            # Synchronize breakpoints
+            ############################
+            self.sync_breakpoints()
+            print("OK")
 
-                if int(thread_id) >= len(execution_threads):
-                    print("No thread %s available" % thread_id)
-                else:
-                    print("Backtrace for thread [%s]" % thread_id)
-                    executed_thread = execution_threads[int(thread_id)]
-                    executed_stack_frames = executed_thread.get_stack_frames()
-                    id = 0
-                    for st in executed_stack_frames:
-                        print("#%s: <%s:%s> %s " % (str(id), st.get_source(), str(st.get_line()), st.get_line_of_code()))
-                        id += 1
-                print("OK")
+        elif data == "disconnect":
+            ###############
+            # Disconnect
+            ###############
+            self.request("disconnect", {}, lambda body: self.connection.close())
+            print("OK")
 
+        elif data.startswith("rec "):
+            ####################
+            # Flight recorder
+            ####################
+            self.record(data[4:].split())
 
-#             elif data.startswith("bytet") and state is not None:
-                #############################
-                # List bytecode for method
-                #############################
-#                st = state.stacks["0"][state.active_stack]
-#                print("Bytecode of stack frame #%s: <%s:%s> %s  " % (st.id, st.source, str(st.line), st.name))
-#                i = 0
-#                for bytecode in st.sselements:
-#                    if i == st.bytepos:
-#                        print("* ", end="")
-#                        print(bytecode)
-#                        i += 1
-#                print("OK")
-
-
-            elif (data == "st" or data.startswith("st ")) and executed_thread is not None and executed_thread.is_valid():
-                #######################
-                # Switch stack frame
-                #######################
-                stid = 0
-                if data == "st":
-                    stid = 0
-                else:
-                    try:
-                        stid = int(data[3:])
-                    except BaseException:
-                        print("Failed to set active stack frame, check syntax")
-                if stid >= len(executed_stack_frames):
-                    print("No such stack frame %s" % (str(stid)))
-                else:
-                    executed_stack_frame = executed_stack_frames[stid]
-                    executed_stack_frame.set_active()
-                    print("#%s: <%s:%s> %s " % (str(stid), executed_stack_frame.get_source(), str(executed_stack_frame.get_line()), executed_stack_frame.get_line_of_code()))
+        elif data == "heap" or data.startswith("heap "):
+            ####################
+            # Heap statistics
+            ####################
+            self.heap_statistics(data[5:].split())
+
+        elif data.startswith("gran "):
+            ######################
+            # Step granularity
+            ######################
+            def show(body):
+                print("Stepping by %s" % body["granularity"])
                 print("OK")
+            self.request("setStepGranularity", {"granularity": data[5:].strip()}, show)
 
-            elif data == "scopes" and executed_stack_frame is not None and executed_stack_frame.is_valid():
-                ###################
-                # Display locals, globas
-                ###################
+        elif data == "p":
+            ####################
+            # Pause execution
+            ####################
+            self.request("pause", {"threadId": 0})
+            print("OK")
 
-                showing_variables = executed_stack_frame.get_scopes()
-                it = 0
-                for v in showing_variables:
-                    print("#%s: %s (%s) - %s" % (str(it), v.get_name(), v.get_type(), v.get_value()))
-                    it += 1
-                print("OK")
+        elif not self.is_paused():
+            print("Not paused")
 
-            elif data.startswith("v "):
-                ###############################
-                # Display variable structure
-                ###############################
-                try:
-                    var_ref = int(data[2:])
-                except BaseException:
-                    print("Failed to get variable, check syntax")
+        elif data == "threads":
+            #################
+            # List threads
+            #################
+            self.fetch_threads()
+            self.when(lambda: self.threads is not None, self.print_threads)
+
+        elif data == "bt" or data.startswith("bt "):
+            ###################
+            # Show backtrace
+            ###################
+            try:
+                thread_id = self.paused_thread if data == "bt" else int(data[3:])
+            except BaseException:
+                print("Failed to display bt, check syntax")
+            else:
+                self.selected_thread = thread_id
+                self.fetch_stack(thread_id)
+                self.when(lambda: thread_id in self.stacks, lambda: self.print_stack(thread_id))
+
+        elif data == "st" or data.startswith("st "):
+            #######################
+            # Switch stack frame
+            #######################
+            try:
+                stid = 0 if data == "st" else int(data[3:])
+            except BaseException:
+                print("Failed to set active stack frame, check syntax")
+            else:
+                thread_id = self.selected_thread
+                self.fetch_stack(thread_id)
+                self.when(lambda: thread_id in self.stacks, lambda: self.switch_frame(thread_id, stid))
+
+        elif data == "scopes":
+            ###################
+            # Display locals, globas
+            ###################
+            self.when(lambda: self.selected_frame is not None and self.selected_frame["id"] in self.scopes, self.print_scopes)
+
+        elif data.startswith("v "):
+            ###############################
+            # Display variable structure
+            ###############################
+            try:
+                var_ref = int(data[2:])
+            except BaseException:
+                print("Failed to get variable, check syntax")
+            else:
+                if self.showing_variables is None or var_ref >= len(self.showing_variables):
+                    print("No such variable %s" % (str(var_ref)))
                 else:
-                    if var_ref >= len(showing_variables):
-                        print("No such variable %s" % (str(var_ref)))
-                    else:
-                        showing_variables = list(showing_variables[var_ref].get_components().values())
-                        it = 0
-                        for v in showing_variables:
-                            print("#%s: %s (%s) - %s" % (str(it), v.get_name(), v.get_type(), v.get_value()))
-                            it += 1
-                        print("OK")
-
-            elif data.startswith("c") and executed_thread is not None and executed_thread.is_valid():
-                #######################
-                # Continue execution
-                #######################
-                exct = executed_thread
-                executed_thread = None
-                exct.continue_execution()
-                print("OK")
+                    reference = self.showing_variables[var_ref]["variablesReference"]
+                    self.fetch_variables(reference)
+                    self.when(lambda: reference in self.variables, lambda: self.print_variables(reference))
 
-            elif data.startswith("p") and renpy_debugger.get_state() == DebuggerState.CONNECTED:
-                ####################
-                # Pause execution
-                ####################
-                renpy_debugger.pause()
-                print("OK")
+        elif data.startswith("e "):
+            ##########################
+            # Evaluate expression
+            ##########################
+            expression = data[2:]
+            self.when(lambda: self.selected_frame is not None, lambda: self.evaluate(expression))
 
-            elif data == "s" and executed_thread is not None and executed_thread.is_valid():
-                ###################
-                # Step execution
-                ###################
-                executed_thread.step()
-                print("OK")
+        elif data == "dis" or data.startswith("dis "):
+            ##################
+            # Disassemble
+            ##################
+            try:
+                count = 16 if data == "dis" else int(data[4:])
+            except BaseException:
+                print("Failed to disassemble, check syntax")
+            else:
+                self.when(lambda: self.selected_frame is not None, lambda: self.disassemble(count))
 
-            elif data == "si" and executed_thread is not None and executed_thread.is_valid():
-                ###################
-                # Step into exec
-                ###################
-                executed_thread.step_in()
-                print("OK")
+        elif data.startswith("snap "):
+            ######################
+            # Export snapshot
+            ######################
+            path = data[5:]
+            self.when(lambda: self.selected_frame is not None, lambda: self.export_snapshot(path))
 
-            elif data == "so" and executed_thread is not None and executed_thread.is_valid():
-                ##################
-                # Step out exec
-                ##################
-                executed_thread.step_out()
-                print("OK")
+        elif data == "c":
+            #######################
+            # Continue execution
+            #######################
+            self.resume("continue")
+            print("OK")
 
-            elif data == "disconnect" and renpy_debugger.get_state() != DebuggerState.NOT_CONNECTED:
-                ###############
-                # Disconnect
-                ###############
-                renpy_debugger.disconnect()
-                print("OK")
+        elif data == "s":
+            ###################
+            # Step execution
+            ###################
+            self.resume("next")
+            print("OK")
+
+        elif data == "si":
+            ###################
+            # Step into exec
+            ###################
+            self.resume("stepIn")
+            print("OK")
+
+        elif data == "so":
+            ##################
+            # Step out exec
+            ##################
+            self.resume("stepOut")
+            print("OK")
+
+    def connect(self):
+        try:
+            self.connection = DAPConnection(self.address, self.on_event, self.on_closed)
+        except Exception:
+            print("Failed. Is renpy debugged game running?")
+            return
+
+        if self.channel_path is not None:
+            try:
+                self.channel = ChannelReader(self.channel_path)
+            except Exception as e:
+                print("Failed to open output channel: %s" % str(e))
+
+        self.state = DebuggerState.CONNECTING
+        self.request("initialize", {"clientID": "manual_debugger", "adapterID": "renpy"})
+
+    def sync_breakpoints(self):
+        """
+        sends breakpoints of every source, including sources which had all breakpoints removed
+        """
+
+        sources = {}
+        for source, line, message in self.breakpoints:
+            breakpoint = {"line": line}
+            if message is not None:
+                breakpoint["logMessage"] = message
+            sources.setdefault(source, []).append(breakpoint)
+        for source in self.synced_sources:
+            sources.setdefault(source, [])
+
+        for source, breakpoints in sources.items():
+            self.request("setBreakpoints", {"source": {"path": source}, "breakpoints": breakpoints},
+                         self.breakpoints_synced(source, breakpoints))
+        self.synced_sources = set(source for source, breakpoints in sources.items() if breakpoints)
+
+        names = list(self.function_breakpoints)
+        self.request("setFunctionBreakpoints", {"breakpoints": [{"name": name} for name in names]},
+                     self.function_breakpoints_synced(names))
+
+    def function_breakpoints_synced(self, names):
+        """
+        returns callback reporting function breakpoints which game could not resolve yet
+        """
+
+        def show(body):
+            for name, result in zip(names, body["breakpoints"]):
+                if not result["verified"]:
+                    print("Function breakpoint at %s pending: %s" % (name, result.get("message", "")))
+        return show
+
+    def breakpoints_synced(self, source, requested):
+        """
+        returns callback reporting breakpoints of source which game moved or could not verify
+        """
+
+        def show(body):
+            for breakpoint, result in zip(requested, body["breakpoints"]):
+                if not result["verified"]:
+                    print("Breakpoint at %s, line %s not verified: %s" % (source, str(breakpoint["line"]), result.get("message", "")))
+                elif result.get("line", breakpoint["line"]) != breakpoint["line"]:
+                    print("Breakpoint at %s, line %s moved to line %s" % (source, str(breakpoint["line"]), str(result["line"])))
+        return show
+
+    def record(self, arguments):
+        def show(body):
+            if "events" in body:
+                print("Recording of %s events written to %s" % (str(body["events"]), body["path"]))
+            else:
+                print("Recording" if body["recording"] else "Not recording")
+            print("OK")
+
+        try:
+            if arguments[0] == "start":
+                self.request("setRecording", {"capacity": int(arguments[1])} if len(arguments) > 1 else {}, show)
+            elif arguments[0] == "stop":
+                self.request("setRecording", {"capacity": 0}, show)
+            elif arguments[0] == "dump":
+                dump = {"path": arguments[1]}
+                if len(arguments) > 2:
+                    dump["seconds"] = float(arguments[2])
+                self.request("dumpRecording", dump, show)
+            else:
+                raise ValueError(arguments[0])
+        except BaseException:
+            print("Failed to control flight recorder, check syntax")
+
+    def heap_statistics(self, arguments):
+        page_size = 20
+
+        def show(body):
+            print("%s objects, %s bytes in %s types (sample 1/%s, collected in %.2fs)" %
+                  (str(body["objects"]), str(body["size"]), str(body["types"]), str(body["sample"]), body["elapsed"]))
+            for entry in body["statistics"]:
+                line = "%10s %12s  %s" % (str(entry["count"]), str(entry["size"]), entry["type"])
+                if body["baseline"]:
+                    line += " (%+d objects, %+d bytes)" % (entry["countDelta"], entry["sizeDelta"])
+                print(line)
+            print("OK")
+
+        try:
+            if arguments and arguments[0] == "collect":
+                sample = int(arguments[1]) if len(arguments) > 1 else 1
+                print("Collecting heap statistics")
+                self.request("heapStatistics", {"refresh": True, "sample": sample, "count": page_size}, show)
+            else:
+                sort_by = arguments[0] if arguments else "size"
+                page = int(arguments[1]) if len(arguments) > 1 else 0
+                self.request("heapStatistics", {"refresh": False, "sortBy": sort_by,
+                                                "start": page * page_size, "count": page_size}, show)
+        except BaseException:
+            print("Failed to show heap statistics, check syntax")
+
+    def add_breakpoint(self, source, line, message):
+        """
+        adds breakpoint (or logpoint if message is set), replacing one at the same line
+        """
+
+        self.breakpoints = [b for b in self.breakpoints if b[:2] != (source, line)]
+        self.breakpoints.append((source, line, message))
+
+    def resume(self, command):
+        thread_id = self.selected_thread
+        self.reset_pause()
+        self.request(command, {"threadId": thread_id})
+
+    def print_threads(self):
+        print("Threads:")
+        for thread in self.threads:
+            print("Threads #%s: %s" % (str(thread["id"]), thread["name"]))
+        print("OK")
+
+    def print_stack(self, thread_id):
+        print("Backtrace for thread [%s]" % str(thread_id))
+        it = 0
+        for frame in self.stacks[thread_id]:
+            print("#%s: <%s:%s> %s " % (str(it), frame["source"]["path"], str(frame["line"]), frame["name"]))
+            it += 1
+        print("OK")
+
+    def switch_frame(self, thread_id, stid):
+        frames = self.stacks[thread_id]
+        if stid >= len(frames):
+            print("No such stack frame %s" % (str(stid)))
+        else:
+            frame = frames[stid]
+            self.select_frame(frame)
+            print("#%s: <%s:%s> %s " % (str(stid), frame["source"]["path"], str(frame["line"]), frame["name"]))
+        print("OK")
+
+    def print_scopes(self):
+        self.showing_variables = self.scopes[self.selected_frame["id"]]
+        it = 0
+        for scope in self.showing_variables:
+            print("#%s: %s (scope) - %s variables" % (str(it), scope["name"], str(scope.get("namedVariables", ""))))
+            it += 1
+        print("OK")
+
+    def print_variables(self, reference):
+        self.showing_variables = self.variables[reference]
+        it = 0
+        for v in self.showing_variables:
+            print("#%s: %s (%s) - %s" % (str(it), v["name"], v.get("type", ""), v["value"]))
+            it += 1
+        print("OK")
+
+    def evaluate(self, expression):
+        def show(body):
+            print("%s (%s)" % (body["result"], body.get("type", "")))
+            print("OK")
+        self.request("evaluate", {"expression": expression, "frameId": self.selected_frame["id"], "context": "repl"}, show)
+
+    def disassemble(self, count):
+        reference = self.selected_frame.get("instructionPointerReference")
+        if reference is None:
+            print("Stack frame has no instruction reference")
+            return
 
-    except BaseException as e:
-        if isinstance(e, KeyboardInterrupt):
-            traceback.print_exc()
-            break
+        def show(body):
+            for instruction in body["instructions"]:
+                if instruction.get("presentationHint") == "invalid":
+                    continue
+                if "symbol" in instruction:
+                    print("%s (%s):" % (instruction["symbol"], instruction["location"]["path"]))
+                print("%s %s %5s  %s" % ("=>" if instruction["address"] == reference else "  ", instruction["address"],
+                                         str(instruction["line"]), instruction["instruction"]))
+            print("OK")
+        self.request("disassemble", {"memoryReference": reference, "instructionOffset": -(count // 2),
+                                     "instructionCount": count}, show)
+
+    def export_snapshot(self, path):
+        def show(body):
+            print("Snapshot of %s values written to %s" % (str(body["values"]), body["path"]))
+            print("OK")
+        self.request("exportSnapshot", {"path": path, "frameId": self.selected_frame["id"]}, show)
 
-        print("Oops, something went wrong.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Text user interface debugger of renpy games")
+    parser.add_argument("--host", default="127.0.0.1", help="host of debugged game")
+    parser.add_argument("--port", type=int, default=debugger_port, help="port of debugged game")
+    parser.add_argument("--socket", help="unix domain socket of debugged game (RENPY_DEBUGGER_SOCKET), used instead of host and port")
+    parser.add_argument("--channel", help="output channel file of debugged game (RENPY_DEBUGGER_CHANNEL)")
+    args = parser.parse_args()
+
+    try:
+        ManualDebugger(args.socket if args.socket else (args.host, args.port), args.channel).run()
+    except KeyboardInterrupt:
         traceback.print_exc()
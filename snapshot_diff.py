@@ -0,0 +1,101 @@
+from __future__ import print_function
+
+import sys
+import gzip
+import json
+import argparse
+
+
+def read_header(snapshot):
+    """
+    reads json header line of opened snapshot
+    """
+
+    header = json.loads(snapshot.readline())
+    if header.get("format") != "rpysnapshot":
+        raise ValueError("not a renpy debugger snapshot")
+    return header
+
+
+def read_values(snapshot):
+    """
+    yields (path, rest of line) for every value in opened snapshot, after its header
+    """
+
+    for line in snapshot:
+        line = line.rstrip(b"\n")
+        path, _, rest = line.partition(b"\t")
+        yield path, rest
+
+
+def matches(path, prefix):
+    return prefix is None or path.startswith(prefix)
+
+
+def diff(old_path, new_path, prefix=None, out=sys.stdout):
+    """
+    prints differences between two snapshots, returns number of differences
+
+    old snapshot is loaded as path -> line, new snapshot is streamed against it,
+    values left unmatched are found by streaming old snapshot again, so output
+    keeps snapshot order and only one snapshot is held in memory
+    """
+
+    old = gzip.open(old_path, "rb")
+    try:
+        old_header = read_header(old)
+        old_values = dict((path, rest) for path, rest in read_values(old) if matches(path, prefix))
+    finally:
+        old.close()
+
+    differences = 0
+
+    new = gzip.open(new_path, "rb")
+    try:
+        new_header = read_header(new)
+        print("--- %s (%s:%s)" % (old_path, old_header["source"], old_header["line"]), file=out)
+        print("+++ %s (%s:%s)" % (new_path, new_header["source"], new_header["line"]), file=out)
+
+        for path, rest in read_values(new):
+            if not matches(path, prefix):
+                continue
+            old_rest = old_values.pop(path, None)
+            if old_rest is None:
+                differences += 1
+                print("+ %s: %s" % (path.decode("utf-8"), format_value(rest)), file=out)
+            elif old_rest != rest:
+                differences += 1
+                print("~ %s: %s -> %s" % (path.decode("utf-8"), format_value(old_rest), format_value(rest)), file=out)
+    finally:
+        new.close()
+
+    if old_values:
+        old = gzip.open(old_path, "rb")
+        try:
+            read_header(old)
+            for path, rest in read_values(old):
+                if path in old_values:
+                    differences += 1
+                    print("- %s: %s" % (path.decode("utf-8"), format_value(rest)), file=out)
+        finally:
+            old.close()
+
+    return differences
+
+
+def format_value(rest):
+    type_name, _, value = rest.decode("utf-8").partition("\t")
+    return "(%s) %s" % (type_name, value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares two snapshots exported from debugged renpy game")
+    parser.add_argument("old", help="older snapshot")
+    parser.add_argument("new", help="newer snapshot")
+    parser.add_argument("--prefix", help="compare only values under this path, ie. globals['persistent']")
+    args = parser.parse_args()
+
+    prefix = args.prefix.encode("utf-8") if args.prefix is not None else None
+    count = diff(args.old, args.new, prefix)
+    print("%s differences" % str(count))
+    sys.exit(1 if count > 0 else 0)
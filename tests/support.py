@@ -0,0 +1,97 @@
+import sys
+import threading
+import types
+import unittest
+
+import debugger
+
+
+class StandInHandler(object):
+    """
+    Stands in for DebugAdapterProtocolServer, handing every pause to pause_debugging
+
+    Pauses are resumed unless subclass answers them otherwise
+    """
+
+    def __init__(self):
+        # breakpoints reported changed
+        self.changed = []
+
+    def is_client_attached(self):
+        return True
+
+    def send_thread_event(self, reason, thread):
+        pass
+
+    def send_breakpoint_changed(self, breakpoint):
+        self.changed.append(breakpoint)
+
+    def send_output(self, output, category="console"):
+        pass
+
+    def send_breakpoint_event(self, thread, breakpoint):
+        self.pause_debugging(thread)
+
+    def pause_debugging(self, thread):
+        debugger.debugger.resume(thread.id)
+
+
+class DebuggerTestCase(unittest.TestCase):
+    """
+    Runs each test with fresh debugger, restoring the module's debugger, handler and tracing afterwards
+    """
+
+    def setUp(self):
+        self.saved = debugger.debugger, debugger.handler
+        debugger.debugger = debugger.RenpyPythonDebugger()
+
+    def tearDown(self):
+        sys.settrace(None)
+        threading.settrace(None)
+        debugger.debugger, debugger.handler = self.saved
+
+    def install_renpy_python(self, **attributes):
+        """
+        makes renpy.python importable as module with attributes until the test ends
+        """
+
+        renpy = types.ModuleType("renpy")
+        renpy.python = types.ModuleType("renpy.python")
+        for name, value in attributes.items():
+            setattr(renpy.python, name, value)
+
+        saved = dict((name, sys.modules.get(name)) for name in ("renpy", "renpy.python"))
+
+        def restore():
+            for name, module in saved.items():
+                if module is None:
+                    sys.modules.pop(name, None)
+                else:
+                    sys.modules[name] = module
+
+        sys.modules.update({"renpy": renpy, "renpy.python": renpy.python})
+        self.addCleanup(restore)
+
+    def break_at(self, function, line, condition=None):
+        """
+        sets breakpoint (with condition) at line of file of function
+        """
+
+        source = function.__code__.co_filename
+        debugger.debugger.set_source_breakpoints(source, [debugger.Breakpoint(source, line, eval_condition=condition)])
+
+    def run_traced(self, handler, function):
+        """
+        runs function traced in current thread, pauses answered by handler
+
+        returns the handler
+        """
+
+        debugger.handler = handler
+        thread = debugger.debugger.register_thread()
+        sys.settrace(thread.trace_event)
+        try:
+            function()
+        finally:
+            sys.settrace(None)
+        return handler
@@ -0,0 +1,79 @@
+import marshal
+import sys
+import types
+import unittest
+
+import debugger
+from support import DebuggerTestCase, StandInHandler
+
+
+SCRIPT = "game/script.rpy"
+
+
+def compiled(line, expression):
+    """
+    returns expression compiled as renpy compiles expression of statement on line of SCRIPT
+    """
+
+    return compile("\n" * (line - 1) + expression, SCRIPT, "eval")
+
+
+class ScriptBreakpointTest(DebuggerTestCase):
+
+    def setUp(self):
+        DebuggerTestCase.setUp(self)
+        self.install_renpy_python(py_compile_cache={(10, SCRIPT, "x == 1", "eval"): compiled(10, "x == 1")},
+                                  compile_cache={(30, SCRIPT, "y", "eval"): marshal.dumps(compiled(30, "y"))})
+
+    def test_compiled_expressions_are_indexed(self):
+        self.assertEqual(debugger.debugger.executable_lines.get(SCRIPT), [10, 30])
+
+    def test_unseen_lines_are_not_snapped(self):
+        lines = [9, 10, 25, 40]
+        active = debugger.debugger.set_source_breakpoints(SCRIPT, [debugger.Breakpoint(SCRIPT, line) for line in lines])
+
+        # expression of any statement may be compiled only when it first runs
+        self.assertEqual([(breakpoint.line, breakpoint.error) for breakpoint in active],
+                         [(line, None) for line in lines])
+        self.assertEqual(sorted(debugger.debugger.source_breakpoints[SCRIPT].keys()), lines)
+
+
+class PausingHandler(StandInHandler):
+    """
+    Resumes every pause, remembering its reason and code name
+    """
+
+    def __init__(self):
+        StandInHandler.__init__(self)
+        # (reason, code name) of every pause
+        self.stops = []
+
+    def pause_debugging(self, thread):
+        self.stops.append((thread.pause_reason, thread.active_frame.f_code.co_name))
+        debugger.debugger.resume(thread.id)
+
+
+class FunctionBreakpointTest(DebuggerTestCase):
+
+    def setUp(self):
+        DebuggerTestCase.setUp(self)
+        self.module = types.ModuleType("pending_module")
+        sys.modules[self.module.__name__] = self.module
+        self.addCleanup(sys.modules.pop, self.module.__name__)
+
+    def test_pending_breakpoint_resolves_on_first_call(self):
+        breakpoint = debugger.FunctionBreakpoint("pending_function")
+        debugger.debugger.set_function_breakpoints([breakpoint])
+        self.assertEqual(breakpoint.error, "No function pending_function is loaded yet")
+
+        # module defines the function only after breakpoint was set
+        exec(compile("def pending_function():\n    return 1\n", "<pending>", "exec"), self.module.__dict__)
+        handler = self.run_traced(PausingHandler(), self.module.pending_function)
+
+        self.assertIsNone(breakpoint.error)
+        self.assertEqual(handler.changed, [breakpoint])
+        self.assertEqual(handler.stops, [("function breakpoint", "pending_function")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+
+import debugger
+from support import DebuggerTestCase, StandInHandler
+
+
+class StoreDict(dict):
+    """
+    Stands in for renpy's store dict
+    """
+
+
+class SettingHandler(StandInHandler):
+    """
+    Sets variable name of locals of paused frame to value of expression at first pause and resumes when it is answered
+    """
+
+    def __init__(self, name, expression):
+        StandInHandler.__init__(self)
+        self.name = name
+        self.expression = expression
+        # reasons of every pause
+        self.pauses = []
+        # (body, exception) answers of setVariable
+        self.answers = []
+
+    def pause_debugging(self, thread):
+        self.pauses.append(thread.pause_reason)
+        if len(self.pauses) > 1:
+            debugger.debugger.resume(thread.id)
+            return
+
+        def done(body, exception):
+            self.answers.append((body, exception))
+            debugger.debugger.resume(thread.id)
+
+        scopes = debugger.debugger.get_scopes(thread.id * debugger.FRAMES_PER_THREAD)
+        debugger.debugger.set_variable(done, scopes[0]["variablesReference"], self.name, self.expression)
+
+
+class DataBreakpointTest(DebuggerTestCase):
+
+    def setUp(self):
+        DebuggerTestCase.setUp(self)
+        self.timeout = debugger.EVALUATION_TIMEOUT
+        debugger.EVALUATION_TIMEOUT = 2.0
+
+        self.store = StoreDict()
+        self.install_renpy_python(store_dicts={"store": self.store})
+
+    def tearDown(self):
+        debugger.debugger.set_data_breakpoints([])
+        debugger.EVALUATION_TIMEOUT = self.timeout
+        DebuggerTestCase.tearDown(self)
+
+    def run_script(self, source, handler):
+        """
+        runs source as renpy python block in store, traced, pauses answered by handler
+        """
+
+        code = compile(source, "<script>", "exec")
+
+        def run():
+            exec(code, {}, self.store)
+
+        return self.run_traced(handler, run)
+
+    def test_set_variable_on_watched_name(self):
+        debugger.debugger.set_data_breakpoints([debugger.DataBreakpoint("store.x")])
+
+        handler = self.run_script("x = 2\ny = x", SettingHandler("x", "7"))
+
+        # write of the debugger itself does not pause
+        self.assertEqual(handler.pauses, ["data breakpoint"])
+        body, exception = handler.answers[0]
+        self.assertIsNone(exception)
+        self.assertEqual(body["value"], "7")
+        self.assertEqual((self.store["x"], self.store["y"]), (7, 7))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import threading
+import unittest
+
+import debugger
+from support import DebuggerTestCase, StandInHandler
+
+
+class EvaluatingHandler(StandInHandler):
+    """
+    Evaluates (expression, context) evaluations one by one at first pause and resumes when last one is answered
+    """
+
+    def __init__(self, evaluations):
+        StandInHandler.__init__(self)
+        self.evaluations = list(evaluations)
+        # (body, exception) answers of evaluations
+        self.answers = []
+        # thread which answered last
+        self.answered_by = None
+
+    def pause_debugging(self, thread):
+        if self.answers:
+            debugger.debugger.resume(thread.id)
+            return
+        self.evaluate_next(thread)
+
+    def evaluate_next(self, thread):
+        expression, context = self.evaluations[len(self.answers)]
+
+        def done(body, exception):
+            self.answers.append((body, exception))
+            self.answered_by = threading.current_thread()
+            if len(self.answers) < len(self.evaluations):
+                self.evaluate_next(thread)
+            else:
+                debugger.debugger.resume(thread.id)
+
+        # answered by the paused thread once this handler returns and thread waits for resume
+        debugger.debugger.evaluate(done, expression, frameId=thread.id * debugger.FRAMES_PER_THREAD, context=context)
+
+
+def scale(n):
+    factor = 3
+    return n * factor
+
+
+def assign():
+    x = 1
+    return x
+
+
+def spin():
+    while True:
+        pass
+
+
+class EvaluateTest(DebuggerTestCase):
+
+    def setUp(self):
+        DebuggerTestCase.setUp(self)
+        self.timeout = debugger.EVALUATION_TIMEOUT
+
+    def tearDown(self):
+        debugger.EVALUATION_TIMEOUT = self.timeout
+        DebuggerTestCase.tearDown(self)
+
+    def run_evaluation(self, expression, context=None):
+        """
+        runs scale(2) traced with breakpoint on its return line, evaluating expression there
+
+        returns the handler, holding answers of evaluation
+        """
+
+        self.break_at(scale, scale.__code__.co_firstlineno + 2)
+        return self.run_traced(EvaluatingHandler([(expression, context)]), lambda: scale(2))
+
+    def test_evaluated_in_paused_thread(self):
+        handler = self.run_evaluation("n * factor")
+
+        self.assertEqual(len(handler.answers), 1)
+        body, exception = handler.answers[0]
+        self.assertIsNone(exception)
+        self.assertEqual(body["result"], "6")
+        self.assertIs(handler.answered_by, threading.current_thread())
+
+    def test_failure_answered(self):
+        handler = self.run_evaluation("missing")
+
+        body, exception = handler.answers[0]
+        self.assertIsNone(body)
+        self.assertIsInstance(exception, NameError)
+
+    def test_repl_invalidates_cached_results(self):
+        results = []
+        self.break_at(assign, assign.__code__.co_firstlineno + 2)
+        handler = EvaluatingHandler([("x", "hover"), ("x = 5", "repl"), ("x", "hover")])
+        self.run_traced(handler, lambda: results.append(assign()))
+
+        self.assertEqual([exception for body, exception in handler.answers], [None, None, None])
+        self.assertEqual(handler.answers[0][0]["result"], "1")
+        self.assertEqual(handler.answers[2][0]["result"], "5")
+        self.assertEqual(results, [5])
+
+    def test_timeout_interrupts_evaluation(self):
+        debugger.EVALUATION_TIMEOUT = 0.2
+        handler = self.run_evaluation("__import__('test_evaluate').spin()")
+
+        body, exception = handler.answers[0]
+        self.assertIsInstance(exception, debugger.EvaluationTimeout)
+        self.assertIsNot(handler.answered_by, threading.current_thread())
+
+
+if __name__ == "__main__":
+    unittest.main()
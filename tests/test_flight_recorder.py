@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import debugger
+import flight_log
+
+
+CODES = [compile("pass", "<even>", "exec"), compile("pass", "<odd>", "exec")]
+
+
+class Frame(object):
+    """
+    Stands in for frame of n-th recorded event, its code tells whether n is even
+    """
+
+    def __init__(self, n):
+        self.f_code = CODES[n % 2]
+        self.f_lineno = n
+
+
+class FlightRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_dump_while_recording(self):
+        recorder = debugger.FlightRecorder(5000)
+        record = recorder.tracer(1)
+        stopped = threading.Event()
+
+        def write():
+            n = 0
+            while not stopped.is_set():
+                record(Frame(n), "line", None)
+                n += 1
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            dumps = []
+            for i in range(20):
+                path = os.path.join(self.directory, "dump%d" % i)
+                recorder.dump(path, None, {})
+                dumps.append(flight_log.read_log(path))
+        finally:
+            stopped.set()
+            writer.join()
+
+        for header, events in dumps:
+            files = [header["codes"][code_id][0] for code_id, line, event, thread, time in events]
+            lines = [line for code_id, line, event, thread, time in events]
+            times = [time for code_id, line, event, thread, time in events]
+            self.assertEqual(lines, sorted(lines))
+            self.assertEqual(times, sorted(times))
+            self.assertEqual(files, [CODES[line % 2].co_filename for line in lines])
+
+    def test_dump_last_seconds(self):
+        recorder = debugger.FlightRecorder(10)
+        record = recorder.tracer(1)
+        for n in range(25):
+            record(Frame(n), "line", None)
+        path = os.path.join(self.directory, "dump")
+
+        self.assertEqual(recorder.dump(path, None, {}), 10)
+        self.assertEqual([event[1] for event in flight_log.read_log(path)[1]], list(range(15, 25)))
+        self.assertEqual(recorder.dump(path, 0, {}), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+import dis
+import unittest
+
+import debugger
+from support import DebuggerTestCase, StandInHandler
+
+
+class InstructionHandler(StandInHandler):
+    """
+    Answers every pause with next scripted action
+
+    Actions are "instruction", "instructionIn" or "continue", pauses left without action continue
+    """
+
+    def __init__(self, actions):
+        StandInHandler.__init__(self)
+        self.actions = list(actions)
+        # (reason, code name, instruction offset) of every pause
+        self.stops = []
+
+    def pause_debugging(self, thread):
+        frame = thread.active_frame
+        self.stops.append((thread.pause_reason, frame.f_code.co_name, frame.f_lasti))
+
+        action = self.actions.pop(0) if self.actions else "continue"
+        if action == "continue":
+            debugger.debugger.resume(thread.id)
+        elif action == "instruction":
+            debugger.debugger.step(thread.id, debugger.StepInstruction)
+        else:
+            debugger.debugger.step(thread.id, debugger.StepInstructionInto)
+
+
+def double(n):
+    doubled = n * 2
+    return doubled
+
+
+def call_double():
+    value = double(1)
+    return value
+
+
+def offsets(function, name):
+    """
+    returns offsets of instructions of function named name
+    """
+
+    return [instruction.offset for instruction in dis.get_instructions(function) if instruction.opname == name]
+
+
+@unittest.skipUnless(debugger.INSTRUCTION_TRACING, "instruction tracing needs python 3.7 or newer")
+class InstructionTest(DebuggerTestCase):
+
+    def breakpoint_at(self, function, offset):
+        reference = debugger.debugger.disassembly.reference(function.__code__, 0)
+        breakpoint = debugger.InstructionBreakpoint(reference, offset)
+        debugger.debugger.set_instruction_breakpoints([breakpoint])
+        return breakpoint
+
+    def test_disassemble(self):
+        reference = debugger.debugger.disassembly.reference(double.__code__, 0)
+        instructions = debugger.debugger.disassemble(reference, 3)["instructions"]
+
+        expected = [instruction.opname for instruction in dis.get_instructions(double)][:3]
+        self.assertEqual([instruction["instruction"].split(" ")[0] for instruction in instructions], expected)
+        self.assertEqual(instructions[0]["symbol"], "double")
+
+    def test_instruction_breakpoint(self):
+        store = offsets(double, "STORE_FAST")[0]
+        breakpoint = self.breakpoint_at(double, store)
+        self.assertIsNone(breakpoint.error)
+        self.assertEqual(breakpoint.line, double.__code__.co_firstlineno + 1)
+
+        handler = self.run_traced(InstructionHandler([]), lambda: double(2))
+
+        self.assertEqual(handler.stops, [("breakpoint", "double", store)])
+
+    def test_instruction_breakpoint_while_recording(self):
+        debugger.debugger.set_recording(1000)
+        store = offsets(double, "STORE_FAST")[0]
+        self.breakpoint_at(double, store)
+
+        handler = self.run_traced(InstructionHandler(["instruction", "continue"]), lambda: double(2))
+
+        self.assertEqual(handler.stops[0], ("breakpoint", "double", store))
+        self.assertEqual(handler.stops[1][:2], ("step", "double"))
+
+    def test_step_instruction(self):
+        store = offsets(double, "STORE_FAST")[0]
+        self.breakpoint_at(double, store)
+
+        handler = self.run_traced(InstructionHandler(["instruction", "continue"]), lambda: double(2))
+
+        following = [offset for offset in (i.offset for i in dis.get_instructions(double)) if offset > store][0]
+        self.assertEqual(handler.stops, [("breakpoint", "double", store), ("step", "double", following)])
+
+    def test_step_instruction_into_call(self):
+        call = max(offset for name in ("CALL_FUNCTION", "CALL") for offset in offsets(call_double, name))
+        self.breakpoint_at(call_double, call)
+
+        handler = self.run_traced(InstructionHandler(["instructionIn", "continue"]), call_double)
+
+        self.assertEqual(handler.stops[0], ("breakpoint", "call_double", call))
+        self.assertEqual(handler.stops[1][:2], ("stepIn", "double"))
+
+    def test_reload_invalidates_breakpoints(self):
+        breakpoint = self.breakpoint_at(double, offsets(double, "STORE_FAST")[0])
+
+        changed = debugger.debugger.reload()
+
+        self.assertIn(breakpoint, changed)
+        self.assertEqual(breakpoint.error, "Code was reloaded")
+        self.assertEqual(debugger.debugger.instruction_breakpoints, {})
+
+    def test_freed_code_is_not_resolved(self):
+        code = compile("x = 1", "<freed>", "exec")
+        reference = debugger.debugger.disassembly.reference(code, 0)
+        del code
+
+        with self.assertRaises(ValueError):
+            debugger.debugger.disassembly.resolve(reference)
+
+
+if __name__ == "__main__":
+    unittest.main()
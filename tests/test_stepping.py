@@ -0,0 +1,135 @@
+import unittest
+
+import debugger
+from support import DebuggerTestCase, StandInHandler
+
+
+STEPPING = {"next": debugger.StepNext, "in": debugger.StepInto, "out": debugger.StepOut}
+
+
+class ScriptedHandler(StandInHandler):
+    """
+    Answers every pause with next scripted action
+
+    Actions are "next", "in", "out" or "continue", pauses left without action continue
+    """
+
+    def __init__(self, actions):
+        StandInHandler.__init__(self)
+        self.actions = list(actions)
+        # (reason, code name, line) of every pause
+        self.stops = []
+        # locals of paused frame at every pause
+        self.locals = []
+
+    def pause_debugging(self, thread):
+        frame = thread.active_frame
+        self.stops.append((thread.pause_reason, frame.f_code.co_name, frame.f_lineno))
+        self.locals.append(dict(frame.f_locals))
+
+        action = self.actions.pop(0) if self.actions else "continue"
+        if action == "continue":
+            debugger.debugger.resume(thread.id)
+        else:
+            debugger.debugger.step(thread.id, STEPPING[action])
+
+
+def recurse(n):
+    if n > 0:
+        recurse(n - 1)
+    return n
+
+
+def numbers():
+    yield 1
+    yield 2
+
+
+def consume():
+    values = numbers()
+    first = next(values)
+    second = next(values)
+    return first + second
+
+
+def raiser():
+    raise ValueError("raised")
+
+
+def catcher():
+    try:
+        raiser()
+    except ValueError:
+        caught = True
+    return caught
+
+
+def at(function, offset):
+    """
+    returns line offset lines below def line of function
+    """
+
+    return function.__code__.co_firstlineno + offset
+
+
+class SteppingTest(DebuggerTestCase):
+
+    def run_script(self, function, line, actions, condition=None):
+        """
+        runs function traced, with breakpoint (with condition) at line of its file, answering pauses with actions
+
+        returns the handler, holding pauses that happened
+        """
+
+        self.break_at(function, line, condition)
+        return self.run_traced(ScriptedHandler(actions), function)
+
+    def test_step_out_of_recursion(self):
+        # step out of innermost frame stops in its caller, breakpoint fires again in the outermost one
+        handler = self.run_script(lambda: recurse(2), at(recurse, 3), ["out", "continue", "continue"])
+
+        self.assertEqual(handler.stops, [("breakpoint", "recurse", at(recurse, 3)),
+                                         ("stepOut", "recurse", at(recurse, 3)),
+                                         ("breakpoint", "recurse", at(recurse, 3))])
+        self.assertEqual([stop["n"] for stop in handler.locals], [0, 1, 2])
+
+    def test_step_over_recursion(self):
+        # recursive call is stepped over, not into, breakpoint of the line fires only in the outermost frame
+        handler = self.run_script(lambda: recurse(2), at(recurse, 2), ["next", "continue"], condition="n == 2")
+
+        self.assertEqual(handler.stops, [("breakpoint", "recurse", at(recurse, 2)),
+                                         ("step", "recurse", at(recurse, 3))])
+        self.assertEqual([stop["n"] for stop in handler.locals], [2, 2])
+
+    def test_step_across_yield(self):
+        handler = self.run_script(consume, at(consume, 2), ["in", "out", "in", "next", "continue"])
+
+        self.assertEqual(handler.stops, [("breakpoint", "consume", at(consume, 2)),
+                                         ("stepIn", "numbers", at(numbers, 1)),
+                                         ("stepOut", "consume", at(consume, 3)),
+                                         ("stepIn", "numbers", at(numbers, 2)),
+                                         ("step", "consume", at(consume, 4))])
+
+    def test_step_over_raising_call(self):
+        handler = self.run_script(catcher, at(catcher, 2), ["next", "continue"])
+
+        self.assertEqual(handler.stops, [("breakpoint", "catcher", at(catcher, 2)),
+                                         ("step", "catcher", at(catcher, 3))])
+
+    def test_step_into_raising_call(self):
+        handler = self.run_script(catcher, at(catcher, 2), ["in", "next", "continue"])
+
+        self.assertEqual(handler.stops, [("breakpoint", "catcher", at(catcher, 2)),
+                                         ("stepIn", "raiser", at(raiser, 1)),
+                                         ("step", "catcher", at(catcher, 3))])
+
+    def test_step_out_of_raising_call(self):
+        handler = self.run_script(catcher, at(catcher, 2), ["in", "out", "continue"])
+
+        self.assertEqual(handler.stops, [("breakpoint", "catcher", at(catcher, 2)),
+                                         ("stepIn", "raiser", at(raiser, 1)),
+                                         ("stepOut", "catcher", at(catcher, 3))])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import sys
+import threading
+import unittest
+
+import debugger
+from support import DebuggerTestCase, StandInHandler
+
+
+class HoldingHandler(StandInHandler):
+    """
+    Keeps first paused thread paused, listing scopes of its top frame, other pauses are resumed
+    """
+
+    def __init__(self):
+        StandInHandler.__init__(self)
+        # set once first thread paused
+        self.held = threading.Event()
+        self.held_thread = None
+        # scopes (locals, globals) of held thread's top frame
+        self.scopes = None
+
+    def pause_debugging(self, thread):
+        if self.held_thread is None:
+            self.held_thread = thread
+            self.scopes = debugger.debugger.get_scopes(thread.id * debugger.FRAMES_PER_THREAD)
+            self.held.set()
+        else:
+            debugger.debugger.resume(thread.id)
+
+
+def scale(n):
+    factor = 3
+    return n * factor
+
+
+def traced_scale(n):
+    thread = debugger.debugger.register_thread()
+    sys.settrace(thread.trace_event)
+    try:
+        scale(n)
+    finally:
+        sys.settrace(None)
+
+
+class ThreadsTest(DebuggerTestCase):
+
+    def test_other_thread_keeps_references(self):
+        debugger.debugger.pause_all = False
+        self.break_at(scale, scale.__code__.co_firstlineno + 2)
+        debugger.handler = handler = HoldingHandler()
+
+        held = threading.Thread(target=traced_scale, args=(2,))
+        held.start()
+        self.assertTrue(handler.held.wait(10))
+        try:
+            # another thread breaks and resumes while first one stays paused
+            other = threading.Thread(target=traced_scale, args=(5,))
+            other.start()
+            other.join(10)
+
+            variables = debugger.debugger.format_variable(handler.scopes[1]["variablesReference"])
+            self.assertIn("traced_scale", [variable["name"] for variable in variables])
+        finally:
+            debugger.debugger.resume(handler.held_thread.id)
+            held.join(10)
+
+
+if __name__ == "__main__":
+    unittest.main()